@@ -0,0 +1,57 @@
+'''
+Cached sampling tables of the bending magnet (BendingMagnetSamplingTables): time of a run of the source
+(S4BendingMagnetLightSource.get_beam) without the cache, at the first run with the cache (tables computed) and at the
+following runs (tables reused, as in a seed loop). The beams are identical with and without the cache.
+
+usage: python benchmarks/benchmark_bending_magnet_tables.py [number of rays] [number of energy points] [repetitions]
+'''
+import sys, time
+import numpy
+
+from shadow4.sources.s4_electron_beam import S4ElectronBeam
+from shadow4.sources.bending_magnet.s4_bending_magnet import S4BendingMagnet
+from shadow4.sources.bending_magnet.s4_bending_magnet_light_source import S4BendingMagnetLightSource
+
+from orangecontrib.shadow4.util.shadow4_cache import BendingMagnetSamplingTables
+
+def get_light_source(number_of_rays, ng_e, seed):
+    electron_beam   = S4ElectronBeam(energy_in_GeV=6.0, energy_spread=0.001, current=0.2)
+    magnetic_field  = -0.87
+    magnetic_radius = numpy.abs(S4BendingMagnet.calculate_magnetic_radius(magnetic_field, electron_beam.energy()))
+
+    bm = S4BendingMagnet(magnetic_radius, magnetic_field, 1e-3 * magnetic_radius, emin=5000.0, emax=100000.0, ng_e=ng_e, flag_emittance=0)
+
+    return S4BendingMagnetLightSource(electron_beam=electron_beam, magnetic_structure=bm, nrays=number_of_rays, seed=seed)
+
+def measure(function):
+    t0 = time.perf_counter()
+    result = function()
+
+    return time.perf_counter() - t0, result
+
+if __name__ == "__main__":
+    number_of_rays = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    ng_e           = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    repetitions    = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    seeds = numpy.arange(1, repetitions + 1) * 1000
+
+    no_cache = [measure(lambda: get_light_source(number_of_rays, ng_e, seed).get_beam()) for seed in seeds]
+
+    BendingMagnetSamplingTables.cache.clear()
+    with BendingMagnetSamplingTables.use():
+        cache = [measure(lambda: get_light_source(number_of_rays, ng_e, seed).get_beam()) for seed in seeds]
+
+    for (_, beam), (_, cached_beam) in zip(no_cache, cache):
+        assert numpy.array_equal(beam.rays, cached_beam.rays), "different beams with the cache"
+
+    no_cache_time = numpy.min([t for t, _ in no_cache])
+    first_time    = cache[0][0]
+    cached_time   = numpy.min([t for t, _ in cache[1:]]) if repetitions > 1 else numpy.nan
+
+    print("%d rays, %d energy points, best of %d [ms]" % (number_of_rays, ng_e, repetitions))
+    print("%-28s %12.1f" % ("no cache", 1e3 * no_cache_time))
+    print("%-28s %12.1f" % ("cache, first run", 1e3 * first_time))
+    print("%-28s %12.1f" % ("cache, following runs", 1e3 * cached_time))
+    print("%-28s %12.1f" % ("saving per run", 1e3 * (no_cache_time - cached_time)))
+    print("cache: %d hits, %d misses" % (BendingMagnetSamplingTables.cache.hits, BendingMagnetSamplingTables.cache.misses))
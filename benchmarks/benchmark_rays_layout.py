@@ -0,0 +1,63 @@
+'''
+Row-major vs column-major rays (ShadowData.set_rays_layout) on the computations done by the plot widgets:
+the histograms of ShadowPlot.DetailedHistoWidget/DetailedPlotWidget (S4Beam.histo1/histo2, good rays, weighted by
+the intensity) and the column reads of the preview plots (S4Beam.get_column).
+
+usage: python benchmarks/benchmark_rays_layout.py [number of rays] [repetitions]
+'''
+import sys, time
+import numpy
+
+from shadow4.beam.s4_beam import S4Beam
+
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+
+def get_shadow_data(number_of_rays, rays_layout):
+    random = numpy.random.default_rng(12345)
+
+    beam = S4Beam(N=number_of_rays)
+    beam.rays[:, 0:3]   = random.normal(0.0, 1e-4, (number_of_rays, 3))
+    beam.rays[:, 3]     = random.normal(0.0, 1e-5, number_of_rays)
+    beam.rays[:, 5]     = random.normal(0.0, 1e-5, number_of_rays)
+    beam.rays[:, 4]     = numpy.sqrt(1.0 - beam.rays[:, 3]**2 - beam.rays[:, 5]**2)
+    beam.rays[:, 6]     = 1.0
+    beam.rays[:, 9]     = numpy.where(random.uniform(size=number_of_rays) < 0.9, 1.0, -1.0)
+    beam.rays[:, 10]    = 50677.3 # 10 keV
+    beam.rays[:, 11]    = numpy.arange(1, number_of_rays + 1)
+
+    return ShadowData(beam=beam, rays_layout=rays_layout)
+
+def measure(function, repetitions):
+    times = []
+    for _ in range(repetitions):
+        t0 = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - t0)
+
+    return numpy.min(times)
+
+if __name__ == "__main__":
+    number_of_rays = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    repetitions    = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    paths = {
+        "get_column(1)"                 : lambda beam: beam.get_column(1, nolost=0),
+        "get_column(1, nolost=1)"       : lambda beam: beam.get_column(1, nolost=1),
+        "histo1(1) (Histogram)"         : lambda beam: beam.histo1(1, nbins=100, nolost=1, ref=23),
+        "histo2(1, 3) (PlotXY)"         : lambda beam: beam.histo2(1, 3, nbins=100, nolost=1, ref=23),
+        "histo2(4, 6) (PlotXY)"         : lambda beam: beam.histo2(4, 6, nbins=100, nolost=1, ref=23),
+    }
+
+    results = {}
+    for rays_layout, layout_name in [(ShadowData.ROW_MAJOR, "row-major"), (ShadowData.COLUMN_MAJOR, "column-major")]:
+        shadow_data = get_shadow_data(number_of_rays, ShadowData.ROW_MAJOR)
+        results[layout_name] = {"conversion" : measure(lambda: shadow_data.set_rays_layout(rays_layout), 1)}
+
+        beam = shadow_data.beam
+        for name, path in paths.items(): results[layout_name][name] = measure(lambda: path(beam), repetitions)
+
+    print("%d rays, best of %d [ms]" % (number_of_rays, repetitions))
+    print("%-28s %12s %12s %8s" % ("", "row-major", "column-major", "ratio"))
+    for name in ["conversion"] + list(paths.keys()):
+        row, column = results["row-major"][name], results["column-major"][name]
+        print("%-28s %12.2f %12.2f %8.2f" % (name, 1e3 * row, 1e3 * column, row / column if column > 0 else numpy.nan))
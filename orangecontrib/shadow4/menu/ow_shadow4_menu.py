@@ -1,7 +1,11 @@
 __author__ = 'L. Rebuffi'
 
 import webbrowser
+from AnyQt.QtWidgets import QInputDialog
 from oasys2.canvas.menus.menu import OMenu
+from oasys2.widget.gui import MessageDialog
+
+from orangecontrib.shadow4.util.shadow4_memory import MemoryManager
 
 from orangecontrib.shadow4.widgets.gui.ow_automatic_element import AutomaticElement
 from orangecontrib.shadow4.widgets.gui.ow_generic_element import GenericElement
@@ -33,6 +37,12 @@ class Shadow4Menu(OMenu):
         self.closeContainer()
         self.addSubMenu("Execute all the Preprocessor widgets")
         self.addSeparator()
+        self.openContainer()
+        self.addContainer("Memory")
+        self.addSubMenu("Show the memory used by the widgets")
+        self.addSubMenu("Set the memory budget")
+        self.closeContainer()
+        self.addSeparator()
         self.addSubMenu("Shadow4 Documentation")
 
     def __set_plot_visibility(self, vt, pg):
@@ -97,6 +107,32 @@ class Shadow4Menu(OMenu):
             super(Shadow4Menu, self).showCriticalMessage(message=exception.args[0])
 
     def executeAction_8(self, action):
+        try:
+            MemoryManager.check()
+
+            budget = MemoryManager.get_budget()
+            usage  = MemoryManager.get_usage()
+
+            text = "Resident rays: {:.1f} MB".format(MemoryManager.get_resident_bytes()*1e-6)
+            text += " (budget: " + ("not set" if budget == 0 else "{:.1f} MB".format(budget*1e-6)) + ")\n\n"
+            for title, resident, spilled in usage:
+                if resident + spilled > 0: text += "{}: {:.1f} MB, spilled to disk: {:.1f} MB\n".format(title, resident*1e-6, spilled*1e-6)
+
+            MessageDialog.message(self.canvas_main_window, text, "Memory used by the Shadow4 widgets", "information")
+        except Exception as exception:
+            super(Shadow4Menu, self).showCriticalMessage(message=exception.args[0])
+
+    def executeAction_9(self, action):
+        try:
+            budget, ok = QInputDialog.getDouble(self.canvas_main_window, "Memory Budget",
+                                                "Budget for the rays held by the widgets [GB] (0: no budget)\n"
+                                                "Beyond it, plotted beams are dropped and idle beams spilled to disk",
+                                                MemoryManager.get_budget()*1e-9, 0.0, 1e4, 2)
+            if ok: MemoryManager.set_budget(budget)
+        except Exception as exception:
+            super(Shadow4Menu, self).showCriticalMessage(message=exception.args[0])
+
+    def executeAction_10(self, action):
         try:
             webbrowser.open("https://shadow4.readthedocs.io/")
         except Exception as exception:
@@ -0,0 +1,28 @@
+import numpy
+
+from shadow4.beam.s4_beam import S4Beam
+
+class UniformLightSource:
+    '''
+    Light source drawing its rays as the shadow4 sources: numpy.random is seeded in get_beam, unless the seed is 0
+    (picklable, for the worker processes).
+    '''
+    def __init__(self, seed=5676561, number_of_rays=1000):
+        self.seed           = seed
+        self.number_of_rays = number_of_rays
+
+    def get_seed(self):         return self.seed
+    def set_seed(self, seed):   self.seed = seed
+    def get_nrays(self):        return self.number_of_rays
+    def set_nrays(self, nrays): self.number_of_rays = nrays
+
+    def get_beam(self):
+        if self.seed != 0: numpy.random.seed(self.seed)
+
+        rays = numpy.zeros((self.number_of_rays, 18))
+        rays[:, 0]  = numpy.random.random(self.number_of_rays)
+        rays[:, 6]  = 1.0
+        rays[:, 9]  = 1.0
+        rays[:, 11] = numpy.arange(1, self.number_of_rays + 1)
+
+        return S4Beam(array=rays)
@@ -0,0 +1,188 @@
+import io
+import os
+import types
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from contextlib import redirect_stdout
+
+from shadow4.beam.s4_beam import S4Beam
+from shadow4.sources.wiggler.s4_wiggler_light_source import S4WigglerLightSource
+from shadow4.sources.wiggler.s4_wiggler_optimized_light_source import S4WigglerOptimizedLightSource
+
+from orangecontrib.shadow4.util.shadow4_cache import get_cache_key, LRUCache, DiskCache, ModulePatch, PrivateAttributes
+from orangecontrib.shadow4.util.shadow4_loops import sample_light_source
+
+class TemporaryDiskCache(DiskCache):
+    def __init__(self, directory, maximum_size=2e9):
+        super().__init__("test", maximum_size=maximum_size)
+        self.directory = directory
+
+    def get_directory(self):
+        return self.directory
+
+class S4UndulatorLightSource:
+    '''
+    As the shadow4 undulator: the radiation is calculated once, and every get_beam scales it in place.
+    '''
+    def __init__(self):
+        self.__result_radiation = None
+
+    def get_result_dictionary(self):
+        if self.__result_radiation is None: self.__result_radiation = {"BACKPROPAGATED_r" : numpy.ones(5)}
+        return self.__result_radiation
+
+    def get_beam(self):
+        radiation = self.get_result_dictionary()
+        radiation["BACKPROPAGATED_r"] *= 2.0
+        radiation["sampled"] = True
+
+        return S4Beam(array=numpy.tile(radiation["BACKPROPAGATED_r"], (18, 1)).T)
+
+class RenamedUndulatorLightSource(S4UndulatorLightSource):
+    '''
+    A version of shadow4 without the private attribute.
+    '''
+    def __init__(self):
+        super().__init__()
+        del self._S4UndulatorLightSource__result_radiation
+        self._S4UndulatorLightSource__radiation = None
+
+    def get_result_dictionary(self):
+        if self._S4UndulatorLightSource__radiation is None: self._S4UndulatorLightSource__radiation = {"BACKPROPAGATED_r" : numpy.ones(5)}
+        return self._S4UndulatorLightSource__radiation
+
+class CacheKeyTest(unittest.TestCase):
+    def test_cache_key(self):
+        self.assertEqual(get_cache_key("a", 1.0, numpy.arange(3)), get_cache_key("a", 1.0, numpy.arange(3)))
+        self.assertNotEqual(get_cache_key("a", 1.0, numpy.arange(3)), get_cache_key("a", 1.0, numpy.arange(4)))
+        self.assertNotEqual(get_cache_key(numpy.arange(3)), get_cache_key(numpy.arange(3, dtype=float)))
+
+class LRUCacheTest(unittest.TestCase):
+    def test_least_recently_used_removed(self):
+        cache = LRUCache(maximum_size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        cache.get("a")
+        cache.put("c", 3)
+
+        self.assertEqual(cache.get("a"), 1)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), 3)
+
+    def test_get_or_compute(self):
+        cache = LRUCache()
+        calls = []
+
+        for _ in range(3): self.assertEqual(cache.get_or_compute("key", lambda: calls.append(1) or 42), 42)
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+class DiskCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_save_and_load(self):
+        TemporaryDiskCache(self.directory).save("key", {"array" : numpy.arange(5.0)})
+
+        entry = TemporaryDiskCache(self.directory).load("key") # a new session
+
+        numpy.testing.assert_array_equal(entry["array"], numpy.arange(5.0))
+        self.assertIsNone(TemporaryDiskCache(self.directory).load("other key"))
+
+    def test_entries_are_copied(self):
+        cache = TemporaryDiskCache(self.directory)
+        entry = {"array" : numpy.arange(5.0)}
+        cache.save("key", entry)
+
+        entry["array"] *= 2
+        cache.load("key")["array"] *= 2
+
+        numpy.testing.assert_array_equal(cache.load("key")["array"], numpy.arange(5.0))
+
+    def test_clear(self):
+        cache = TemporaryDiskCache(self.directory)
+        cache.save("key", 1)
+        cache.clear()
+
+        self.assertIsNone(cache.load("key"))
+        self.assertEqual(os.listdir(self.directory), [])
+
+class ModulePatchTest(unittest.TestCase):
+    def test_overlapping_users(self):
+        module = types.ModuleType("patched_module")
+        module.function = original = lambda: "original"
+
+        with ModulePatch.use(module, "function", lambda function: lambda: "patched"):
+            with ModulePatch.use(module, "function", lambda function: lambda: "patched again"):
+                self.assertEqual(module.function(), "patched")
+            self.assertEqual(module.function(), "patched")
+
+        self.assertIs(module.function, original)
+
+class PrivateAttributesTest(unittest.TestCase):
+    def test_attributes(self):
+        light_source = S4UndulatorLightSource()
+        results      = PrivateAttributes(light_source, "S4UndulatorLightSource", ["result_radiation"])
+
+        self.assertTrue(results.is_instance())
+        self.assertTrue(results.is_available())
+
+        results.set("result_radiation", {"BACKPROPAGATED_r" : numpy.zeros(2)})
+        self.assertIs(light_source.get_result_dictionary(), results.get("result_radiation"))
+
+        results = PrivateAttributes(RenamedUndulatorLightSource(), "S4UndulatorLightSource", ["result_radiation"])
+
+        self.assertTrue(results.is_instance())
+        self.assertFalse(results.is_available())
+        self.assertIn("has no result_radiation", results.get_warning("radiation cache"))
+
+        self.assertFalse(PrivateAttributes(object(), "S4UndulatorLightSource", ["result_radiation"]).is_instance())
+
+    def test_sample_light_source(self):
+        light_source = S4UndulatorLightSource()
+
+        for _ in range(3): numpy.testing.assert_array_equal(sample_light_source(light_source).rays[:, 0], numpy.full(5, 2.0))
+
+        # the radiation kept is not scaled, the entries added by the sampling are kept
+        numpy.testing.assert_array_equal(light_source.get_result_dictionary()["BACKPROPAGATED_r"], numpy.ones(5))
+        self.assertTrue(light_source.get_result_dictionary()["sampled"])
+
+    def test_sample_light_source_without_attributes(self):
+        light_source = RenamedUndulatorLightSource()
+
+        with redirect_stdout(io.StringIO()) as output:
+            beams = [sample_light_source(light_source) for _ in range(2)]
+
+        self.assertIn("Warning", output.getvalue())
+        numpy.testing.assert_array_equal(beams[1].rays[:, 0], numpy.full(5, 4.0)) # sampled as it is
+
+class WigglerAttributesTest(unittest.TestCase):
+    NAMES = ["calculate_radiation", "result_trajectory", "result_parameters", "result_cdf"]
+
+    def test_installed_shadow4(self):
+        # the trajectory cache of the Wiggler widget works on this version of shadow4
+        for light_source in [S4WigglerLightSource(), S4WigglerOptimizedLightSource()]:
+            results = PrivateAttributes(light_source, "S4WigglerLightSource", self.NAMES)
+
+            self.assertTrue(results.is_available())
+            self.assertTrue(callable(results.get("calculate_radiation")))
+            self.assertIsNone(results.get("result_cdf")) # not calculated yet
+
+    def test_renamed(self):
+        light_source = S4WigglerLightSource()
+        del light_source._S4WigglerLightSource__result_cdf
+
+        results = PrivateAttributes(light_source, "S4WigglerLightSource", self.NAMES)
+
+        self.assertFalse(results.is_available())
+        self.assertTrue(results.get_warning("trajectory cache").endswith("has no result_cdf"))
+
+if __name__ == "__main__":
+    unittest.main()
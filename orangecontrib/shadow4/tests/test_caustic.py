@@ -0,0 +1,131 @@
+import unittest
+import numpy
+
+from shadow4.beam.s4_beam import S4Beam
+
+from orangecontrib.shadow4.util.shadow4_caustic import BeamRetracer, FocusFinder
+
+def get_focused_beam(number_of_rays=20000, waist=2.0, sigma_x=1e-6, divergence_x=1e-5, seed=0):
+    '''
+    Beam at Y=0 whose rays cross at Y=waist (within sigma_x), with random intensities and some lost rays.
+    '''
+    random = numpy.random.default_rng(seed)
+
+    tan_x = random.normal(0.0, divergence_x, number_of_rays)
+    tan_z = random.normal(0.0, 2*divergence_x, number_of_rays)
+
+    rays = numpy.zeros((number_of_rays, 18))
+    rays[:, 0]  = random.normal(0.0, sigma_x, number_of_rays) - waist * tan_x
+    rays[:, 2]  = random.normal(0.0, 2*sigma_x, number_of_rays) - waist * tan_z
+    rays[:, 4]  = 1 / numpy.sqrt(1 + tan_x**2 + tan_z**2)
+    rays[:, 3]  = tan_x * rays[:, 4]
+    rays[:, 5]  = tan_z * rays[:, 4]
+    rays[:, 6]  = random.uniform(0.5, 1.0, number_of_rays)
+    rays[:, 15] = random.uniform(0.0, 0.5, number_of_rays)
+    rays[:, 9]  = numpy.where(random.random(number_of_rays) < 0.1, -1.0, 1.0)
+    rays[:, 10] = 1e5
+    rays[:, 11] = numpy.arange(1, number_of_rays + 1)
+
+    return S4Beam(array=rays)
+
+def get_retraced_beam(beam, position):
+    beam = beam.duplicate()
+    beam.retrace(position, resetY=True)
+
+    return beam
+
+class BeamRetracerTest(unittest.TestCase):
+    def setUp(self):
+        self.beam      = get_focused_beam()
+        self.positions = numpy.linspace(0.0, 4.0, 9)
+
+    def test_coordinates(self):
+        retracer = BeamRetracer(self.beam, nolost=1)
+        good     = self.beam.rays[:, 9] > 0
+
+        for col in [1, 3]:
+            coordinates = retracer.get_coordinates(col, self.positions)
+
+            for index, position in enumerate(self.positions):
+                numpy.testing.assert_allclose(coordinates[:, index], get_retraced_beam(self.beam, position).rays[good, col - 1], rtol=0, atol=1e-15)
+
+        self.assertRaises(ValueError, retracer.get_coordinates, 2, self.positions)
+
+    def test_histograms(self):
+        xrange = [-3e-5, 3e-5]
+
+        for col in [1, 3]:
+            # small chunks: the rays are processed in several passes
+            histograms = BeamRetracer(self.beam, nolost=1, ref=23, maximum_elements_per_chunk=10000).histograms(col, self.positions, xrange, 51)
+
+            for index, position in enumerate(self.positions):
+                ticket = get_retraced_beam(self.beam, position).histo1(col, xrange=xrange, nbins=51, nolost=1, ref=23, calculate_widths=1)
+
+                numpy.testing.assert_allclose(histograms["histogram"][:, index], ticket["histogram"], rtol=1e-10, atol=1e-12)
+                numpy.testing.assert_allclose(histograms["bins"], ticket["bins"])
+                if ticket["fwhm"] is None: self.assertTrue(numpy.isnan(histograms["fwhm"][index]))
+                else:                      self.assertAlmostEqual(histograms["fwhm"][index], ticket["fwhm"], delta=1e-12)
+
+    def test_histograms2d(self):
+        xrange, zrange = [-3e-5, 3e-5], [-6e-5, 6e-5]
+
+        cube = BeamRetracer(self.beam, nolost=1, ref=23).histograms2d(self.positions, xrange, zrange, 20, 30)["cube"]
+
+        for index, position in enumerate(self.positions):
+            retraced = get_retraced_beam(self.beam, position)
+            x, z, intensity = retraced.get_columns([1, 3, 23], nolost=1)
+            histogram, _, _ = numpy.histogram2d(x, z, bins=[20, 30], range=[xrange, zrange], weights=intensity)
+
+            numpy.testing.assert_allclose(cube[index], histogram, rtol=1e-10, atol=1e-12)
+
+    def test_rms_size(self):
+        retracer = BeamRetracer(self.beam, nolost=1, ref=23)
+
+        for position in self.positions:
+            self.assertAlmostEqual(retracer.get_rms_size(1, position),
+                                   get_retraced_beam(self.beam, position).get_standard_deviation(1, nolost=1, ref=23), delta=1e-15)
+
+class FocusFinderTest(unittest.TestCase):
+    def setUp(self):
+        self.beam = get_focused_beam(waist=2.0)
+
+    def test_rms_focus(self):
+        result = FocusFinder(BeamRetracer(self.beam, nolost=1, ref=23), direction="H", kind="rms").find_focus(0.0, 4.0)
+
+        # against a fine scan of the retraced beams
+        positions = numpy.linspace(1.9, 2.1, 201)
+        sizes     = [get_retraced_beam(self.beam, position).get_standard_deviation(1, nolost=1, ref=23) for position in positions]
+
+        self.assertAlmostEqual(result["position"], positions[numpy.argmin(sizes)], delta=2e-3)
+        self.assertAlmostEqual(result["size"], numpy.min(sizes), delta=1e-3 * numpy.min(sizes))
+
+        # the size is sqrt(2) times the waist at the limits of the depth of focus
+        for limit in result["depth_of_focus_limits"]:
+            self.assertAlmostEqual(get_retraced_beam(self.beam, limit).get_standard_deviation(1, nolost=1, ref=23), numpy.sqrt(2) * result["size"],
+                                   delta=1e-3 * result["size"])
+        self.assertAlmostEqual(result["depth_of_focus"], result["depth_of_focus_limits"][1] - result["depth_of_focus_limits"][0])
+
+    def test_fwhm_focus(self):
+        xrange = [-2e-5, 2e-5]
+        result = FocusFinder(BeamRetracer(self.beam, nolost=1, ref=23), direction="V", kind="fwhm", xrange=xrange, nbins=80).find_focus(0.0, 4.0)
+
+        self.assertAlmostEqual(result["position"], 2.0, delta=0.1)
+
+        ticket = get_retraced_beam(self.beam, result["position"]).histo1(3, xrange=xrange, nbins=80, nolost=1, ref=23, calculate_widths=1)
+        self.assertAlmostEqual(result["size"], ticket["fwhm"], delta=1e-12)
+
+    def test_both_directions(self):
+        retracer = BeamRetracer(self.beam, nolost=1, ref=23)
+        finder   = FocusFinder(retracer, direction="both", kind="rms")
+
+        self.assertAlmostEqual(finder.get_size(1.0), numpy.hypot(retracer.get_rms_size(1, 1.0), retracer.get_rms_size(3, 1.0)))
+
+    def test_wrong_parameters(self):
+        retracer = BeamRetracer(self.beam)
+
+        self.assertRaises(ValueError, FocusFinder, retracer, direction="X")
+        self.assertRaises(ValueError, FocusFinder, retracer, kind="hew")
+        self.assertRaises(ValueError, FocusFinder, retracer, kind="fwhm")
+
+if __name__ == "__main__":
+    unittest.main()
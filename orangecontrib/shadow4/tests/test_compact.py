@@ -0,0 +1,103 @@
+import copy
+import unittest
+import numpy
+
+from orangecontrib.shadow4.util.shadow4_compact import CompactRays, get_compact_beam, get_beam_copy, parse_columns, validate_compact_beam
+from orangecontrib.shadow4.tests.test_caustic import get_focused_beam
+
+class CompactRaysTest(unittest.TestCase):
+    def setUp(self):
+        self.beam = get_focused_beam(number_of_rays=5000)
+        self.beam.rays[:, 12] = 100.0 + numpy.random.default_rng(1).normal(0.0, 1e-9, 5000) # optical path
+
+    def test_dtypes(self):
+        rays = get_compact_beam(self.beam, full_precision_columns=[13]).rays
+
+        dtypes = rays.dtypes
+        self.assertEqual(dtypes[9], numpy.int8)
+        self.assertEqual(dtypes[11], numpy.int32)
+        self.assertEqual(dtypes[12], numpy.float64)
+        self.assertEqual([dtype for index, dtype in enumerate(dtypes) if not index in [9, 11, 12]], [numpy.float32] * 15)
+
+        self.assertEqual(rays.shape, (5000, 18))
+        self.assertEqual(rays.nbytes, 5000 * (15 * 4 + 1 + 4 + 8)) # ~40% of the float64 rays
+
+        full_rays = rays.to_float64()
+        numpy.testing.assert_array_equal(full_rays[:, [9, 11, 12]], self.beam.rays[:, [9, 11, 12]]) # exact
+        numpy.testing.assert_allclose(full_rays, self.beam.rays, rtol=1e-7, atol=0)
+
+    def test_not_integer_columns(self):
+        rays = self.beam.rays.copy()
+        rays[0, 9]  = -0.5
+        rays[0, 11] = 2.0**40
+
+        dtypes = CompactRays.initialize_from_rays(rays).dtypes
+
+        self.assertEqual(dtypes[9], numpy.float64)
+        self.assertEqual(dtypes[11], numpy.float64)
+
+    def test_beam(self):
+        compact_beam = get_compact_beam(self.beam)
+
+        self.assertEqual(compact_beam.N, self.beam.N)
+        self.assertEqual(compact_beam.get_number_of_rays(nolost=1), self.beam.get_number_of_rays(nolost=1))
+        numpy.testing.assert_allclose(compact_beam.get_column(23, nolost=1), self.beam.get_column(23, nolost=1), rtol=1e-6)
+        numpy.testing.assert_array_equal(compact_beam.get_rays(nolost=1)[:, 11], self.beam.get_rays(nolost=1)[:, 11])
+
+        # the retrace works on the columns in place
+        retraced_beam = self.beam.duplicate()
+        retraced_beam.retrace(2.0)
+        compact_beam.retrace(2.0)
+
+        self.assertIsInstance(compact_beam.rays, CompactRays)
+        numpy.testing.assert_allclose(compact_beam.rays[:, 0], retraced_beam.rays[:, 0], rtol=0, atol=1e-10)
+
+    def test_copies(self):
+        compact_beam = get_compact_beam(self.beam)
+
+        for duplicate in [compact_beam.duplicate(), copy.deepcopy(compact_beam)]:
+            self.assertIsInstance(duplicate.rays, CompactRays)
+            duplicate.rays[:, 0] = 0.0
+            self.assertNotEqual(compact_beam.rays[0, 0], 0.0)
+
+        # any other write goes through the float64 rays
+        compact_beam.rays[compact_beam.rays[:, 9] < 0, :] = 0.0
+        self.assertEqual(compact_beam.rays.dtypes[9], numpy.int8)
+        self.assertEqual(compact_beam.get_number_of_rays(nolost=2), 0)
+
+    def test_beam_copy(self):
+        self.assertIsInstance(get_beam_copy(self.beam, 0).rays, numpy.ndarray)
+        self.assertIsInstance(get_beam_copy(self.beam, 1).rays, CompactRays)
+        self.assertTrue(get_beam_copy(self.beam, 3).rays.flags.f_contiguous)
+
+        for rays_storage in range(4):
+            beam_copy = get_beam_copy(self.beam, rays_storage)
+            beam_copy.rays[:, 0] = 0.0
+            self.assertNotEqual(self.beam.rays[0, 0], 0.0)
+
+    def test_parse_columns(self):
+        self.assertEqual(parse_columns("11, 13 14"), [11, 13, 14])
+        self.assertEqual(parse_columns(""), [])
+        self.assertRaises(ValueError, parse_columns, "19")
+
+class ValidationTest(unittest.TestCase):
+    def test_validation(self):
+        beam = get_focused_beam(number_of_rays=20000)
+
+        deviations, worst_deviation = validate_compact_beam(beam)
+
+        self.assertEqual(worst_deviation, max(deviations.values()))
+        self.assertLess(worst_deviation, 1e-5)
+        self.assertIn("fwhm col 3", deviations)
+        self.assertIn("mean col 26", deviations) # constant energy: relative to the mean
+
+    def test_precision_loss(self):
+        # float32 cannot resolve a spot of 1e-9 around 1e3: the validation reports it, unless the column is in full precision
+        beam = get_focused_beam(number_of_rays=20000)
+        beam.rays[:, 0] = 1e3 + numpy.random.default_rng(0).normal(0.0, 1e-9, 20000)
+
+        self.assertGreater(validate_compact_beam(beam, columns=[1])[1], 1.0)
+        self.assertLess(validate_compact_beam(beam, full_precision_columns=[1], columns=[1])[1], 1e-3) # float64 sums of 1e3 +- 1e-9
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import numpy
+
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData, LazyFootprint
+from orangecontrib.shadow4.tests.test_caustic import get_focused_beam
+
+class CountingElement:
+    '''
+    Deterministic element: its footprint is the input beam, scaled.
+    '''
+    number_of_traces = 0
+
+    def __init__(self, input_beam):
+        self.input_beam = input_beam
+
+    def trace_beam(self):
+        CountingElement.number_of_traces += 1
+
+        footprint = self.input_beam.duplicate()
+        footprint.rays[:, 0] *= 2.0
+
+        return self.input_beam.duplicate(), footprint
+
+class LazyFootprintTest(unittest.TestCase):
+    def setUp(self):
+        CountingElement.number_of_traces = 0
+
+        self.element      = CountingElement(get_focused_beam(number_of_rays=1000))
+        _, self.footprint = self.element.trace_beam()
+
+    def test_kept(self):
+        lazy_footprint = LazyFootprint(self.element, self.footprint)
+
+        self.assertTrue(lazy_footprint.is_materialized())
+        self.assertIs(lazy_footprint.materialize(), self.footprint)
+        self.assertEqual(CountingElement.number_of_traces, 1)
+
+    def test_traced_on_demand(self):
+        shadow_data = ShadowData(beam=self.footprint, footprint=LazyFootprint(self.element))
+
+        self.assertTrue(shadow_data.has_footprint())
+        self.assertTrue(shadow_data.is_footprint_lazy())
+        self.assertEqual(CountingElement.number_of_traces, 1) # not traced until asked for
+
+        numpy.testing.assert_array_equal(shadow_data.footprint.rays, self.footprint.rays)
+        self.assertFalse(shadow_data.is_footprint_lazy())
+        self.assertEqual(CountingElement.number_of_traces, 2)
+
+        shadow_data.footprint
+        self.assertEqual(CountingElement.number_of_traces, 2) # traced once
+
+    def test_release(self):
+        lazy_footprint = LazyFootprint(self.element, self.footprint)
+        lazy_footprint.release()
+
+        self.assertFalse(lazy_footprint.is_materialized())
+        numpy.testing.assert_array_equal(lazy_footprint.materialize().rays, self.footprint.rays)
+        self.assertFalse(lazy_footprint.duplicate().is_materialized())
+
+if __name__ == "__main__":
+    unittest.main()
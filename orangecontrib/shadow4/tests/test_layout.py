@@ -0,0 +1,57 @@
+import unittest
+import numpy
+
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+from orangecontrib.shadow4.util.shadow4_compact import get_column_major_beam, get_compact_beam
+from orangecontrib.shadow4.tests.test_caustic import get_focused_beam
+
+class RaysLayoutTest(unittest.TestCase):
+    def setUp(self):
+        self.beam = get_focused_beam(number_of_rays=5000)
+
+    def test_column_major(self):
+        footprint   = get_focused_beam(number_of_rays=1000, seed=1)
+        shadow_data = ShadowData(beam=self.beam.duplicate(), footprint=footprint.duplicate(), rays_layout=ShadowData.COLUMN_MAJOR)
+
+        self.assertEqual(shadow_data.get_rays_layout(), ShadowData.COLUMN_MAJOR)
+        self.assertTrue(shadow_data.footprint.rays.flags.f_contiguous)
+        self.assertTrue(shadow_data.beam.get_column(1, nolost=0).flags.c_contiguous) # a contiguous view of the column
+
+        numpy.testing.assert_array_equal(shadow_data.beam.rays, self.beam.rays)
+        numpy.testing.assert_array_equal(shadow_data.footprint.rays, footprint.rays)
+
+        for col in [1, 3, 23, 26]:
+            ticket     = shadow_data.beam.histo1(col, nbins=50, nolost=1, ref=23, calculate_widths=1)
+            ref_ticket = self.beam.histo1(col, nbins=50, nolost=1, ref=23, calculate_widths=1)
+
+            numpy.testing.assert_array_equal(ticket["histogram"], ref_ticket["histogram"])
+            self.assertEqual(ticket["fwhm"], ref_ticket["fwhm"])
+
+    def test_row_major(self):
+        shadow_data = ShadowData(beam=self.beam.duplicate(), rays_layout=ShadowData.COLUMN_MAJOR)
+        shadow_data.set_rays_layout(ShadowData.ROW_MAJOR)
+
+        self.assertEqual(shadow_data.get_rays_layout(), ShadowData.ROW_MAJOR)
+        self.assertTrue(shadow_data.beam.rays.flags.c_contiguous)
+        numpy.testing.assert_array_equal(shadow_data.beam.rays, self.beam.rays)
+
+        self.assertEqual(ShadowData(beam=self.beam).get_rays_layout(), ShadowData.ROW_MAJOR)
+        self.assertRaises(ValueError, shadow_data.set_rays_layout, 2)
+
+    def test_other_rays(self):
+        # compact rays are left as they are
+        shadow_data = ShadowData(beam=get_compact_beam(self.beam))
+        shadow_data.set_rays_layout(ShadowData.COLUMN_MAJOR)
+
+        self.assertEqual(shadow_data.get_rays_layout(), ShadowData.ROW_MAJOR)
+        self.assertEqual(ShadowData().get_rays_layout(), ShadowData.ROW_MAJOR)
+
+    def test_column_major_beam(self):
+        column_major_beam = get_column_major_beam(self.beam)
+
+        self.assertTrue(column_major_beam.rays.flags.f_contiguous)
+        self.assertFalse(numpy.shares_memory(column_major_beam.rays, self.beam.rays))
+        numpy.testing.assert_array_equal(column_major_beam.rays, self.beam.rays)
+
+if __name__ == "__main__":
+    unittest.main()
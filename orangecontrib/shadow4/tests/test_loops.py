@@ -0,0 +1,360 @@
+import os
+import copy
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy
+
+from AnyQt.QtCore import QCoreApplication
+from AnyQt.QtWidgets import QApplication
+
+from oasys2.widget.util.widget_objects import TriggerOut
+
+from shadow4.beam.s4_beam import S4Beam
+from shadow4.beamline.s4_beamline import S4Beamline
+
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+from orangecontrib.shadow4.util.shadow4_loops import ConvergenceMonitor, LoopCheckpoint, LoopDispatcher, ChunkedSource, RejectionSource, RejectionLightSource, regenerate_beam
+from orangecontrib.shadow4.util.shadow4_parallel import SeedManager, trace_beamline_with_seed
+from orangecontrib.shadow4.util.shadow4_util import ChunkedSourceDecorator, TriggerToolsDecorator
+from orangecontrib.shadow4.tests.fake_sources import UniformLightSource
+
+def get_gaussian_beam(number_of_rays, sigma_x, seed):
+    random = numpy.random.default_rng(seed)
+
+    rays = numpy.zeros((number_of_rays, 18))
+    rays[:, 0]  = random.normal(0.0, sigma_x, number_of_rays)
+    rays[:, 2]  = random.normal(0.0, 2*sigma_x, number_of_rays)
+    rays[:, 4]  = 1.0
+    rays[:, 6]  = 1.0
+    rays[:, 9]  = 1.0
+    rays[:, 10] = 1e5
+    rays[:, 11] = numpy.arange(1, number_of_rays + 1)
+
+    return S4Beam(array=rays)
+
+class XAcceptance:
+    def __init__(self, x_max):
+        self.x_max = x_max
+
+    def is_accepted(self, rays):
+        return rays[:, 0] < self.x_max
+
+class ConvergenceMonitorTest(unittest.TestCase):
+    def test_estimates(self):
+        monitor = ConvergenceMonitor(columns=[1, 3])
+        beams   = [get_gaussian_beam(2000, 1e-5, seed) for seed in range(5)]
+
+        for beam in beams: monitor.add_beam(beam)
+
+        self.assertEqual(monitor.number_of_iterations, 5)
+
+        sigmas    = numpy.array([numpy.std(beam.rays[:, 0]) for beam in beams])
+        centroids = numpy.array([numpy.mean(beam.rays[:, 0]) for beam in beams])
+        estimates = monitor.get_estimates()
+
+        numpy.testing.assert_allclose(estimates["sigma col 1"], (sigmas.mean(), sigmas.std(ddof=1) / numpy.sqrt(5)), rtol=1e-9)
+        numpy.testing.assert_allclose(estimates["centroid col 1"][0], centroids.mean(), rtol=1e-9, atol=1e-15)
+        self.assertEqual(estimates["intensity"], (2000.0, 0.0))
+
+        # the centroid relative to the sigma of the same column
+        relative_uncertainties = monitor.get_relative_uncertainties()
+        self.assertAlmostEqual(relative_uncertainties["centroid col 1"], estimates["centroid col 1"][1] / estimates["sigma col 1"][0])
+
+    def test_convergence(self):
+        monitor = ConvergenceMonitor(columns=[1])
+        monitor.add_beam(get_gaussian_beam(5000, 1e-5, 0))
+
+        self.assertEqual(monitor.get_worst_relative_uncertainty(), numpy.inf) # no standard error from a single sample
+        self.assertFalse(monitor.is_converged(1.0))
+
+        for seed in range(1, 20): monitor.add_beam(get_gaussian_beam(5000, 1e-5, seed))
+
+        self.assertTrue(monitor.is_converged(0.05, minimum_iterations=3))
+        self.assertFalse(monitor.is_converged(0.05, minimum_iterations=50))
+        self.assertFalse(monitor.is_converged(1e-6))
+
+        iterations, curves = monitor.get_convergence_curves()
+        numpy.testing.assert_array_equal(iterations, numpy.arange(1, 21))
+        self.assertLess(curves["sigma col 1"][-1], curves["sigma col 1"][2])
+
+    def test_state(self):
+        monitor = ConvergenceMonitor(columns=[1, 3])
+        for seed in range(4): monitor.add_beam(get_gaussian_beam(1000, 1e-5, seed))
+
+        restored = ConvergenceMonitor(columns=[1, 3])
+        restored.set_state(monitor.get_state())
+
+        self.assertEqual(restored.number_of_iterations, 4)
+        self.assertEqual(restored.get_estimates(), monitor.get_estimates())
+
+class LoopCheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.file_name = os.path.join(self.directory, "checkpoint.h5")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_round_trip(self):
+        beam      = get_gaussian_beam(1000, 1e-5, 0)
+        footprint = get_gaussian_beam(1000, 1e-3, 1)
+
+        shadow_data = ShadowData(beam=beam, footprint=footprint, beamline=S4Beamline(light_source=UniformLightSource(seed=77)))
+        shadow_data.initial_flux  = 1e12
+        shadow_data.scanning_data = ShadowData.ScanningData("distance", 12.5, "Distance", "m")
+
+        LoopCheckpoint.write(self.file_name, loop_name="Loop", parameters={"current_iteration" : 7, "columns" : "1, 3"},
+                             arrays={"seeds" : numpy.array([1, 2, 3]), "convergence/sigma col 1" : numpy.array([0.5, 0.25])},
+                             shadow_data=shadow_data)
+
+        self.assertEqual(os.listdir(self.directory), ["checkpoint.h5"]) # the temporary file replaced the checkpoint
+
+        parameters, arrays, read_data = LoopCheckpoint.read(self.file_name, loop_name="Loop")
+
+        self.assertEqual(parameters["current_iteration"], 7)
+        self.assertEqual(parameters["columns"], "1, 3")
+        numpy.testing.assert_array_equal(arrays["seeds"], [1, 2, 3])
+        numpy.testing.assert_array_equal(arrays["convergence/sigma col 1"], [0.5, 0.25])
+
+        numpy.testing.assert_array_equal(read_data.beam.rays, beam.rays)
+        numpy.testing.assert_array_equal(read_data.footprint.rays, footprint.rays)
+        self.assertEqual(read_data.initial_flux, 1e12)
+        self.assertEqual(read_data.scanning_data.scanned_variable_value, 12.5)
+        self.assertEqual(read_data.beamline.get_light_source().get_seed(), 77)
+
+    def test_wrong_loop(self):
+        LoopCheckpoint.write(self.file_name, loop_name="Loop")
+
+        self.assertRaises(ValueError, LoopCheckpoint.read, self.file_name, "Other Loop")
+        self.assertRaises(ValueError, LoopCheckpoint.read, os.path.join(self.directory, "missing.h5"), "Loop")
+
+    def test_ids(self):
+        self.assertEqual(LoopCheckpoint.get_id(("distance", 12.5)), LoopCheckpoint.get_id(("distance", 12.5)))
+        self.assertNotEqual(LoopCheckpoint.get_id(("distance", 12.5)), LoopCheckpoint.get_id(("distance", 12.6)))
+
+        shadow_data = ShadowData(beam=S4Beam(N=10))
+        self.assertIsNone(LoopCheckpoint.get_stream_id(shadow_data))
+
+        shadow_data.random_stream = ShadowData.RandomStream(0, None, 0, 10)
+        self.assertIsNone(LoopCheckpoint.get_stream_id(shadow_data)) # seed 0: not reproducible
+
+        shadow_data.random_stream = ShadowData.RandomStream(1234, (3,), 5678, 10)
+        self.assertEqual(LoopCheckpoint.get_stream_id(shadow_data), LoopCheckpoint.get_id((1234, (3,), 5678, 0)))
+
+    def test_is_due(self):
+        self.assertFalse(LoopCheckpoint.is_due(9, 0, 10))
+        self.assertTrue(LoopCheckpoint.is_due(10, 0, 10))
+        self.assertTrue(LoopCheckpoint.is_due(13, 2, 10)) # an input can bring more than one iteration
+        self.assertTrue(LoopCheckpoint.is_due(1, 0, 0))
+
+class LoopDispatcherTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.application = QApplication.instance() or QApplication([]) # the widget tests need a QApplication
+
+    def run_events(self, dispatcher):
+        for _ in range(100):
+            if not dispatcher.is_running: break
+            QCoreApplication.processEvents()
+
+    def test_no_nested_dispatch(self):
+        sent, depth, completed = [], [0], []
+
+        def send_iteration(iteration):
+            depth[0] += 1
+            sent.append((iteration, depth[0]))
+            dispatcher.acknowledge() # the downstream widgets answer within the signal dispatch
+            depth[0] -= 1
+
+        dispatcher = LoopDispatcher(send_iteration, on_completed=lambda: completed.append(True))
+        dispatcher.start(1, 5)
+
+        self.assertEqual(sent, []) # sent from the event loop only
+        self.run_events(dispatcher)
+
+        self.assertEqual(sent, [(iteration, 1) for iteration in range(1, 6)])
+        self.assertEqual(completed, [True])
+
+    def test_one_iteration_at_a_time(self):
+        sent = []
+        dispatcher = LoopDispatcher(sent.append)
+        dispatcher.start(1, 3)
+
+        for _ in range(5): QCoreApplication.processEvents()
+        self.assertEqual(sent, [1])
+        self.assertTrue(dispatcher.is_waiting)
+
+        dispatcher.acknowledge()
+        for _ in range(5): QCoreApplication.processEvents()
+        self.assertEqual(sent, [1, 2])
+
+        dispatcher.interrupt()
+        self.assertFalse(dispatcher.is_running)
+        self.assertEqual(dispatcher.number_of_queued_iterations, 0)
+
+    def test_empty_loop(self):
+        completed = []
+        LoopDispatcher(lambda iteration: None, on_completed=lambda: completed.append(True)).start(1, 0)
+
+        self.assertEqual(completed, [True])
+
+class ChunkedSourceTest(unittest.TestCase):
+    def test_chunks(self):
+        light_source = UniformLightSource()
+        source       = ChunkedSource(light_source, number_of_rays=2500, chunk_size=1000)
+
+        self.assertEqual(source.number_of_chunks, 3)
+
+        sizes = []
+        while not source.is_completed(): sizes.append(len(source.get_next_beam().rays))
+
+        self.assertEqual(sizes, [1000, 1000, 500])
+        self.assertEqual(source.generated_rays, 2500)
+        self.assertRaises(ValueError, source.get_next_beam)
+
+        # the light source is left as it was
+        self.assertEqual(light_source.get_seed(), 5676561)
+        self.assertEqual(light_source.get_nrays(), 2500)
+
+    def test_single_stream(self):
+        chunks = ChunkedSource(UniformLightSource(), number_of_rays=3000, chunk_size=1000)
+
+        first_chunk = chunks.get_next_beam().rays
+        numpy.random.random(10) # does not change the stream
+        second_chunk = chunks.get_next_beam().rays
+
+        numpy.random.seed(5676561)
+        reference = numpy.random.random(3000)
+
+        numpy.testing.assert_array_equal(first_chunk[:, 0], reference[:1000])
+        numpy.testing.assert_array_equal(second_chunk[:, 0], reference[1000:2000])
+        numpy.testing.assert_array_equal(second_chunk[:, 11], numpy.arange(1001, 2001))
+
+    def test_regenerate_chunk(self):
+        light_source = UniformLightSource(seed=1234)
+        source       = ChunkedSource(light_source, number_of_rays=3000, chunk_size=1000, seed_manager=SeedManager(1234), parent_key=(7,))
+
+        source.get_next_beam()
+        second_chunk  = source.get_next_beam().rays
+        random_stream = source.get_random_stream()
+
+        self.assertEqual(random_stream.spawn_key, (7, 1))
+        numpy.testing.assert_array_equal(regenerate_beam(light_source, random_stream).rays, second_chunk)
+
+    def test_wrong_chunk_size(self):
+        self.assertRaises(ValueError, ChunkedSource, UniformLightSource(), 1000, 0)
+
+class RejectionSourceTest(unittest.TestCase):
+    def test_accepted_rays(self):
+        light_source = UniformLightSource(number_of_rays=100)
+        source       = RejectionSource(light_source, XAcceptance(0.25), number_of_rays=5000)
+        beam         = source.get_beam()
+
+        self.assertEqual(len(beam.rays), 5000)
+        self.assertTrue(numpy.all(beam.rays[:, 0] < 0.25))
+        numpy.testing.assert_array_equal(beam.rays[:, 11], numpy.arange(1, 5001))
+        self.assertAlmostEqual(source.efficiency, 0.25, delta=0.02)
+
+        # the intensity is the one of the accepted part of the generated rays
+        self.assertAlmostEqual(numpy.sum(beam.rays[:, 6]**2), 5000 * source.efficiency)
+
+        self.assertEqual(light_source.get_nrays(), 100)
+        self.assertEqual(light_source.get_seed(), 5676561)
+
+    def test_rejection_limit(self):
+        source = RejectionSource(UniformLightSource(), XAcceptance(0.01), number_of_rays=10000, max_number_of_rejected_rays=2000)
+        source.get_beam()
+
+        self.assertTrue(source.is_rejection_limit_reached())
+        self.assertLess(source.accepted_rays, 10000)
+
+    def test_nothing_accepted(self):
+        source = RejectionSource(UniformLightSource(), XAcceptance(-1.0), number_of_rays=10)
+
+        self.assertRaises(ValueError, source.get_beam)
+        self.assertEqual(source.generated_rays, RejectionSource.MAXIMUM_GENERATION_FACTOR * 10)
+
+class RejectionLightSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.light_source = RejectionLightSource(UniformLightSource(seed=1234, number_of_rays=2000), XAcceptance(0.5))
+
+    def test_beam(self):
+        beam = self.light_source.get_beam()
+
+        self.assertEqual(len(beam.rays), 2000) # the accepted rays
+        self.assertTrue(numpy.all(beam.rays[:, 0] < 0.5))
+        numpy.testing.assert_array_equal(beam.rays, RejectionSource(UniformLightSource(seed=1234, number_of_rays=2000), XAcceptance(0.5), 2000).get_beam().rays)
+
+        # seed and number of rays of the light source
+        self.light_source.set_seed(99)
+        self.light_source.set_nrays(300)
+        self.assertEqual((self.light_source.get_seed(), self.light_source.get_nrays()), (99, 300))
+        self.assertEqual(self.light_source.get_light_source().get_seed(), 99)
+
+    def test_regenerated_beamline(self):
+        # the parallel seeds re-trace the beamline of the optimized beam: within the acceptance too
+        for light_source in [copy.deepcopy(self.light_source), pickle.loads(pickle.dumps(self.light_source))]:
+            self.assertIsInstance(light_source.get_acceptance(), XAcceptance)
+
+            _, beam, _ = trace_beamline_with_seed(S4Beamline(light_source=light_source), seed=777, number_of_rays=500)
+
+            self.assertEqual(len(beam.rays), 500)
+            self.assertTrue(numpy.all(beam.rays[:, 0] < 0.5))
+
+        self.assertEqual(self.light_source.get_seed(), 1234) # not modified
+
+class ChunkedSourceWidget(ChunkedSourceDecorator, TriggerToolsDecorator):
+    seed                = 5676561
+    number_of_rays      = 2500
+    chunked_generation  = 1
+    chunk_size          = 1000
+    independent_streams = 0
+    run_index           = 0
+
+    def __init__(self):
+        self.sent_rays  = []
+        self.triggers   = []
+        self.exceptions = []
+        self.Outputs    = type("Outputs", (), {"trigger" : type("Output", (), {"send" : lambda _, trigger: self.triggers.append(trigger)})()})()
+
+    def run_shadow4(self, scanning_data=None):
+        self.sent_rays.append(len(self.get_beam_from_light_source(UniformLightSource(seed=self.seed, number_of_rays=self.number_of_rays), scanning_data).rays))
+
+    def set_scanned_variable(self, variable_name, variable_value): return variable_name, variable_value
+    def prompt_exception(self, exception): self.exceptions.append(exception)
+    def setStatusMessage(self, message): pass
+
+class ChunkedSourceDecoratorTest(unittest.TestCase):
+    def test_loop_point(self):
+        widget = ChunkedSourceWidget()
+
+        for _ in range(4): widget.set_trigger_parameters_for_sources(TriggerOut(new_object=True))
+
+        self.assertEqual(widget.sent_rays, [1000, 1000, 500])
+        self.assertEqual(len(widget.triggers), 1)
+        self.assertTrue(widget.triggers[0].interrupt) # the end of the stream
+        self.assertIsNone(widget.chunked_source)
+
+        widget.set_trigger_parameters_for_sources(TriggerOut(new_object=True)) # a new stream
+        self.assertEqual(widget.sent_rays, [1000, 1000, 500, 1000])
+        self.assertEqual(widget.exceptions, [])
+
+    def test_seed_loop(self):
+        widget = ChunkedSourceWidget()
+        widget.set_trigger_parameters_for_sources(TriggerOut(new_object=True, additional_parameters={"seed_increment" : 1, "seed_loop_iteration" : 1}))
+        widget.set_trigger_parameters_for_sources(TriggerOut(new_object=True, additional_parameters={"variable_name" : "seed", "variable_display_name" : "Seed",
+                                                                                                     "variable_value" : 1, "variable_um" : ""}))
+
+        self.assertEqual(widget.sent_rays, [])
+        self.assertEqual(len(widget.exceptions), 2)
+
+        widget.chunked_generation = 0
+        widget.set_trigger_parameters_for_sources(TriggerOut(new_object=True, additional_parameters={"seed_increment" : 1}))
+
+        self.assertEqual(widget.sent_rays, [2500])
+        self.assertEqual(widget.seed, 5676562)
+
+if __name__ == "__main__":
+    unittest.main()
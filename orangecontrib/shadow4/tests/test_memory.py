@@ -0,0 +1,116 @@
+import gc
+import os
+import time
+import unittest
+import numpy
+
+from AnyQt.QtWidgets import QApplication
+
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData, LazyFootprint
+from orangecontrib.shadow4.util.shadow4_memory import MemoryManager
+from orangecontrib.shadow4.tests.test_caustic import get_focused_beam
+from orangecontrib.shadow4.tests.test_footprint import CountingElement
+
+class FakeWidget:
+    def __init__(self, title, input_data=None, plotted_beam=None, footprint_beam=None):
+        self.title          = title
+        self.input_data     = input_data
+        self.plotted_beam   = plotted_beam
+        self.footprint_beam = footprint_beam
+
+    def windowTitle(self): return self.title
+
+class MemoryManagerTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.application = QApplication.instance() or QApplication([]) # the timer of the registry
+
+    def setUp(self):
+        self.widgets = []
+        MemoryManager._MemoryManager__budget = 0.0 # not from the settings of the user
+
+    def tearDown(self):
+        MemoryManager._MemoryManager__budget = None
+        self.widgets = None
+        gc.collect()
+
+    def register(self, widget):
+        MemoryManager.register(widget)
+        self.widgets.append(widget)
+        time.sleep(0.01) # registered at different times
+
+        return widget
+
+    def set_budget(self, budget):
+        MemoryManager._MemoryManager__budget = budget / 1e9
+
+    def test_spill_beam(self):
+        beam = get_focused_beam(number_of_rays=1000)
+        rays = beam.rays.copy()
+
+        MemoryManager.spill_beam(beam)
+
+        self.assertIsInstance(beam.rays, numpy.memmap)
+        file_name = beam.rays.filename
+        self.assertTrue(os.path.exists(file_name))
+
+        # reloaded on use, with the same rays
+        numpy.testing.assert_array_equal(beam.rays, rays)
+        self.assertEqual(beam.histo1(1, nbins=20, nolost=1)["histogram"].tolist(), get_focused_beam(number_of_rays=1000).histo1(1, nbins=20, nolost=1)["histogram"].tolist())
+
+        # copy on write: the file is not changed
+        beam.rays[:, 0] = 0.0
+        numpy.testing.assert_array_equal(numpy.load(file_name)[:, 0], rays[:, 0])
+
+        beam = None
+        gc.collect()
+        self.assertFalse(os.path.exists(file_name))
+
+    def test_budget(self):
+        shared_beam = get_focused_beam(number_of_rays=2000)
+        idle        = self.register(FakeWidget("Idle", input_data=ShadowData(beam=shared_beam), plotted_beam=get_focused_beam(number_of_rays=2000, seed=1)))
+        MemoryManager.check()
+        time.sleep(0.01)
+        active      = self.register(FakeWidget("Active", input_data=ShadowData(beam=shared_beam), plotted_beam=get_focused_beam(number_of_rays=2000, seed=2)))
+        MemoryManager.check()
+
+        beam_bytes = shared_beam.rays.nbytes
+        self.assertEqual(MemoryManager.get_resident_bytes(), 3 * beam_bytes) # the shared beam is counted once, nothing spilled without budget
+
+        # the beams of the widget idle for the longest time are spilled first
+        self.set_budget(2 * beam_bytes)
+        MemoryManager.check()
+
+        self.assertLessEqual(MemoryManager.get_resident_bytes(), 2 * beam_bytes)
+        self.assertIsInstance(idle.plotted_beam.rays, numpy.memmap)
+        self.assertIsInstance(active.plotted_beam.rays, numpy.ndarray)
+        self.assertNotIsInstance(active.plotted_beam.rays, numpy.memmap)
+
+        usage = {title : (resident, spilled) for title, resident, spilled in MemoryManager.get_usage()}
+        self.assertEqual(usage["Idle"], (0, 2 * beam_bytes))
+        self.assertEqual(usage["Active"], (beam_bytes, beam_bytes)) # the shared beam is spilled in place
+
+        numpy.testing.assert_array_equal(idle.plotted_beam.rays, get_focused_beam(number_of_rays=2000, seed=1).rays)
+
+    def test_footprint_released_first(self):
+        CountingElement.number_of_traces = 0
+        element      = CountingElement(get_focused_beam(number_of_rays=2000))
+        _, footprint = element.trace_beam()
+
+        widget = self.register(FakeWidget("Mirror", plotted_beam=get_focused_beam(number_of_rays=2000), footprint_beam=LazyFootprint(element, footprint)))
+        MemoryManager.check()
+
+        self.set_budget(footprint.rays.nbytes)
+        MemoryManager.check()
+
+        self.assertFalse(widget.footprint_beam.is_materialized()) # released, not spilled
+        self.assertNotIsInstance(widget.plotted_beam.rays, numpy.memmap)
+
+        numpy.testing.assert_array_equal(widget.footprint_beam.materialize().rays, footprint.rays) # re-traced
+        self.assertEqual(CountingElement.number_of_traces, 2)
+
+    def test_wrong_budget(self):
+        self.assertRaises(ValueError, MemoryManager.set_budget, -1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,144 @@
+import unittest
+from unittest import mock
+import numpy
+
+from AnyQt.QtWidgets import QApplication
+
+from shadow4.beam.s4_beam import S4Beam
+
+from orangecontrib.shadow4.widgets.tools.ow_merge_beams import merge_beams, MergeBeams
+
+def get_random_beam(number_of_rays, seed, lost_fraction=0.2):
+    random = numpy.random.default_rng(seed)
+
+    rays = random.normal(0.0, 1.0, (number_of_rays, 18))
+    rays[:, 9]  = numpy.where(random.random(number_of_rays) < lost_fraction, -1.0, 1.0)
+    rays[:, 11] = numpy.arange(1, number_of_rays + 1)
+
+    return S4Beam(array=rays)
+
+def get_appended_beams(beams, weights):
+    '''
+    The merge as S4LightSourceFromBeamlines, with the weight applied to each beam.
+    '''
+    merged_beam = None
+    for beam, weight in zip(beams, weights):
+        beam = beam.duplicate()
+        if weight != 1.0: beam.apply_attenuation(numpy.sqrt(weight)) # weight is intensity, attenuator is amplitude!
+
+        if merged_beam is None: merged_beam = beam
+        else:                   merged_beam.append_beam(beam, update_column_index=True)
+
+    return merged_beam
+
+class MergeBeamsTest(unittest.TestCase):
+    def setUp(self):
+        self.beams = [get_random_beam(number_of_rays, seed) for seed, number_of_rays in enumerate([1000, 10, 2500])]
+
+    def test_merge(self):
+        for weights in [None, [1.0, 1.0, 1.0], [0.5, 1.0, 4.0], [0.0, 2.0, 1.0]]:
+            merged_beam = merge_beams(self.beams, weights)
+            reference   = get_appended_beams(self.beams, [1.0] * 3 if weights is None else weights)
+
+            numpy.testing.assert_allclose(merged_beam.rays, reference.rays, rtol=1e-15, atol=0)
+            self.assertEqual(merged_beam.N, 3510)
+            self.assertEqual(merged_beam.intensity(nolost=1), reference.intensity(nolost=1))
+
+        # the input beams are not modified
+        for seed, (beam, number_of_rays) in enumerate(zip(self.beams, [1000, 10, 2500])):
+            numpy.testing.assert_array_equal(beam.rays, get_random_beam(number_of_rays, seed).rays)
+
+    def test_cleaned_beams(self):
+        cleaned = self.beams[0].duplicate()
+        cleaned.clean_lost_rays()
+        beams = [cleaned, self.beams[2]]
+
+        merged_beam = merge_beams(beams, [2.0, 1.0])
+        reference   = get_appended_beams(beams, [2.0, 1.0])
+
+        numpy.testing.assert_allclose(merged_beam.rays, reference.rays, rtol=1e-15, atol=0)
+        self.assertTrue(merged_beam.is_cleaned())
+        self.assertEqual(merged_beam.N, reference.N) # the lost rays of the cleaned beam are counted
+        self.assertEqual(merged_beam.rays[cleaned.rays.shape[0], 11], 1001) # indices after all the rays of the first beam
+
+        self.assertFalse(merge_beams(self.beams).is_cleaned())
+        self.assertRaises(ValueError, merge_beams, [])
+
+class MigrateSettingsTest(unittest.TestCase):
+    def migrate(self, **weights):
+        settings = {"use_weights" : 1}
+        for index in range(1, 11): settings["weight_input_data_" + str(index)] = weights.get("w" + str(index), 1.0)
+
+        MergeBeams.migrate_settings(settings, 1)
+
+        self.assertFalse(any([key.startswith("weight_input_data_") for key in settings]))
+
+        return settings
+
+    def test_default_weights(self):
+        settings = self.migrate()
+
+        self.assertEqual(settings["weights"], "1.0") # a single input is enough
+        self.assertFalse(settings["weights_from_channels"])
+
+    def test_weights(self):
+        settings = self.migrate(w1=0.5, w3=2.0)
+
+        self.assertEqual(settings["weights"], "0.5, 1.0, 2.0")
+        self.assertTrue(settings["weights_from_channels"]) # to be fitted to the links present
+
+        settings = self.migrate(**{"w" + str(index) : 3.0 for index in range(1, 11)})
+
+        self.assertEqual(settings["weights"], ", ".join(["3.0"] * 10))
+        self.assertTrue(settings["weights_from_channels"])
+
+    def test_current_version(self):
+        settings = {"use_weights" : 1, "weights" : "2.0"}
+        MergeBeams.migrate_settings(settings, 2)
+
+        self.assertEqual(settings, {"use_weights" : 1, "weights" : "2.0"})
+
+class WeightsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.application = QApplication.instance() or QApplication([])
+
+    def get_widget(self, weights, number_of_inputs, weights_from_channels=False):
+        widget = MergeBeams()
+        widget.use_weights           = 1
+        widget.weights               = weights
+        widget.weights_from_channels = weights_from_channels
+        widget.input_data            = [None] * number_of_inputs
+
+        return widget
+
+    def test_weights(self):
+        self.assertEqual(self.get_widget("0.5, 2", 3).get_weights(), [0.5, 2.0, 1.0])
+        self.assertEqual(self.get_widget("0.5", 1).get_weights(), [0.5])
+
+        self.assertRaises(ValueError, self.get_widget("0.5, 2, 3", 2).get_weights)
+        with self.assertRaisesRegex(ValueError, "Weight #2 must be >= 0"): self.get_widget("0.5, -2", 2).get_weights()
+
+    def test_weights_from_channels(self):
+        # the same weight on all the old inputs: whatever the links present
+        widget = self.get_widget(", ".join(["3.0"] * 10), 2, weights_from_channels=True)
+
+        with mock.patch("orangecontrib.shadow4.widgets.tools.ow_merge_beams.QMessageBox.warning") as warning:
+            self.assertEqual(widget.get_weights(), [3.0, 3.0])
+            warning.assert_not_called()
+
+        self.assertEqual(widget.weights, "3.0, 3.0")
+        self.assertFalse(widget.weights_from_channels)
+
+        # different weights: assigned in the order of the links, once, with a warning
+        widget = self.get_widget("0.5, 1.0, 2.0", 1, weights_from_channels=True)
+
+        with mock.patch("orangecontrib.shadow4.widgets.tools.ow_merge_beams.QMessageBox.warning") as warning:
+            self.assertEqual(widget.get_weights(), [0.5])
+            self.assertEqual(widget.get_weights(), [0.5])
+            self.assertEqual(warning.call_count, 1)
+
+        self.assertEqual(widget.weights, "0.5")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,125 @@
+import unittest
+import numpy
+
+from shadow4.beam.s4_beam import S4Beam
+from shadow4.beamline.s4_beamline import S4Beamline
+
+from orangecontrib.shadow4.util.shadow4_parallel import SeedManager, spawn_seeds, ParallelSeedTracer, ParallelScanTracer
+from orangecontrib.shadow4.tests.fake_sources import UniformLightSource
+
+class ShiftElement:
+    '''
+    Beamline element shifting the rays along x (picklable, for the worker processes).
+    '''
+    def __init__(self, shift):
+        self.shift      = shift
+        self.input_beam = None
+
+    def set_input_beam(self, beam):
+        self.input_beam = beam
+
+    def trace_beam(self):
+        beam = self.input_beam.duplicate() # as the shadow4 elements: the input beam is not modified
+        beam.rays[:, 0] += self.shift
+
+        return beam, None
+
+class SeedManagerTest(unittest.TestCase):
+    def test_streams(self):
+        seed_manager = SeedManager(1234)
+
+        self.assertEqual(seed_manager.base_seed, 1234)
+        self.assertEqual(seed_manager.get_seed(3, 1), SeedManager(1234).get_seed(3, 1)) # regenerated by itself
+        self.assertNotEqual(seed_manager.get_seed(3, 1), SeedManager(1235).get_seed(3, 1))
+
+        self.assertEqual(seed_manager.spawn_seeds(5), spawn_seeds(1234, 5))
+        self.assertEqual(seed_manager.spawn_seeds(5)[3], seed_manager.get_seed(3))
+
+    def test_independent_streams(self):
+        seed_manager = SeedManager(1234)
+
+        # iterations and chunks of different iterations never share a seed
+        seeds = seed_manager.spawn_seeds(20) + [seed for iteration in range(20) for seed in seed_manager.spawn_seeds(10, parent_key=(iteration,))]
+
+        self.assertEqual(len(set(seeds)), 220)
+        self.assertTrue(all(0 < seed < 2**31 - 1 for seed in seeds))
+
+    def test_first_child(self):
+        seed_manager = SeedManager(1234)
+        seeds        = seed_manager.spawn_seeds(10, parent_key=(7,))
+
+        self.assertEqual(seeds[4:], seed_manager.spawn_seeds(6, parent_key=(7,), first_child=4))
+        self.assertEqual(seeds[2], seed_manager.get_seed(7, 2))
+
+class ParallelSeedTracerTest(unittest.TestCase):
+    def test_spawn_seeds(self):
+        seeds = spawn_seeds(1234, 10)
+
+        self.assertEqual(seeds, spawn_seeds(1234, 10))
+        self.assertEqual(seeds[4:], spawn_seeds(1234, 6, first_child=4))
+        self.assertEqual(len(set(seeds)), 10)
+        self.assertNotIn(0, seeds)
+
+    def check_seeds(self, number_of_workers):
+        light_source = UniformLightSource(seed=1, number_of_rays=100)
+        beamline     = S4Beamline(light_source=light_source)
+        seeds        = spawn_seeds(1234, 5)
+
+        results = list(ParallelSeedTracer(number_of_workers=number_of_workers).trace(beamline, seeds, number_of_rays=500))
+
+        self.assertEqual([seed for seed, _, _ in results], seeds) # in the order of the seeds
+        for seed, beam, footprint in results:
+            numpy.testing.assert_array_equal(beam.rays, UniformLightSource(seed=seed, number_of_rays=500).get_beam().rays)
+            self.assertIsNone(footprint)
+
+        # the beamline is not modified
+        self.assertEqual((light_source.get_seed(), light_source.get_nrays()), (1, 100))
+
+    def test_serial(self):
+        self.check_seeds(number_of_workers=1)
+
+    def test_parallel(self):
+        self.check_seeds(number_of_workers=2)
+
+class ParallelScanTracerTest(unittest.TestCase):
+    def setUp(self):
+        self.rays = numpy.random.default_rng(0).random((1000, 18))
+
+    def check_scan(self, number_of_workers):
+        input_beam = S4Beam(array=self.rays.copy())
+        tracer     = ParallelScanTracer(input_beam, [ShiftElement(shift) for shift in range(5)], number_of_workers=number_of_workers, maximum_in_flight=2)
+
+        try:
+            for index in range(5):
+                self.assertEqual(tracer.next_index, index)
+
+                element, beam, footprint = tracer.get_next_result()
+
+                self.assertEqual(element.shift, index)
+                self.assertIsNone(element.input_beam)
+                self.assertIsNone(footprint)
+                numpy.testing.assert_allclose(beam.rays[:, 0], self.rays[:, 0] + index)
+
+            self.assertRaises(StopIteration, tracer.get_next_result)
+        finally:
+            tracer.close()
+
+        return input_beam
+
+    def test_serial(self):
+        self.check_scan(number_of_workers=1)
+
+    def test_parallel(self):
+        input_beam = self.check_scan(number_of_workers=2)
+
+        numpy.testing.assert_array_equal(input_beam.rays, self.rays)
+
+    def test_close_abandoned_scan(self):
+        tracer = ParallelScanTracer(S4Beam(array=self.rays.copy()), [ShiftElement(shift) for shift in range(6)], number_of_workers=2)
+        tracer.get_next_result()
+        tracer.close()
+
+        self.assertEqual(tracer.next_index, 1)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,85 @@
+import pickle
+import unittest
+import numpy
+
+from shadow4.beam.s4_beam import S4Beam
+from shadow4.beamline.s4_beamline import S4Beamline
+
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+from orangecontrib.shadow4.util.shadow4_transport import BeamlineCache, SharedBeam
+from orangecontrib.shadow4.tests.fake_sources import UniformLightSource
+
+class ShadowDataPicklingTest(unittest.TestCase):
+    def setUp(self):
+        random = numpy.random.default_rng(0)
+
+        self.beamline    = S4Beamline(light_source=UniformLightSource(seed=77))
+        self.shadow_data = ShadowData(beam=S4Beam(array=random.random((1000, 18))), footprint=S4Beam(array=random.random((500, 18))), beamline=self.beamline)
+        self.shadow_data.initial_flux  = 1e12
+        self.shadow_data.random_stream = ShadowData.RandomStream(1234, (3,), 5678, 1000)
+
+    def check_shadow_data(self, read_data):
+        numpy.testing.assert_array_equal(read_data.beam.rays, self.shadow_data.beam.rays)
+        numpy.testing.assert_array_equal(read_data.footprint.rays, self.shadow_data.footprint.rays)
+        self.assertEqual(read_data.initial_flux, 1e12)
+        self.assertEqual(read_data.random_stream.spawn_key, (3,))
+        self.assertEqual(read_data.beamline.get_light_source().get_seed(), 77)
+
+    def test_out_of_band(self):
+        buffers = []
+        data    = pickle.dumps(self.shadow_data, protocol=5, buffer_callback=buffers.append)
+
+        self.assertEqual(len(buffers), 2) # beam and footprint
+        self.assertLess(len(data), 1000 * 18 * 8)
+
+        buffers   = [bytearray(buffer.raw()) for buffer in buffers] # as received from another process
+        read_data = pickle.loads(data, buffers=buffers)
+
+        self.check_shadow_data(read_data)
+        self.assertTrue(numpy.shares_memory(read_data.beam.rays, numpy.frombuffer(buffers[0]))) # no copies
+
+        # read-only buffers are copied: the beams are modified in place by the tools
+        read_data = pickle.loads(data, buffers=[bytes(buffer) for buffer in buffers])
+        self.assertTrue(read_data.beam.rays.flags.writeable)
+
+    def test_beamline_versions(self):
+        version_1, data_1 = BeamlineCache.pack(self.beamline)
+        version_2, data_2 = BeamlineCache.pack(self.beamline)
+
+        self.assertEqual(version_1, version_2)
+        self.assertIs(data_1, data_2) # pickled once
+        self.assertNotEqual(BeamlineCache.pack(S4Beamline(light_source=UniformLightSource(seed=77)))[0], version_1)
+
+        # unpickled once
+        self.assertIs(pickle.loads(pickle.dumps(self.shadow_data, protocol=5)).beamline,
+                      pickle.loads(pickle.dumps(self.shadow_data, protocol=5)).beamline)
+
+    def test_older_protocols(self):
+        for protocol in range(2, 5): self.check_shadow_data(pickle.loads(pickle.dumps(self.shadow_data, protocol=protocol)))
+
+class SharedBeamTest(unittest.TestCase):
+    def test_read_beam(self):
+        beam        = S4Beam(array=numpy.random.default_rng(0).random((1000, 18)))
+        shared_beam = SharedBeam(beam)
+
+        try:
+            def trace(input_beam):
+                self.assertFalse(input_beam.rays.flags.writeable)
+                self.assertRaises(ValueError, input_beam.rays.__setitem__, (0, 0), 1.0)
+
+                output_beam = input_beam.duplicate()
+                output_beam.rays[:, 0] += 1.0
+
+                return output_beam
+
+            output_beam = SharedBeam.read_beam(shared_beam.handle, trace)
+
+            numpy.testing.assert_array_equal(output_beam.rays[:, 0], beam.rays[:, 0] + 1.0)
+            numpy.testing.assert_array_equal(SharedBeam.read_beam(shared_beam.handle, lambda input_beam: input_beam.rays.sum()), beam.rays.sum())
+        finally:
+            shared_beam.release()
+
+        self.assertRaises(FileNotFoundError, SharedBeam.read_beam, shared_beam.handle, lambda input_beam: None)
+
+if __name__ == "__main__":
+    unittest.main()
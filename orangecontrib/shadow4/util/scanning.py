@@ -95,6 +95,34 @@ class AbstractScanHistoWidget(QWidget):
                    colormap=cm.rainbow):
         raise NotImplementedError("this methid is abstract")
 
+    def plot_histogram_data(self,
+                            histo_data,
+                            col,
+                            ref=23,
+                            title="",
+                            xtitle="",
+                            ytitle="",
+                            histo_index=0,
+                            scan_variable_name="Variable",
+                            offset=0.0,
+                            show_reference=True,
+                            add_labels=True,
+                            has_colormap=True,
+                            colormap=cm.rainbow):
+        '''
+        Draws a histogram already computed (bins and histogram of HistogramData), e.g. restored from a checkpoint.
+        '''
+        raise NotImplementedError("this methid is abstract")
+
+    @staticmethod
+    def get_histogram_path(bins, histogram):
+        '''
+        Points of the histogram area, as histogram_path and bin_path of S4Beam.histo1, from the bin centers.
+        '''
+        half_width = 0.5*(bins[1] - bins[0]) if len(bins) > 1 else 0.0
+
+        return numpy.repeat(histogram, 2), numpy.ravel(numpy.column_stack((bins - half_width, bins + half_width)))
+
 
 class Scan3DHistoWidget(AbstractScanHistoWidget):
     class PlotType:
@@ -223,6 +251,31 @@ class Scan3DHistoWidget(AbstractScanHistoWidget):
                              peak_intensity=peak_intensity,
                              integral_intensity=integral_intensity)
 
+    def plot_histogram_data(self,
+                            histo_data,
+                            col,
+                            ref=23,
+                            title="",
+                            xtitle="",
+                            ytitle="",
+                            histo_index=0,
+                            scan_variable_name="Variable",
+                            offset=0.0,
+                            show_reference=True,
+                            add_labels=True,
+                            has_colormap=True,
+                            colormap=cm.rainbow):
+        histogram, bins = self.get_histogram_path(histo_data.bins, histo_data.histogram)
+
+        if not ytitle is None:  ytitle = ytitle + ' weighted by ' + ShadowPlot.get_shadow_label(ref)
+
+        rcParams['axes.formatter.useoffset']='False'
+
+        self.set_xrange(bins*ShadowPlot.get_factor(col))
+        self.set_labels(title=title, xlabel=xtitle, ylabel=scan_variable_name, zlabel=ytitle)
+
+        self.add_histo(histo_data.scan_value, histogram, has_colormap, colormap, histo_index)
+
     def add_histo(self, scan_value, intensities, has_colormap, colormap, histo_index):
         if self.xx is None: raise ValueError("Initialize X range first")
         if self.xx.shape != intensities.shape: raise ValueError("Given Histogram has a different binning")
@@ -405,14 +458,54 @@ class ScanHistoWidget(AbstractScanHistoWidget):
         else:
             h_title = scan_variable_name + ": " + str(scan_variable_value)
 
+        if histo_index== 0:
+            offset = int(peak_intensity*0.3)
+
+        self.__draw_histogram(bins, histogram, xrange, factor, offset, histo_index, h_title, title, xtitle, ytitle, add_labels)
+
+        return HistogramData(histogram=histogram_stats,
+                             bins=bins_stats,
+                             offset=offset,
+                             xrange=xrange,
+                             fwhm=fwhm,
+                             sigma=sigma,
+                             centroid=centroid,
+                             peak_intensity=peak_intensity,
+                             integral_intensity=integral_intensity)
+
+    def plot_histogram_data(self,
+                            histo_data,
+                            col,
+                            ref=23,
+                            title="",
+                            xtitle="",
+                            ytitle="",
+                            histo_index=0,
+                            scan_variable_name="Variable",
+                            offset=0.0,
+                            show_reference=True,
+                            add_labels=True,
+                            has_colormap=True,
+                            colormap=cm.rainbow):
+        factor = ShadowPlot.get_factor(col)
+
+        if not ytitle is None:  ytitle = ytitle + ' weighted by ' + ShadowPlot.get_shadow_label(ref)
+
+        histogram, bins = self.get_histogram_path(histo_data.bins, histo_data.histogram)
+
+        if histo_index==0 and show_reference:
+            h_title = "Reference"
+        else:
+            h_title = scan_variable_name + ": " + str(histo_data.scan_value)
+
+        self.__draw_histogram(bins*factor, histogram, [bins[0], bins[-1]], factor, offset, histo_index, h_title, title, xtitle, ytitle, add_labels)
+
+    def __draw_histogram(self, bins, histogram, xrange, factor, offset, histo_index, h_title, title, xtitle, ytitle, add_labels):
         color="#000000"
 
         import matplotlib
         matplotlib.rcParams['axes.formatter.useoffset']='False'
 
-        if histo_index== 0:
-            offset = int(peak_intensity*0.3)
-
         self.plot_canvas.addCurve(bins, histogram + offset*histo_index, h_title, symbol='', color=color, xlabel=xtitle, ylabel=ytitle, replace=False) #'+', '^', ','
 
         if add_labels: self.plot_canvas._backend.ax.text(xrange[0]*factor*1.05, offset*histo_index*1.05, h_title)
@@ -443,16 +536,6 @@ class ScanHistoWidget(AbstractScanHistoWidget):
 
         self.plot_canvas.addDockWidget(Qt.RightDockWidgetArea, self.plot_canvas.getLegendsDockWidget())
 
-        return HistogramData(histogram=histogram_stats,
-                             bins=bins_stats,
-                             offset=offset,
-                             xrange=xrange,
-                             fwhm=fwhm,
-                             sigma=sigma,
-                             centroid=centroid,
-                             peak_intensity=peak_intensity,
-                             integral_intensity=integral_intensity)
-
     def add_empty_curve(self, histo_data):
         self.plot_canvas.addCurve(numpy.array([histo_data.centroid]),
                                   numpy.zeros(1),
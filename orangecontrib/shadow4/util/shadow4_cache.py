@@ -0,0 +1,367 @@
+import os
+import io
+import copy
+import pickle
+import hashlib
+import urllib.request
+import urllib.parse
+import threading
+import numpy
+
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
+
+from AnyQt.QtCore import QStandardPaths
+
+import shadow4.sources.bending_magnet.s4_bending_magnet_light_source as s4_bending_magnet_light_source
+import shadow4.sources.source_geometrical.source_geometrical as source_geometrical
+
+#########################################################################################
+# Caches of the expensive precomputations of the light sources (radiation maps, trajectories, sampling tables).
+#
+# An entry is identified by the hash of all the parameters the precomputation depends on: the seed and the number of
+# rays are never among them, so a seed loop pays only for the ray sampling.
+#########################################################################################
+
+def get_cache_key(*parameters):
+    '''
+    Hash of the parameters (numbers, strings, arrays, and lists or dictionaries of them).
+    '''
+    sha1 = hashlib.sha1()
+
+    def update(value):
+        if isinstance(value, numpy.ndarray):
+            sha1.update(str((value.dtype, value.shape)).encode())
+            sha1.update(numpy.ascontiguousarray(value).tobytes())
+        elif isinstance(value, (list, tuple)):
+            sha1.update(b"[")
+            for item in value: update(item)
+            sha1.update(b"]")
+        elif isinstance(value, dict):
+            sha1.update(b"{")
+            for key in sorted(value.keys()):
+                update(key)
+                update(value[key])
+            sha1.update(b"}")
+        else:
+            sha1.update(repr(value).encode())
+        sha1.update(b";")
+
+    for parameter in parameters: update(parameter)
+
+    return sha1.hexdigest()
+
+def get_local_copy(file_name):
+    '''
+    Local file with the content of file_name: URLs are downloaded once, into the user cache.
+    '''
+    if not file_name.strip().lower().startswith(("http://", "https://", "ftp://")): return file_name
+
+    url             = file_name.strip()
+    directory       = DiskCache("downloads").get_directory()
+    local_file_name = os.path.join(directory, hashlib.sha1(url.encode()).hexdigest() + "_" + os.path.basename(urllib.parse.urlparse(url).path))
+
+    if not os.path.exists(local_file_name):
+        urllib.request.urlretrieve(url, local_file_name + ".tmp")
+        os.replace(local_file_name + ".tmp", local_file_name)
+
+    return local_file_name
+
+def get_file_hash(file_name):
+    with open(file_name, "rb") as file: return hashlib.sha1(file.read()).hexdigest()
+
+class DiskCache:
+    '''
+    Pickled entries in a directory of the user cache, surviving the session (reopening a workflow reuses them).
+    The oldest entries are removed when the total size exceeds maximum_size. The last entry used is also kept in memory.
+
+    Entries are copied in and out: the light sources modify their precomputed arrays in place (e.g. the undulator
+    scales its backpropagated radiation at every get_beam), which must never reach the cached entry.
+    '''
+    FORMAT_VERSION = 1
+
+    def __init__(self, name, maximum_size=2e9):
+        self.__name         = name
+        self.__maximum_size = maximum_size
+        self.__last_key     = None
+        self.__last_entry   = None
+
+    def get_directory(self):
+        directory = os.path.join(QStandardPaths.writableLocation(QStandardPaths.CacheLocation), "shadow4", self.__name)
+        os.makedirs(directory, exist_ok=True)
+
+        return directory
+
+    def __get_file_name(self, key):
+        return os.path.join(self.get_directory(), key + ".pkl")
+
+    def load(self, key):
+        '''
+        :return: the entry, None if not cached
+        '''
+        if key == self.__last_key: return copy.deepcopy(self.__last_entry)
+
+        file_name = self.__get_file_name(key)
+        if not os.path.exists(file_name): return None
+
+        try:
+            with open(file_name, "rb") as file: version, entry = pickle.load(file)
+            if version != self.FORMAT_VERSION: return None
+        except Exception as exception: # e.g. an entry written by another version of the libraries
+            print("Cache entry " + file_name + " not readable: " + str(exception))
+            return None
+
+        os.utime(file_name) # the cleaning removes the least recently used
+
+        self.__last_key   = key
+        self.__last_entry = entry
+
+        return copy.deepcopy(entry)
+
+    def save(self, key, entry):
+        entry               = copy.deepcopy(entry)
+        file_name           = self.__get_file_name(key)
+        temporary_file_name = file_name + ".tmp"
+
+        with open(temporary_file_name, "wb") as file: pickle.dump((self.FORMAT_VERSION, entry), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_file_name, file_name)
+
+        self.__last_key   = key
+        self.__last_entry = entry
+
+        self.__clean()
+
+    def clear(self):
+        for file_name in os.listdir(self.get_directory()):
+            try:    os.remove(os.path.join(self.get_directory(), file_name))
+            except: pass
+
+        self.__last_key   = None
+        self.__last_entry = None
+
+    def __clean(self):
+        directory = self.get_directory()
+        files     = [os.path.join(directory, file_name) for file_name in os.listdir(directory) if file_name.endswith(".pkl")]
+        files     = sorted(files, key=os.path.getmtime, reverse=True)
+
+        total_size = 0
+        for file_name in files:
+            total_size += os.path.getsize(file_name)
+            if total_size > self.__maximum_size and file_name != self.__get_file_name(self.__last_key):
+                try:    os.remove(file_name)
+                except: pass
+
+class PrivateAttributes:
+    '''
+    Private (name-mangled) attributes of a shadow4 class, read and written by the caches to skip a precomputation.
+    They are not part of the shadow4 API and can be renamed by a new version: the users check is_available() and,
+    if not, leave the light source to compute everything by itself (get_warning() tells what is not cached).
+    '''
+    def __init__(self, instance, class_name, names):
+        self.__instance   = instance
+        self.__class_name = class_name
+        self.__names      = names
+
+    def __get_attribute_name(self, name):
+        return "_" + self.__class_name + "__" + name
+
+    def is_instance(self):
+        # by name: the module of the class is not imported (e.g. the undulator needs pySRU)
+        return any([cls.__name__ == self.__class_name for cls in type(self.__instance).__mro__])
+
+    def is_available(self):
+        return all([hasattr(self.__instance, self.__get_attribute_name(name)) for name in self.__names])
+
+    def get_warning(self, what):
+        missing = [name for name in self.__names if not hasattr(self.__instance, self.__get_attribute_name(name))]
+
+        return "***** Warning: " + what + " not used, this version of " + self.__class_name + " has no " + ", ".join(missing)
+
+    def get(self, name):
+        return getattr(self.__instance, self.__get_attribute_name(name))
+
+    def set(self, name, value):
+        setattr(self.__instance, self.__get_attribute_name(name), value)
+
+class LRUCache:
+    '''
+    Entries in memory: the least recently used are removed beyond maximum_size entries.
+    '''
+    def __init__(self, maximum_size=8):
+        self.__maximum_size = maximum_size
+        self.__entries      = OrderedDict()
+        self.hits           = 0
+        self.misses         = 0
+
+    def get(self, key):
+        '''
+        :return: the entry, None if not cached
+        '''
+        entry = self.__entries.get(key, None)
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.__entries.move_to_end(key)
+
+        return entry
+
+    def put(self, key, entry):
+        self.__entries[key] = entry
+        self.__entries.move_to_end(key)
+
+        while len(self.__entries) > self.__maximum_size: self.__entries.popitem(last=False)
+
+    def get_or_compute(self, key, function):
+        entry = self.get(key)
+
+        if entry is None:
+            entry = function()
+            self.put(key, entry)
+
+        return entry
+
+    def clear(self):
+        self.__entries.clear()
+        self.hits   = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+class ModulePatch:
+    '''
+    Replacement of a function of a shadow4 module, shared by the overlapping users (e.g. the tracing threads of two
+    widgets): it is installed by the first user and the original is restored by the last one, only if the replacement
+    is still in place (the module was not patched again meanwhile).
+    '''
+    __lock    = threading.Lock()
+    __patches = {} # (module name, attribute name) -> [original, replacement, number of users]
+
+    @classmethod
+    @contextmanager
+    def use(cls, module, name, get_replacement):
+        '''
+        :param get_replacement: function of the original, returning its replacement
+        '''
+        key = (module.__name__, name)
+
+        with cls.__lock:
+            patch = cls.__patches.get(key, None)
+            if patch is None:
+                original = getattr(module, name)
+                patch    = cls.__patches[key] = [original, get_replacement(original), 0]
+                setattr(module, name, patch[1])
+            patch[2] += 1
+        try:
+            yield
+        finally:
+            with cls.__lock:
+                patch[2] -= 1
+                if patch[2] == 0:
+                    del cls.__patches[key]
+                    if getattr(module, name) is patch[1]: setattr(module, name, patch[0])
+
+class BendingMagnetSamplingTables:
+    '''
+    S4BendingMagnetLightSource.get_beam computes the synchrotron distribution on a (psi, energy) grid and its sampling
+    CDFs before sampling the rays: they depend only on the field, the energy range and the electron beam.
+    Within use(), they are taken from a bounded LRU cache (the monochromatic tables are cheap and not cached).
+    '''
+    cache = LRUCache(maximum_size=8)
+
+    @classmethod
+    @contextmanager
+    def use(cls):
+        def get_cached_sync_f_sigma_and_pi(sync_f_sigma_and_pi):
+            def cached_sync_f_sigma_and_pi(rAngle, rEnergy):
+                if numpy.ndim(rAngle) < 2: return sync_f_sigma_and_pi(rAngle, rEnergy) # the rays, not the grid
+                else: return cls.cache.get_or_compute(get_cache_key("sync_f_sigma_and_pi", rAngle, rEnergy), lambda: sync_f_sigma_and_pi(rAngle, rEnergy))
+            return cached_sync_f_sigma_and_pi
+
+        def get_cached_Sampler2D(Sampler2D):
+            def cached_Sampler2D(pdf, pdf_x0=None, pdf_x1=None):
+                return cls.cache.get_or_compute(get_cache_key("Sampler2D", pdf, pdf_x0, pdf_x1), lambda: Sampler2D(pdf, pdf_x0, pdf_x1))
+            return cached_Sampler2D
+
+        with ExitStack() as stack:
+            stack.enter_context(ModulePatch.use(s4_bending_magnet_light_source, "sync_f_sigma_and_pi", get_cached_sync_f_sigma_and_pi))
+            stack.enter_context(ModulePatch.use(s4_bending_magnet_light_source, "Sampler2D", get_cached_Sampler2D))
+            yield
+
+class InverseCDFSampler1D:
+    '''
+    Vectorized version of srxraylib Sampler1D (a binary search of all the random numbers in the CDF, instead of a
+    linear search for each one): same sampled points for the same random numbers.
+    '''
+    def __init__(self, pdf, pdf_x=None):
+        self.__pdf_x = numpy.arange(numpy.size(pdf)) if pdf_x is None else numpy.asarray(pdf_x)
+        self.__cdf   = numpy.cumsum(pdf, dtype=float)
+        self.__cdf  -= self.__cdf[0]
+        if self.__cdf.max() != 0.0: self.__cdf /= self.__cdf.max()
+        self.__cdf_envelope = numpy.maximum.accumulate(self.__cdf) # sorted, same first index >= edge as the CDF
+
+    def get_sampled(self, random_in_0_1):
+        edges = numpy.atleast_1d(numpy.asarray(random_in_0_1, dtype=float))
+        size  = self.__cdf.size
+
+        indices = numpy.searchsorted(self.__cdf_envelope, edges, side="left")
+        indices[indices == size] = 0
+        indices = numpy.maximum(indices - 1, 0)
+
+        inside       = indices < size - 1
+        next_indices = numpy.minimum(indices + 1, size - 1)
+        deltas       = numpy.zeros_like(edges)
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            deltas[inside] = ((edges - self.__cdf[indices]) / (self.__cdf[next_indices] - self.__cdf[indices]))[inside]
+
+        sampled = self.__pdf_x[indices] + deltas * (self.__pdf_x[1] - self.__pdf_x[0])
+
+        return sampled if numpy.ndim(random_in_0_1) > 0 else sampled[0]
+
+    def get_n_sampled_points(self, npoints, seed=None):
+        if not seed is None: cdf_rand_array = numpy.random.default_rng(seed).random(npoints)
+        else:                cdf_rand_array = numpy.random.random(npoints)
+
+        return self.get_sampled(cdf_rand_array)
+
+class UserDefinedSpectrum:
+    '''
+    Spectrum files of the geometrical source, parsed once: an entry is found by the modification time of the file
+    or, if the file was rewritten, by the hash of its content. Within use(), the spectra are sampled with a cached
+    InverseCDFSampler1D.
+    '''
+    cache = LRUCache(maximum_size=8)
+
+    @classmethod
+    def load(cls, file_name):
+        '''
+        :return: the spectrum array (read-only), columns: energy/wavelength, intensity
+        '''
+        stat     = os.stat(file_name)
+        file_key = ("file", os.path.abspath(file_name), stat.st_mtime_ns, stat.st_size)
+        spectrum = cls.cache.get(file_key)
+
+        if spectrum is None:
+            with open(file_name, "rb") as file: content = file.read()
+
+            def parse():
+                spectrum = numpy.loadtxt(io.BytesIO(content))
+                spectrum.setflags(write=False)
+                return spectrum
+
+            spectrum = cls.cache.get_or_compute(("content", hashlib.sha1(content).hexdigest()), parse)
+            cls.cache.put(file_key, spectrum)
+
+        return spectrum
+
+    @classmethod
+    def get_sampler(cls, pdf, pdf_x=None):
+        return cls.cache.get_or_compute(("sampler", get_cache_key(pdf, pdf_x)), lambda: InverseCDFSampler1D(pdf, pdf_x))
+
+    @classmethod
+    @contextmanager
+    def use(cls):
+        with ModulePatch.use(source_geometrical, "Sampler1D", lambda Sampler1D: cls.get_sampler): # used only for the user defined spectra
+            yield
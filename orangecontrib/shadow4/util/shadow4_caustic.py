@@ -0,0 +1,379 @@
+import copy
+import numpy
+
+from scipy import optimize
+
+from shadow4.beam.s4_beam import S4Beam
+
+MAXIMUM_ELEMENTS_PER_CHUNK = 2**22 # rays x planes in a chunk: ~32 MB for each temporary array
+
+class BeamRetracer:
+    '''
+    Analytical retrace of a beam to many planes perpendicular to Y at once, as S4Beam.retrace(distance, resetY=True)
+    does for a single plane, but without copying the beam: positions and direction cosines are read only once, and the
+    coordinates at all the planes are computed as a broadcasted operation, processing the rays in chunks to cap the
+    memory.
+
+    Supported columns: 1 (X), 3 (Z), 20 (R = sqrt(X^2 + Z^2), Y being 0 on the planes).
+    '''
+    COLUMNS = [1, 3, 20]
+
+    def __init__(self, beam: S4Beam, nolost=1, ref=23, maximum_elements_per_chunk=MAXIMUM_ELEMENTS_PER_CHUNK):
+        x, y, z, vx, vy, vz = beam.get_columns([1, 2, 3, 4, 5, 6], nolost=nolost)
+
+        # x(d) = x + (d - y) * vx/vy
+        self.__x      = x
+        self.__z      = z
+        self.__y_0    = y
+        self.__tan_x  = vx / vy
+        self.__tan_z  = vz / vy
+
+        if ref == 0 or ref is None: self.__weights = numpy.ones(len(x))
+        else:                       self.__weights = beam.get_column(ref, nolost=nolost)
+
+        self.__maximum_elements_per_chunk = maximum_elements_per_chunk
+
+    @property
+    def number_of_rays(self):
+        return len(self.__x)
+
+    @property
+    def weights(self):
+        return self.__weights
+
+    def get_chunks(self, number_of_positions):
+        chunk_size = max(1, self.__maximum_elements_per_chunk // max(1, number_of_positions))
+
+        for start in range(0, self.number_of_rays, chunk_size): yield slice(start, min(start + chunk_size, self.number_of_rays))
+
+    def get_coordinates(self, col, positions, rays=slice(None)):
+        '''
+        :return: array (rays, positions) of the values of the column on the planes
+        '''
+        positions = numpy.atleast_1d(numpy.asarray(positions, dtype=float))
+        distance  = positions[numpy.newaxis, :] - self.__y_0[rays, numpy.newaxis]
+
+        if col == 1:    return self.__x[rays, numpy.newaxis] + distance * self.__tan_x[rays, numpy.newaxis]
+        elif col == 3:  return self.__z[rays, numpy.newaxis] + distance * self.__tan_z[rays, numpy.newaxis]
+        elif col == 20: return numpy.sqrt((self.__x[rays, numpy.newaxis] + distance * self.__tan_x[rays, numpy.newaxis])**2 +
+                                          (self.__z[rays, numpy.newaxis] + distance * self.__tan_z[rays, numpy.newaxis])**2)
+        else: raise ValueError("Column " + str(col) + " not supported by the analytical retrace")
+
+    def histograms(self, col, positions, xrange, nbins):
+        '''
+        Histograms (weighted as the beam) of the column on all the planes, as S4Beam.histo1 would calculate them.
+
+        :return: dictionary with: histogram (nbins, positions), bins, bin_center, fwhm (positions),
+                 center (positions, weighted average over all the rays, also outside xrange), intensity
+        '''
+        positions = numpy.atleast_1d(numpy.asarray(positions, dtype=float))
+        npositions = len(positions)
+        bins       = numpy.linspace(xrange[0], xrange[1], nbins + 1)
+        plane_offsets = numpy.arange(npositions)[numpy.newaxis, :] * nbins
+
+        histogram     = numpy.zeros(nbins * npositions)
+        weighted_sums = numpy.zeros(npositions)
+
+        for rays in self.get_chunks(npositions):
+            coordinates = self.get_coordinates(col, positions, rays)
+            weights     = numpy.broadcast_to(self.__weights[rays, numpy.newaxis], coordinates.shape)
+
+            weighted_sums += numpy.sum(coordinates * weights, axis=0)
+
+            indices, inside = get_bin_indices(coordinates, bins)
+
+            # all the planes in a single bincount
+            histogram += numpy.bincount((indices + plane_offsets)[inside], weights=weights[inside], minlength=nbins * npositions)
+
+        histogram = histogram.reshape(npositions, nbins).T
+
+        intensity = numpy.sum(self.__weights)
+
+        return {
+            "histogram"  : histogram,
+            "bins"       : bins,
+            "bin_center" : bins[:-1] + (bins[1] - bins[0]) * 0.5,
+            "fwhm"       : get_fwhms(histogram, bins),
+            "center"     : weighted_sums / intensity if intensity != 0.0 else numpy.full(npositions, numpy.nan),
+            "intensity"  : intensity,
+        }
+
+    def histograms2d(self, positions, xrange, zrange, nbins_x, nbins_z):
+        '''
+        X-Z images (weighted as the beam) on all the planes, filled in a single pass over the rays.
+
+        :return: dictionary with: cube (positions, nbins_x, nbins_z), bins_x, bins_z, bin_center_x, bin_center_z, intensity
+        '''
+        positions  = numpy.atleast_1d(numpy.asarray(positions, dtype=float))
+        npositions = len(positions)
+        bins_x     = numpy.linspace(xrange[0], xrange[1], nbins_x + 1)
+        bins_z     = numpy.linspace(zrange[0], zrange[1], nbins_z + 1)
+        plane_offsets = numpy.arange(npositions)[numpy.newaxis, :] * nbins_x * nbins_z
+
+        cube = numpy.zeros(npositions * nbins_x * nbins_z)
+
+        for rays in self.get_chunks(npositions):
+            indices_x, inside_x = get_bin_indices(self.get_coordinates(1, positions, rays), bins_x)
+            indices_z, inside_z = get_bin_indices(self.get_coordinates(3, positions, rays), bins_z)
+
+            inside  = inside_x & inside_z
+            weights = numpy.broadcast_to(self.__weights[rays, numpy.newaxis], inside.shape)
+
+            cube += numpy.bincount((plane_offsets + indices_x * nbins_z + indices_z)[inside], weights=weights[inside], minlength=cube.size)
+
+        return {
+            "cube"         : cube.reshape(npositions, nbins_x, nbins_z),
+            "bins_x"       : bins_x,
+            "bins_z"       : bins_z,
+            "bin_center_x" : bins_x[:-1] + (bins_x[1] - bins_x[0]) * 0.5,
+            "bin_center_z" : bins_z[:-1] + (bins_z[1] - bins_z[0]) * 0.5,
+            "intensity"    : numpy.sum(self.__weights),
+        }
+
+    def get_rms_size(self, col, position):
+        coordinates = self.get_coordinates(col, position)[:, 0]
+        average     = numpy.average(coordinates, weights=self.__weights)
+
+        return numpy.sqrt(numpy.average((coordinates - average)**2, weights=self.__weights))
+
+    def get_fwhm_size(self, col, position, xrange, nbins):
+        return self.histograms(col, position, xrange, nbins)["fwhm"][0]
+
+class ImagePlaneRetracer:
+    '''
+    Output beam of a beamline element at other image plane distances, when only the drift (in vacuum) to the image
+    plane changes: the beam traced at the reference distance is retraced as S4Beam.retrace(distance, resetY=True),
+    the inverse of the Y direction cosines being computed once for all the distances.
+    '''
+    def __init__(self, beam: S4Beam, reference_distance):
+        self.__rays               = beam.rays.copy() # the traced beam is sent downstream, where it can be modified
+        self.__reference_distance = reference_distance
+        self.__y_0                = self.__rays[:, 1].copy()
+        self.__inverse_vy         = 1 / self.__rays[:, 4]
+
+    @property
+    def reference_distance(self):
+        return self.__reference_distance
+
+    def get_beam(self, distance) -> S4Beam:
+        beam = S4Beam(array=self.__rays)
+        rays = beam.rays
+
+        if distance != self.__reference_distance:
+            tof = (distance - self.__reference_distance - self.__y_0) * self.__inverse_vy
+
+            rays[:, 0]  += tof * rays[:, 3]
+            rays[:, 2]  += tof * rays[:, 5]
+            rays[:, 1]   = 0.0
+            rays[:, 12] += tof
+
+        return beam
+
+class FocusFinder:
+    '''
+    Position of the waist along Y, found with a bracketed 1D minimization of the beam size on the analytical retrace:
+    a coarse scan of a few planes brackets the minimum, then bounded Brent (golden section + parabolic steps) refines it.
+
+    direction: "H" (col 1), "V" (col 3) or "both" (quadratic sum of H and V sizes)
+    kind:      "rms" or "fwhm" (the FWHM is histogrammed in xrange with nbins, as the caustic)
+
+    The depth of focus is the distance between the planes where the size is sqrt(2) times the size at the waist.
+    '''
+    DIRECTIONS = ["H", "V", "both"]
+    KINDS      = ["rms", "fwhm"]
+
+    def __init__(self, retracer: BeamRetracer, direction="H", kind="rms", xrange=None, nbins=100):
+        if not direction in self.DIRECTIONS: raise ValueError("Direction should be one of " + str(self.DIRECTIONS))
+        if not kind in self.KINDS:           raise ValueError("Size should be one of " + str(self.KINDS))
+        if kind == "fwhm" and xrange is None: raise ValueError("FWHM size needs a range")
+
+        self.__retracer  = retracer
+        self.__columns   = {"H" : [1], "V" : [3], "both" : [1, 3]}[direction]
+        self.__kind      = kind
+        self.__xrange    = xrange
+        self.__nbins     = nbins
+
+        self.number_of_evaluations = 0
+
+    def get_size(self, position):
+        self.number_of_evaluations += 1
+
+        if self.__kind == "rms": sizes = [self.__retracer.get_rms_size(col, position) for col in self.__columns]
+        else:
+            sizes = [self.__retracer.get_fwhm_size(col, position, self.__xrange, self.__nbins) for col in self.__columns]
+            # spot narrower than a bin: the FWHM is not resolved
+            sizes = [(self.__xrange[1] - self.__xrange[0]) / self.__nbins if numpy.isnan(size) else size for size in sizes]
+
+        return numpy.sqrt(numpy.sum(numpy.array(sizes)**2))
+
+    def find_focus(self, y_min, y_max, number_of_bracketing_planes=11, tolerance=None):
+        '''
+        :param tolerance: on the positions (default: 1e-5 of the Y range)
+        :return: dictionary with: position, size, depth_of_focus, depth_of_focus_limits, number_of_evaluations
+        '''
+        if tolerance is None: tolerance = 1e-5 * (y_max - y_min)
+
+        self.number_of_evaluations = 0
+
+        planes = numpy.linspace(y_min, y_max, max(3, number_of_bracketing_planes))
+        sizes  = numpy.array([self.get_size(plane) for plane in planes])
+        sizes[~numpy.isfinite(sizes)] = numpy.inf
+
+        best = int(numpy.argmin(sizes))
+
+        result = optimize.minimize_scalar(self.get_size,
+                                          bounds=(planes[max(0, best - 1)], planes[min(len(planes) - 1, best + 1)]),
+                                          method="bounded",
+                                          options={"xatol" : tolerance})
+
+        if result.fun <= sizes[best]: position, size = result.x, result.fun
+        else:                         position, size = planes[best], sizes[best] # FWHM is stepwise: keep the best plane
+
+        target = numpy.sqrt(2) * size
+
+        def find_crossing(bound):
+            if self.get_size(bound) < target: return numpy.nan # no crossing inside the range
+            else:                             return optimize.brentq(lambda y: self.get_size(y) - target, min(position, bound), max(position, bound), xtol=tolerance)
+
+        limits = (find_crossing(y_min), find_crossing(y_max))
+
+        return {
+            "position"              : position,
+            "size"                  : size,
+            "depth_of_focus"        : limits[1] - limits[0],
+            "depth_of_focus_limits" : limits,
+            "number_of_evaluations" : self.number_of_evaluations,
+        }
+
+def get_bin_indices(coordinates, bins):
+    '''
+    Same binning of numpy.histogram with uniform bins (last bin closed on the right).
+
+    :return: bin indices, mask of the coordinates inside the bins
+    '''
+    nbins   = len(bins) - 1
+    inside  = (coordinates >= bins[0]) & (coordinates <= bins[-1])
+    indices = ((coordinates - bins[0]) * (nbins / (bins[-1] - bins[0]))).astype(numpy.intp)
+    indices[indices >= nbins] = nbins - 1
+    indices[indices < 0]      = 0
+    indices[coordinates < bins[indices]] -= 1
+    indices[(coordinates >= bins[indices + 1]) & (indices != nbins - 1)] += 1
+
+    return indices, inside
+
+def get_fwhms(histogram, bins):
+    '''
+    FWHM of each column of the histogram (bins, positions), as S4Beam.histo1: distance between the first and the last
+    bin above half maximum, nan when only one bin is above half maximum.
+    '''
+    nbins        = histogram.shape[0]
+    above_half   = histogram >= numpy.max(histogram, axis=0) * 0.5
+    first        = numpy.argmax(above_half, axis=0)
+    last         = nbins - 1 - numpy.argmax(above_half[::-1, :], axis=0)
+
+    return numpy.where(numpy.sum(above_half, axis=0) > 1, (bins[1] - bins[0]) * (last - first), numpy.nan)
+
+def get_beams_at_elements(beamline, last_beam=None):
+    '''
+    Beams at the image plane of the source and of each beamline element, taken from the input beams stored in the
+    beamline elements by the upstream widgets (the output of element i is the input of element i+1) and, for the last
+    element, from last_beam. Only the missing ones are re-traced, each from the nearest available beam upstream, on
+    copies of the elements (the beamline is not modified).
+
+    :return: list of n elements + 1 beams, list of the indices of the re-traced elements (-1 is the source)
+    '''
+    number_of_elements = beamline.get_beamline_elements_number()
+
+    beams = [beamline.get_beamline_element_at(index).get_input_beam() for index in range(number_of_elements)] + [last_beam]
+    retraced_elements = []
+
+    if beams[0] is None:
+        beams[0] = beamline.get_light_source().get_beam()
+        retraced_elements.append(-1)
+
+    for index in range(number_of_elements):
+        if beams[index + 1] is None:
+            element = copy.copy(beamline.get_beamline_element_at(index))
+            element.set_input_beam(beams[index])
+            beams[index + 1], _ = element.trace_beam()
+            retraced_elements.append(index)
+
+    return beams, retraced_elements
+
+def focnew_scan_beams_at_elements(beamline, last_beam=None, npoints=10, nolost=1):
+    '''
+    Same scan of shadow4.tools.beamline_tools.focnew_scan_full_beamline (RMS sizes along the optical axis, on the p and
+    q segments of each element), with the beams got by get_beams_at_elements. The focnew coefficients are calculated
+    once per beam, and the sizes of all the segments are evaluated as a single broadcasted operation.
+
+    :return: dictionary with the keys of focnew_scan_full_beamline, plus retraced_elements
+    '''
+    beams, retraced_elements = get_beams_at_elements(beamline, last_beam)
+
+    coefficients = [beam.focnew_coeffs(nolost=nolost)[:2] for beam in beams] # AX, AZ
+
+    abscissas = numpy.linspace(0.0, 1.0, npoints)
+
+    segment_coefficients = []
+    segment_distances    = []
+    segment_positions    = []
+    labels  = []
+    markers = []
+
+    oes       = [0]
+    screens   = [0]
+    alpha_tot = 0.0
+    y_last    = 0.0
+    for index in range(beamline.get_beamline_elements_number()):
+        element = beamline.get_beamline_element_at(index)
+        p, q, _, _, alpha = element.get_coordinates().get_positions()
+        thickness = element.get_optical_element().interthickness()
+
+        oes.append(screens[-1] + p)
+        screens.append(screens[-1] + p + q)
+
+        # p segment: from the image plane of the previous element, q segment: back from the image plane of the element
+        for distance, ax_az, start, label, marker in [(p, coefficients[index], 0.0, "p", 0.1),
+                                                      (q, coefficients[index + 1], -q, "q", 0.2)]:
+            if label == "q": alpha_tot += alpha
+            if distance > 0:
+                distances = start + abscissas * distance
+                if label == "p": positions = y_last + distances
+                else:            positions = y_last + thickness + q + distances
+
+                segment_coefficients.append(ax_az if numpy.abs(numpy.mod(alpha_tot, numpy.pi)) < 1e-9 else ax_az[::-1])
+                segment_distances.append(distances)
+                segment_positions.append(positions)
+                labels.append("oe %d %s" % (index + 1, label))
+                markers.append(index + marker)
+
+                y_last = positions[-1]
+
+    if len(segment_positions) == 0: sizes = numpy.zeros((2, 0, npoints))
+    else:
+        A = numpy.array(segment_coefficients).transpose(1, 0, 2)[:, :, :, numpy.newaxis] # (H/V, segments, 6, 1)
+        t = numpy.array(segment_distances)[numpy.newaxis, :, :]                           # (1, segments, points)
+
+        sizes = numpy.sqrt(numpy.abs(A[:, :, 0] * t**2 + 2.0 * A[:, :, 1] * t + A[:, :, 2] - (A[:, :, 3] + 2.0 * A[:, :, 4] * t + A[:, :, 5] * t**2)))
+
+    list_y = segment_positions
+    list_x = [1e6 * x_i for x_i in sizes[0]]
+    list_z = [1e6 * z_i for z_i in sizes[1]]
+
+    return {
+        "x"                 : sizes[0].flatten(),
+        "y"                 : numpy.concatenate(list_y) if len(list_y) > 0 else numpy.array([]),
+        "z"                 : sizes[1].flatten(),
+        "marker"            : numpy.repeat(numpy.array(markers), npoints),
+        "list_oes"          : oes,
+        "list_screens"      : screens,
+        "list_yy"           : [y_i for y_i in list_y for _ in range(2)],
+        "list_xz"           : [xz_i for x_i, z_i in zip(list_x, list_z) for xz_i in (x_i, z_i)],
+        "list_labels"       : [label + direction for label in labels for direction in (" (H)", " (V)")],
+        "list_y"            : list_y,
+        "list_x"            : list_x,
+        "list_z"            : list_z,
+        "list_x_label"      : [label + " (H)" for label in labels],
+        "list_z_label"      : [label + " (V)" for label in labels],
+        "retraced_elements" : retraced_elements,
+    }
@@ -0,0 +1,182 @@
+import numpy
+
+from shadow4.beam.s4_beam import S4Beam
+
+RAYS_STORAGE_ITEMS = ["Full precision (float64)", "Compact (float32)", "Compact (float32), validated", "Full precision (float64), column-major"]
+
+DEFAULT_FULL_PRECISION_COLUMNS = "13" # optical path: large values, with differences of a few wavelengths
+
+class CompactRays:
+    '''
+    Rays stored by column, for the beams that are only displayed: float32 columns (half the memory and the memory
+    bandwidth of the float64 rays), float64 for the columns asked in full precision, int8 for the flag (column 10) and
+    int32 for the ray index (column 12), if their values are integers in range.
+
+    It is the "rays" of an S4Beam: the column reads and writes of the plot tools and of S4Beam.retrace
+    (rays[:, column], rays[rows, :], rays.shape) use the stored arrays, any other access goes through the float64
+    rays, rebuilt on demand (to_float64).
+    '''
+    FLAG_COLUMN  = 10
+    INDEX_COLUMN = 12
+
+    def __init__(self, columns):
+        self.__columns = columns
+
+    @classmethod
+    def initialize_from_rays(cls, rays, full_precision_columns=()):
+        full_precision_columns = [int(column) for column in full_precision_columns]
+
+        def get_dtype(column, values):
+            if column == cls.FLAG_COLUMN:    integer_type = numpy.int8
+            elif column == cls.INDEX_COLUMN: integer_type = numpy.int32
+            elif column in full_precision_columns: return numpy.float64
+            else: return numpy.float32
+
+            if values.size == 0: return integer_type
+
+            limits = numpy.iinfo(integer_type)
+            if numpy.all(numpy.mod(values, 1) == 0) and values.min() >= limits.min and values.max() <= limits.max: return integer_type
+            else:                                                                                                    return numpy.float64
+
+        return CompactRays([rays[:, column - 1].astype(get_dtype(column, rays[:, column - 1])) for column in range(1, 19)])
+
+    @property
+    def shape(self):
+        return (self.__columns[0].shape[0], 18)
+
+    @property
+    def ndim(self):
+        return 2
+
+    @property
+    def dtypes(self):
+        return [values.dtype for values in self.__columns]
+
+    @property
+    def nbytes(self):
+        return sum([values.nbytes for values in self.__columns])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def copy(self):
+        return CompactRays([values.copy() for values in self.__columns])
+
+    def __deepcopy__(self, memo):
+        return self.copy()
+
+    def to_float64(self):
+        rays = numpy.empty(self.shape)
+        for index, values in enumerate(self.__columns): rays[:, index] = values
+
+        return rays
+
+    def __array__(self, dtype=None, copy=None):
+        rays = self.to_float64()
+
+        return rays if dtype is None else rays.astype(dtype)
+
+    @classmethod
+    def __split_key(cls, key):
+        if not isinstance(key, tuple): return key, slice(None)
+        elif len(key) == 1:            return key[0], slice(None)
+        elif len(key) == 2:            return key
+        else:                          return None, None
+
+    def __getitem__(self, key):
+        rows, column = self.__split_key(key)
+
+        if isinstance(column, (int, numpy.integer)): return self.__columns[column][rows]
+        elif isinstance(column, slice) and column == slice(None) and not isinstance(rows, (int, numpy.integer)):
+            return CompactRays([values[rows] for values in self.__columns])
+        else:
+            return self.to_float64()[key]
+
+    def __setitem__(self, key, value):
+        rows, column = self.__split_key(key)
+
+        if isinstance(column, (int, numpy.integer)):
+            self.__columns[column][rows] = value
+        else:
+            rays = self.to_float64()
+            rays[key] = value
+
+            for index, values in enumerate(self.__columns): values[:] = rays[:, index]
+
+def get_compact_beam(beam: S4Beam, full_precision_columns=()) -> S4Beam:
+    compact_beam = S4Beam(N=0)
+    compact_beam.rays       = CompactRays.initialize_from_rays(beam.rays, full_precision_columns)
+    compact_beam._N_cleaned = beam._N_cleaned
+
+    return compact_beam
+
+def get_column_major_beam(beam: S4Beam) -> S4Beam:
+    column_major_beam = S4Beam(N=0)
+    column_major_beam.rays       = numpy.array(beam.rays, dtype=numpy.float64, order="F") # copy
+    column_major_beam._N_cleaned = beam._N_cleaned
+
+    return column_major_beam
+
+def get_beam_copy(beam: S4Beam, rays_storage=0, full_precision_columns=()) -> S4Beam:
+    '''
+    Copy of a received beam made by a display widget (e.g. to retrace it on a new image plane), with the rays in the
+    RAYS_STORAGE_ITEMS choice. The received beam is held upstream and only referenced by the display widgets: the
+    compact or column-major copy replaces the float64 duplicate, it is not kept in addition to it.
+    '''
+    if rays_storage in [1, 2]: return get_compact_beam(beam, full_precision_columns)
+    elif rays_storage == 3:    return get_column_major_beam(beam)
+    else:                      return beam.duplicate()
+
+def parse_columns(text):
+    '''
+    :param text: comma separated column numbers (1-18)
+    '''
+    columns = [int(column) for column in text.replace(",", " ").split()]
+
+    for column in columns:
+        if column < 1 or column > 18: raise ValueError("Column " + str(column) + " not valid: the columns of the rays are 1-18")
+
+    return columns
+
+def validate_compact_beam(beam: S4Beam, full_precision_columns=(), columns=[1, 3, 4, 6, 26], nbins=100, ref=23):
+    '''
+    Statistics of the compact copy of the beam compared with the full precision beam (good rays, weighted): mean and
+    sigma (deviations relative to the sigma, or to the mean for a constant column), FWHM and intensity (relative
+    deviations).
+
+    :return: dictionary {statistic name: deviation}, worst deviation
+    '''
+    def relative_deviation(value, reference_value, scale):
+        if value is None or reference_value is None: return 0.0 if value is reference_value else numpy.inf
+        elif scale == 0.0:                           return 0.0 if value == reference_value else numpy.inf
+        else:                                        return float(numpy.abs(value - reference_value) / numpy.abs(scale))
+
+    compact_beam = get_compact_beam(beam, full_precision_columns)
+
+    deviations = {}
+    for column in columns:
+        sigma     = compact_beam.get_standard_deviation(column, nolost=1, ref=ref)
+        ref_sigma = beam.get_standard_deviation(column, nolost=1, ref=ref)
+
+        ref_mean  = beam.get_average(column, nolost=1, ref=ref)
+        scale     = ref_mean if ref_sigma == 0.0 else ref_sigma
+
+        deviations["mean col " + str(column)]  = relative_deviation(compact_beam.get_average(column, nolost=1, ref=ref), ref_mean, scale)
+        deviations["sigma col " + str(column)] = relative_deviation(sigma, ref_sigma, scale)
+
+        # same bins for both
+        xrange   = beam.histo1(column, nbins=nbins, nolost=1, ref=ref, calculate_widths=0)["xrange"]
+        fwhm     = compact_beam.histo1(column, nbins=nbins, xrange=xrange, nolost=1, ref=ref)["fwhm"]
+        ref_fwhm = beam.histo1(column, nbins=nbins, xrange=xrange, nolost=1, ref=ref)["fwhm"]
+        deviations["fwhm col " + str(column)] = relative_deviation(fwhm, ref_fwhm, ref_fwhm)
+
+    ref_intensity = beam.intensity(nolost=1)
+    deviations["intensity"] = relative_deviation(compact_beam.intensity(nolost=1), ref_intensity, ref_intensity)
+
+    return deviations, max(deviations.values())
+
+def get_validation_text(deviations, worst_deviation):
+    text = "Compact (float32) rays: worst deviation from the full precision beam: {:.3e}\n".format(worst_deviation)
+    for name, deviation in deviations.items(): text += "   {:20s} {:.3e}\n".format(name, deviation)
+
+    return text
@@ -0,0 +1,718 @@
+import os
+import time
+import pickle
+import hashlib
+import numpy
+import h5py
+import copy
+
+from collections import deque
+from scipy import ndimage
+
+from AnyQt.QtCore import QTimer
+
+from shadow4.beam.s4_beam import S4Beam
+
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+from orangecontrib.shadow4.util.shadow4_cache import PrivateAttributes
+from orangecontrib.shadow4.util.shadow4_parallel import get_beamline_without_beams
+
+class ConvergenceMonitor:
+    '''
+    Running estimates of beam statistics over the iterations of an accumulation loop.
+
+    Every iteration contributes one independent sample of FWHM, sigma and centroid of the selected columns, and of the
+    intensity of the good rays. The uncertainty of each estimate is the standard error of the mean over the iterations.
+    The relative uncertainty of the centroid is computed with respect to the sigma of the same column, since the
+    centroid is usually close to zero.
+    '''
+    QUANTITIES = ["fwhm", "sigma", "centroid"]
+
+    def __init__(self, columns=[1, 3], nbins=100, ref=23):
+        self.__columns = list(columns)
+        self.__nbins   = nbins
+        self.__ref     = ref
+
+        self.reset()
+
+    def reset(self):
+        self.__samples = {name : [] for name in self.get_quantity_names()}
+        self.__relative_uncertainty_history = {name : [] for name in self.get_quantity_names()}
+
+    @property
+    def columns(self):
+        return self.__columns
+
+    @property
+    def number_of_iterations(self):
+        return len(self.__samples["intensity"])
+
+    def get_quantity_names(self):
+        return [quantity + " col " + str(column) for column in self.__columns for quantity in self.QUANTITIES] + ["intensity"]
+
+    def add_beam(self, beam: S4Beam):
+        for column in self.__columns:
+            ticket = beam.histo1(column, nbins=self.__nbins, nolost=1, ref=self.__ref, calculate_widths=1)
+
+            self.__samples["fwhm col " + str(column)].append(ticket["fwhm"] if not ticket["fwhm"] is None else numpy.nan)
+            self.__samples["sigma col " + str(column)].append(beam.get_standard_deviation(column, nolost=1, ref=self.__ref))
+            self.__samples["centroid col " + str(column)].append(beam.get_average(column, nolost=1, ref=self.__ref))
+
+        self.__samples["intensity"].append(beam.intensity(nolost=1))
+
+        for name, relative_uncertainty in self.get_relative_uncertainties().items():
+            self.__relative_uncertainty_history[name].append(relative_uncertainty)
+
+    def get_estimates(self):
+        '''
+        :return: dictionary {quantity name: (mean, standard error)}
+        '''
+        estimates = {}
+        for name, samples in self.__samples.items():
+            samples = numpy.array(samples, dtype=float)
+            samples = samples[numpy.isfinite(samples)]
+
+            if len(samples) == 0:   estimates[name] = (numpy.nan, numpy.nan)
+            elif len(samples) == 1: estimates[name] = (samples[0], numpy.inf)
+            else:                   estimates[name] = (samples.mean(), samples.std(ddof=1) / numpy.sqrt(len(samples)))
+
+        return estimates
+
+    def get_relative_uncertainties(self):
+        estimates = self.get_estimates()
+
+        relative_uncertainties = {}
+        for name, (mean, standard_error) in estimates.items():
+            if name.startswith("centroid"): reference = estimates[name.replace("centroid", "sigma")][0]
+            else:                           reference = mean
+
+            if numpy.isfinite(standard_error) and reference != 0.0: relative_uncertainties[name] = numpy.abs(standard_error / reference)
+            else:                                                   relative_uncertainties[name] = numpy.inf
+
+        return relative_uncertainties
+
+    def get_worst_relative_uncertainty(self):
+        if self.number_of_iterations == 0: return numpy.inf
+        else:                              return max(self.get_relative_uncertainties().values())
+
+    def is_converged(self, target_relative_uncertainty, minimum_iterations=3):
+        return self.number_of_iterations >= max(2, minimum_iterations) and \
+               self.get_worst_relative_uncertainty() <= target_relative_uncertainty
+
+    def get_state(self):
+        '''
+        :return: dictionary {array name: array}, to be stored in a checkpoint
+        '''
+        state = {}
+        for name in self.get_quantity_names():
+            state["samples/" + name]                  = numpy.array(self.__samples[name], dtype=float)
+            state["relative_uncertainties/" + name]   = numpy.array(self.__relative_uncertainty_history[name], dtype=float)
+
+        return state
+
+    def set_state(self, state):
+        self.reset()
+
+        for name in self.get_quantity_names():
+            self.__samples[name]                      = list(state["samples/" + name])
+            self.__relative_uncertainty_history[name] = list(state["relative_uncertainties/" + name])
+
+    def get_convergence_curves(self):
+        '''
+        :return: iteration numbers, dictionary {quantity name: relative uncertainty after each iteration}
+        '''
+        return numpy.arange(1, self.number_of_iterations + 1), \
+               {name : numpy.array(history) for name, history in self.__relative_uncertainty_history.items()}
+
+class LoopCheckpoint:
+    '''
+    Checkpoint of the state of a loop widget in an HDF5 file: scalar parameters are stored as attributes, arrays as
+    datasets, and the accumulated Shadow Data as rays plus the beamline (pickled, without the input beams).
+
+    The checkpoint is written into a temporary file that replaces the previous one only when complete, so a crash
+    during the writing never corrupts the last good checkpoint.
+
+    The loop upstream of a resumed widget restarts from its first iteration: the widgets store the ids of the
+    iterations done (e.g. the random streams of the accumulated beams) and skip them when they come again.
+    '''
+    @classmethod
+    def is_due(cls, current_iteration, last_checkpoint_iteration, checkpoint_interval):
+        '''
+        A checkpoint is due every checkpoint_interval iterations (an input can bring more than one iteration).
+        '''
+        return current_iteration - last_checkpoint_iteration >= max(1, checkpoint_interval)
+
+    @classmethod
+    def get_id(cls, key):
+        '''
+        int64 id of the key (built from its repr), the same in every session.
+        '''
+        return int.from_bytes(hashlib.sha1(repr(key).encode()).digest()[:8], "little", signed=True)
+
+    @classmethod
+    def get_stream_id(cls, shadow_data: ShadowData):
+        '''
+        id of the source rays of the beam, None if they are not reproducible (unknown random stream, or seed 0).
+        '''
+        random_stream = shadow_data.random_stream
+
+        if random_stream is None or random_stream.base_seed == 0: return None
+        else: return cls.get_id((random_stream.base_seed, random_stream.spawn_key, random_stream.seed, random_stream.first_ray_index))
+
+    @classmethod
+    def write(cls, file_name, loop_name, parameters={}, arrays={}, shadow_data: ShadowData=None):
+        temporary_file_name = file_name + ".tmp"
+
+        with h5py.File(temporary_file_name, "w") as file:
+            file.attrs["loop_name"]    = loop_name
+            file.attrs["file_time"]    = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+            file.attrs["creator"]      = "LoopCheckpoint.write"
+            file.attrs["code"]         = "OASYS2-SHADOW4"
+            file.attrs["h5py_version"] = h5py.version.version
+
+            parameters_group = file.create_group("parameters")
+            for name, value in parameters.items():
+                if not value is None: parameters_group.attrs[name] = value
+
+            arrays_group = file.create_group("arrays")
+            for name, value in arrays.items():
+                if not value is None: arrays_group.create_dataset(name, data=numpy.asarray(value))
+
+            if not shadow_data is None:
+                shadow_data_group = file.create_group("shadow_data")
+                shadow_data_group.create_dataset("beam", data=shadow_data.beam.rays)
+                # a footprint not computed (or released) is not re-traced only to be written
+                if not shadow_data.is_footprint_lazy() and isinstance(shadow_data.footprint, S4Beam):
+                    shadow_data_group.create_dataset("footprint", data=shadow_data.footprint.rays)
+                if not shadow_data.initial_flux is None:      shadow_data_group.attrs["initial_flux"] = shadow_data.initial_flux
+                if not shadow_data.beamline is None:          shadow_data_group.create_dataset("beamline", data=numpy.void(pickle.dumps(get_beamline_without_beams(shadow_data.beamline))))
+                if not shadow_data.scanning_data is None:     shadow_data_group.create_dataset("scanning_data", data=numpy.void(pickle.dumps(shadow_data.scanning_data)))
+
+        os.replace(temporary_file_name, file_name)
+
+    @classmethod
+    def read(cls, file_name, loop_name):
+        '''
+        :return: parameters, arrays, shadow data (None if not stored)
+        '''
+        if not os.path.exists(file_name): raise ValueError("Checkpoint file " + file_name + " not existing")
+
+        with h5py.File(file_name, "r") as file:
+            if file.attrs.get("loop_name", "") != loop_name:
+                raise ValueError("File " + file_name + " is not a checkpoint of a " + loop_name)
+
+            parameters = {name : value for name, value in file["parameters"].attrs.items()}
+
+            arrays = {}
+            def read_dataset(name, item):
+                if isinstance(item, h5py.Dataset): arrays[name] = item[()]
+            file["arrays"].visititems(read_dataset)
+
+            if "shadow_data" in file:
+                shadow_data_group = file["shadow_data"]
+
+                shadow_data = ShadowData(beam=S4Beam(array=shadow_data_group["beam"][()]),
+                                         footprint=S4Beam(array=shadow_data_group["footprint"][()]) if "footprint" in shadow_data_group else None,
+                                         beamline=pickle.loads(shadow_data_group["beamline"][()].tobytes()) if "beamline" in shadow_data_group else None)
+                if "initial_flux" in shadow_data_group.attrs: shadow_data.initial_flux  = shadow_data_group.attrs["initial_flux"]
+                if "scanning_data" in shadow_data_group:      shadow_data.scanning_data = pickle.loads(shadow_data_group["scanning_data"][()].tobytes())
+            else:
+                shadow_data = None
+
+        return parameters, arrays, shadow_data
+
+class LoopDispatcher:
+    '''
+    Iterations of a loop widget dispatched from the Qt event loop, instead of recursively from the input handlers.
+
+    The next iteration is never sent from inside the input handler acknowledging the previous one: it is queued and
+    sent when the control returns to the event loop, so the signal dispatch does not nest (no growing stack over
+    the iterations) and the widgets downstream can repaint in between.
+
+    The iterations do not overlap: the next one is sent only when the previous one is acknowledged, since Orange
+    merges the signals sent on the same link before they are processed, and the downstream widgets compute on the
+    GUI thread anyway.
+    '''
+    def __init__(self, send_iteration, on_completed=None, interval=0):
+        self.__send_iteration = send_iteration # callable(iteration number)
+        self.__on_completed   = on_completed
+        self.__interval       = int(interval)  # ms between the dispatches
+
+        self.__queue            = deque()
+        self.__waiting          = False # an iteration was sent and not acknowledged yet
+        self.__running          = False
+        self.__dispatch_pending = False
+
+    @property
+    def is_waiting(self):
+        return self.__waiting
+
+    @property
+    def number_of_queued_iterations(self):
+        return len(self.__queue)
+
+    @property
+    def is_running(self):
+        return self.__running
+
+    def start(self, first_iteration, last_iteration):
+        self.__queue   = deque(range(first_iteration, last_iteration + 1))
+        self.__waiting = False
+        self.__running = True
+
+        if len(self.__queue) == 0: self.__complete() # nothing to do: the loop is over
+        else:                      self.__schedule_dispatch()
+
+    def acknowledge(self):
+        self.__waiting = False
+
+        if len(self.__queue) == 0: self.__complete()
+        else:                      self.__schedule_dispatch()
+
+    def stop(self):
+        self.__queue.clear()
+
+        if not self.__waiting: self.__complete()
+
+    def interrupt(self):
+        # the iteration sent is not coming back
+        self.__queue.clear()
+        self.__waiting = False
+
+        self.__complete()
+
+    def suspend(self):
+        self.__running = False
+
+    def resume(self):
+        self.__running = True
+
+        if not self.__waiting and len(self.__queue) == 0: self.__complete()
+        else:                                              self.__schedule_dispatch()
+
+    def __complete(self):
+        self.__running = False
+        if not self.__on_completed is None: self.__on_completed()
+
+    def __schedule_dispatch(self):
+        if not self.__dispatch_pending:
+            self.__dispatch_pending = True
+            QTimer.singleShot(self.__interval, self.__dispatch)
+
+    def __dispatch(self):
+        self.__dispatch_pending = False
+
+        if self.__running and len(self.__queue) > 0 and not self.__waiting:
+            self.__waiting = True
+            self.__send_iteration(self.__queue.popleft())
+
+UNDULATOR_SCALED_RADIATION = ["BACKPROPAGATED_r", "CART_BACKPROPAGATED_x", "CART_BACKPROPAGATED_y"]
+
+def sample_light_source(light_source) -> S4Beam:
+    '''
+    get_beam for light sources sampled more than once. S4UndulatorLightSource scales its backpropagated radiation in
+    place at every get_beam (energy spread correction of the size): it samples a copy of those arrays, and the
+    radiation it keeps stays as calculated. If the radiation cannot be replaced, the undulator is sampled as it is
+    (its backpropagated radiation is then scaled again at every call).
+    '''
+    results = PrivateAttributes(light_source, "S4UndulatorLightSource", ["result_radiation"])
+
+    if not results.is_instance(): return light_source.get_beam()
+    elif not results.is_available():
+        print(results.get_warning("copy of the sampled radiation"))
+        return light_source.get_beam()
+
+    radiation = light_source.get_result_dictionary() # calculated at the first call
+
+    sampled_radiation = dict(radiation)
+    for key in UNDULATOR_SCALED_RADIATION:
+        if key in sampled_radiation: sampled_radiation[key] = numpy.array(sampled_radiation[key], copy=True)
+
+    results.set("result_radiation", sampled_radiation)
+    try:
+        return light_source.get_beam()
+    finally:
+        results.set("result_radiation", radiation)
+
+        for key, value in sampled_radiation.items(): # entries added by the sampling
+            if not key in radiation: radiation[key] = value
+
+class ChunkedSource:
+    '''
+    Rays of a light source sampled in chunks of fixed size, from a single stream of random numbers: the source is
+    seeded once, then every chunk continues the numpy random state where the previous chunk stopped. The state is
+    saved and restored around each chunk, so the code using numpy.random in between does not change the sequence.
+    The chunks are not the rays of a single get_beam of the total number: the sources draw their random numbers
+    column by column.
+
+    Only one chunk exists at a time: the total number of rays is limited by time rather than by memory.
+
+    With a seed_manager, every chunk is instead sampled from its own stream, the child chunk_index of the stream
+    parent_key: any chunk can be regenerated by itself (regenerate_beam).
+    '''
+    def __init__(self, light_source, number_of_rays, chunk_size, seed_manager=None, parent_key=()):
+        if chunk_size <= 0: raise ValueError("Chunk size should be > 0")
+
+        self.__light_source   = light_source
+        self.__number_of_rays = int(number_of_rays)
+        self.__chunk_size     = int(chunk_size)
+        self.__seed           = light_source.get_seed()
+        self.__seed_manager   = seed_manager
+        self.__parent_key     = tuple(parent_key)
+        self.__random_state   = None
+        self.__generated_rays = 0
+        self.__chunk_index    = 0
+        self.__random_stream  = None
+
+    @property
+    def number_of_chunks(self):
+        return int(numpy.ceil(self.__number_of_rays / self.__chunk_size))
+
+    @property
+    def chunk_index(self):
+        return self.__chunk_index # number of chunks generated
+
+    @property
+    def generated_rays(self):
+        return self.__generated_rays
+
+    def is_completed(self):
+        return self.__generated_rays >= self.__number_of_rays
+
+    def get_random_stream(self) -> ShadowData.RandomStream:
+        '''
+        :return: the random stream of the last chunk
+        '''
+        return self.__random_stream
+
+    def get_next_beam(self) -> S4Beam:
+        if self.is_completed(): raise ValueError("All the chunks have been generated")
+
+        number_of_rays = min(self.__chunk_size, self.__number_of_rays - self.__generated_rays)
+        random_state   = numpy.random.get_state()
+
+        if self.__seed_manager is None:
+            spawn_key = None
+            seed      = self.__seed if self.__random_state is None else 0
+        else:
+            spawn_key = self.__parent_key + (self.__chunk_index,)
+            seed      = self.__seed_manager.get_seed(*spawn_key)
+
+        try:
+            # the shadow4 sources seed numpy.random in get_beam, unless the seed is 0
+            if seed == 0 and not self.__random_state is None: numpy.random.set_state(self.__random_state)
+            self.__light_source.set_seed(seed)
+            self.__light_source.set_nrays(number_of_rays)
+
+            beam = sample_light_source(self.__light_source)
+
+            self.__random_state = numpy.random.get_state()
+        finally:
+            numpy.random.set_state(random_state)
+            self.__light_source.set_seed(self.__seed)
+            self.__light_source.set_nrays(self.__number_of_rays)
+
+        beam.rays[:, 11] += self.__generated_rays # ray index along the whole stream
+
+        self.__random_stream = ShadowData.RandomStream(self.__seed if self.__seed_manager is None else self.__seed_manager.base_seed,
+                                                       spawn_key, seed, number_of_rays, self.__generated_rays)
+
+        self.__generated_rays += number_of_rays
+        self.__chunk_index    += 1
+
+        return beam
+
+def regenerate_beam(light_source, random_stream: ShadowData.RandomStream) -> S4Beam:
+    '''
+    The source rays recorded in random_stream (e.g. one chunk), sampled again with the same seed and ray indices.
+    The light source is not modified (the sampling works on a copy), and the numpy random state is preserved.
+    '''
+    if random_stream is None or not random_stream.is_regenerable():
+        raise ValueError("The rays do not come from a stream that can be regenerated by itself")
+
+    light_source = copy.deepcopy(light_source)
+    light_source.set_seed(random_stream.seed)
+    light_source.set_nrays(random_stream.number_of_rays)
+
+    random_state = numpy.random.get_state()
+    try:
+        beam = sample_light_source(light_source)
+    finally:
+        numpy.random.set_state(random_state)
+
+    beam.rays[:, 11] += random_stream.first_ray_index
+
+    return beam
+
+class SourceAcceptance:
+    '''
+    Phase space volume accepted by the beamline, to reject at generation time the source rays that would be lost.
+    Text files, one row per item [m, rad]:
+      - PHASE_SPACE_VOLUME: x_min x_max x'_min x'_max z_min z_max z'_min z'_max, a ray is accepted if it is within
+        at least one of the boxes,
+      - SLIT: distance center_x center_z gap_x gap_z, a ray is accepted if, propagated in free space along y, it
+        passes through all the slits.
+    '''
+    PHASE_SPACE_VOLUME = 1
+    SLIT               = 2
+
+    def __init__(self, acceptance_type, data):
+        data = numpy.atleast_2d(numpy.asarray(data, dtype=float))
+
+        if acceptance_type == self.PHASE_SPACE_VOLUME: columns = 8
+        elif acceptance_type == self.SLIT:             columns = 5
+        else: raise ValueError("Acceptance type not recognized")
+
+        if data.shape[1] != columns: raise ValueError("Acceptance data should have " + str(columns) + " columns")
+
+        self.__acceptance_type = acceptance_type
+        self.__data            = data
+
+    @classmethod
+    def load(cls, acceptance_type, file_name):
+        return SourceAcceptance(acceptance_type, numpy.loadtxt(file_name, ndmin=2))
+
+    def is_accepted(self, rays):
+        '''
+        :return: boolean mask of the accepted rays
+        '''
+        x, y, z    = rays[:, 0], rays[:, 1], rays[:, 2]
+        vx, vy, vz = rays[:, 3], rays[:, 4], rays[:, 5]
+
+        if self.__acceptance_type == self.PHASE_SPACE_VOLUME:
+            xp, zp   = vx / vy, vz / vy
+            accepted = numpy.zeros(rays.shape[0], dtype=bool)
+
+            for x_min, x_max, xp_min, xp_max, z_min, z_max, zp_min, zp_max in self.__data:
+                accepted |= (x >= x_min) & (x <= x_max) & (xp >= xp_min) & (xp <= xp_max) & \
+                            (z >= z_min) & (z <= z_max) & (zp >= zp_min) & (zp <= zp_max)
+        else:
+            accepted = numpy.ones(rays.shape[0], dtype=bool)
+
+            for distance, center_x, center_z, gap_x, gap_z in self.__data:
+                path      = (distance - y) / vy
+                accepted &= (numpy.abs(x + path * vx - center_x) <= 0.5 * gap_x) & \
+                            (numpy.abs(z + path * vz - center_z) <= 0.5 * gap_z)
+
+        return accepted
+
+class AcceptanceMap:
+    '''
+    Binned map of the source phase space (x, z, x', z', photon energy) where the rays survive the beamline, learnt
+    with a pilot trace: the source of the beamline is sampled with few rays, that are traced through all the elements.
+
+    A ray is accepted if one of the bins within margin bins from its own had a surviving pilot ray: the margin covers
+    the bins at the border of the useful region that the pilot could miss. The rays beyond the range of the pilot are
+    assigned to the bins at the border.
+    As acceptance of RejectionSource, the production rays are sampled only in the useful region, with correct weights.
+    '''
+    COORDINATES = ["x", "z", "x'", "z'", "wavenumber"]
+
+    def __init__(self, edges, mask):
+        self.__edges = [numpy.asarray(edge, dtype=float) for edge in edges]
+        self.__mask  = numpy.asarray(mask, dtype=bool)
+
+    @classmethod
+    def get_coordinates(cls, rays):
+        return [rays[:, 0], rays[:, 2], rays[:, 3] / rays[:, 4], rays[:, 5] / rays[:, 4], rays[:, 10]]
+
+    @classmethod
+    def from_rays(cls, source_rays, survived, number_of_bins=16, margin=1):
+        '''
+        :param source_rays: rays of the pilot, as generated by the source
+        :param survived: boolean mask of the pilot rays surviving the beamline
+        '''
+        if not numpy.any(survived): raise ValueError("No pilot ray survived the beamline")
+
+        # bins with the same number of pilot rays: narrow where the source is dense
+        edges = []
+        for coordinate in cls.get_coordinates(source_rays):
+            edge = numpy.unique(numpy.quantile(coordinate, numpy.linspace(0.0, 1.0, number_of_bins + 1)))
+            edges.append(edge if len(edge) > 1 else numpy.repeat(edge, 2))
+
+        acceptance_map = AcceptanceMap(edges, numpy.zeros([len(edge) - 1 for edge in edges], dtype=bool))
+        acceptance_map.__mask[acceptance_map.__get_bins(source_rays[survived])] = True
+
+        if margin > 0: acceptance_map.__mask = ndimage.binary_dilation(acceptance_map.__mask, structure=numpy.ones((3,)*len(edges), dtype=bool), iterations=margin)
+
+        return acceptance_map
+
+    @classmethod
+    def from_pilot_trace(cls, beamline, number_of_rays, seed, number_of_bins=16, margin=1):
+        '''
+        :return: the acceptance map, the pilot statistics (transmission, fraction of the source rays in the
+                 accepted region, expected speed-up of the tracing, estimated fraction of the surviving rays in the
+                 accepted region)
+        '''
+        beamline     = copy.deepcopy(get_beamline_without_beams(beamline))
+        light_source = beamline.get_light_source()
+
+        if light_source is None: raise ValueError("No light source in beamline")
+
+        light_source.set_seed(seed)
+        light_source.set_nrays(int(number_of_rays))
+
+        source_beam = light_source.get_beam()
+        beam        = source_beam
+
+        for index in range(beamline.get_beamline_elements_number()):
+            element = beamline.get_beamline_element_at(index)
+            element.set_input_beam(beam)
+            beam, _ = element.trace_beam()
+
+        good_rays = beam.rays[beam.rays[:, 9] > 0]
+        survived  = numpy.isin(source_beam.rays[:, 11], good_rays[:, 11]) # the ray index is kept along the beamline
+
+        acceptance_map = cls.from_rays(source_beam.rays, survived, number_of_bins, margin)
+        accepted       = acceptance_map.is_accepted(source_beam.rays)
+
+        # the survivors of one half of the pilot found by the map of the other half: the rays the map would lose
+        # (a bias of the intensity) are fewer with the map of the whole pilot
+        first_half = numpy.arange(len(survived)) % 2 == 0
+        try:
+            coverage = cls.from_rays(source_beam.rays[first_half], survived[first_half], number_of_bins, margin).is_accepted(source_beam.rays[~first_half & survived]).mean()
+        except ValueError:
+            coverage = numpy.nan
+
+        statistics = {"transmission"       : survived.mean(),
+                      "accepted fraction"  : accepted.mean(),
+                      "speed-up"           : 1.0 / accepted.mean(),
+                      "estimated coverage" : coverage}
+
+        return acceptance_map, statistics
+
+    @classmethod
+    def load(cls, file_name):
+        data = numpy.load(file_name)
+
+        return AcceptanceMap([data["edges_" + str(index)] for index in range(len(cls.COORDINATES))], data["mask"])
+
+    def save(self, file_name):
+        numpy.savez_compressed(file_name, mask=self.__mask, **{"edges_" + str(index) : edge for index, edge in enumerate(self.__edges)})
+
+    def get_accepted_bins_fraction(self):
+        return self.__mask.mean()
+
+    def is_accepted(self, rays):
+        '''
+        :return: boolean mask of the accepted rays
+        '''
+        return self.__mask[self.__get_bins(rays)]
+
+    def __get_bins(self, rays):
+        return tuple(numpy.clip(numpy.searchsorted(edge, coordinate, side="right") - 1, 0, len(edge) - 2)
+                     for edge, coordinate in zip(self.__edges, self.get_coordinates(rays)))
+
+class RejectionSource:
+    '''
+    Rays of a light source within an acceptance (SourceAcceptance or AcceptanceMap): the rays are generated in chunks, from a single stream of random
+    numbers, and the ones out of the acceptance are discarded, until number_of_rays rays are accepted or more than
+    max_number_of_rejected_rays are rejected (0: no limit). In any case, no more than MAXIMUM_GENERATION_FACTOR rays
+    are generated for each requested ray.
+
+    An accepted ray stands for generated/accepted rays of the source: the electric fields are scaled by
+    sqrt(accepted/generated), so the beam has the intensity of the accepted part of a beam of generated rays.
+    '''
+    MINIMUM_CHUNK_SIZE        = 1000
+    MAXIMUM_GENERATION_FACTOR = 1000
+
+    def __init__(self, light_source, acceptance, number_of_rays, max_number_of_rejected_rays=0):
+        self.__light_source                = light_source
+        self.__acceptance                  = acceptance
+        self.__number_of_rays              = int(number_of_rays)
+        self.__max_number_of_rejected_rays = int(max_number_of_rejected_rays)
+        self.__generated_rays              = 0
+        self.__accepted_rays               = 0
+
+    @property
+    def generated_rays(self):
+        return self.__generated_rays
+
+    @property
+    def accepted_rays(self):
+        return self.__accepted_rays
+
+    @property
+    def efficiency(self):
+        return 0.0 if self.__generated_rays == 0 else self.__accepted_rays / self.__generated_rays
+
+    def is_rejection_limit_reached(self):
+        return self.__max_number_of_rejected_rays > 0 and \
+               self.__generated_rays - self.__accepted_rays > self.__max_number_of_rejected_rays
+
+    def is_generation_limit_reached(self):
+        return self.__generated_rays >= self.MAXIMUM_GENERATION_FACTOR * self.__number_of_rays
+
+    def get_beam(self) -> S4Beam:
+        seed           = self.__light_source.get_seed()
+        number_of_rays = self.__light_source.get_nrays()
+
+        accepted_rays = []
+        try:
+            while self.__accepted_rays < self.__number_of_rays and not (self.is_rejection_limit_reached() or self.is_generation_limit_reached()):
+                missing_rays = self.__number_of_rays - self.__accepted_rays
+
+                if self.__accepted_rays == 0: chunk_size = missing_rays
+                else:                         chunk_size = int(numpy.ceil(1.1 * missing_rays / self.efficiency))
+                if self.__max_number_of_rejected_rays > 0: # the rejected rays can exceed the limit by missing_rays at most
+                    chunk_size = min(chunk_size, missing_rays + self.__max_number_of_rejected_rays - (self.__generated_rays - self.__accepted_rays))
+                chunk_size = min(max(chunk_size, self.MINIMUM_CHUNK_SIZE), 10 * self.__number_of_rays,
+                                 self.MAXIMUM_GENERATION_FACTOR * self.__number_of_rays - self.__generated_rays)
+
+                self.__light_source.set_nrays(chunk_size)
+                rays = sample_light_source(self.__light_source).rays
+                self.__light_source.set_seed(0) # the shadow4 sources continue the numpy random state
+
+                indices = numpy.flatnonzero(self.__acceptance.is_accepted(rays))
+                if len(indices) > missing_rays: # the rays after the last one needed are not counted
+                    indices    = indices[:missing_rays]
+                    chunk_size = indices[-1] + 1
+
+                accepted_rays.append(rays[indices])
+                self.__accepted_rays  += len(indices)
+                self.__generated_rays += int(chunk_size)
+        finally:
+            self.__light_source.set_seed(seed)
+            self.__light_source.set_nrays(number_of_rays)
+
+        if self.__accepted_rays == 0: raise ValueError("No ray accepted, out of " + str(self.__generated_rays) + " generated")
+
+        beam = S4Beam(N=0)
+        beam.rays = numpy.concatenate(accepted_rays)
+        beam.rays[:, 11] = numpy.arange(1, self.__accepted_rays + 1)
+
+        amplitude_factor = numpy.sqrt(self.efficiency)
+        beam.rays[:, 6:9]   *= amplitude_factor
+        beam.rays[:, 15:18] *= amplitude_factor
+
+        return beam
+
+class RejectionLightSource:
+    '''
+    Light source of the beamline sent with an optimized beam: it carries the acceptance, and get_beam gives the rays
+    of a RejectionSource (number of rays: the accepted ones). The re-generations of the beamline (parallel seeds,
+    pilot traces, beams at the elements) then give rays within the acceptance, as the beam that was sent.
+    '''
+    def __init__(self, light_source, acceptance, max_number_of_rejected_rays=0):
+        self.__light_source                = light_source
+        self.__acceptance                  = acceptance
+        self.__max_number_of_rejected_rays = max_number_of_rejected_rays
+
+    def get_light_source(self):
+        return self.__light_source
+
+    def get_acceptance(self):
+        return self.__acceptance
+
+    def __getattr__(self, name):
+        # the other methods (seed, number of rays, info, ...) are the ones of the light source
+        if name.startswith("_"): raise AttributeError(name)
+
+        return getattr(self.__light_source, name)
+
+    def get_beam(self) -> S4Beam:
+        return RejectionSource(self.__light_source, self.__acceptance, self.__light_source.get_nrays(), self.__max_number_of_rejected_rays).get_beam()
+
+    def to_python_code(self):
+        return "\n# WARNING: the rays of this source are filtered by the source optimization (" + type(self.__acceptance).__name__ + \
+               "), not reproduced by this script\n" + self.__light_source.to_python_code()
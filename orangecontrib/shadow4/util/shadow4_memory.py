@@ -0,0 +1,192 @@
+import os
+import time
+import weakref
+import tempfile
+import numpy
+
+from AnyQt.QtCore import QTimer, QSettings
+
+from shadow4.beam.s4_beam import S4Beam
+
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData, LazyFootprint
+
+#########################################################################################
+# Memory held by the Shadow4 widgets.
+#
+# The widgets keep their input data, the last plotted beams and tickets: in a large workflow this can exhaust the RAM.
+# The registry measures the rays held by every widget and, when a global budget is set, it keeps the resident rays
+# within it, starting from the widgets whose data did not change for the longest time:
+#   1. the computed lazy footprints are released (they are re-traced if asked for again),
+#   2. the input and plotted beams are spilled into a temporary directory: their rays become a copy-on-write memory
+#      map of the file, reloaded transparently (page by page) when they are used (e.g. re-plotted).
+# A beam is spilled in place: the widgets downstream holding the same beam get the memory map too.
+#########################################################################################
+
+class MemoryManager:
+    CHECK_INTERVAL = 2000 # ms
+    SETTINGS_KEY   = "shadow4/memory-budget" # GB, 0: no budget
+
+    REGENERABLE_ATTRIBUTES = ["footprint_beam"]
+    SPILLABLE_ATTRIBUTES   = ["input_data", "input_data_color", "input_beam", "plotted_beam", "footprint_beam"]
+    OTHER_ATTRIBUTES       = ["plotted_ticket", "last_ticket", "cumulated_ticket", "current_histo_data", "last_histo_data"]
+
+    __widgets             = weakref.WeakKeyDictionary() # widget: [fingerprint of the held arrays, time of its last change]
+    __timer               = None
+    __budget              = None
+    __temporary_directory = None
+
+    @classmethod
+    def register(cls, widget):
+        cls.__widgets[widget] = [None, time.monotonic()]
+
+        if cls.__timer is None:
+            cls.__timer = QTimer()
+            cls.__timer.timeout.connect(cls.__on_timeout)
+            cls.__timer.start(cls.CHECK_INTERVAL)
+
+    @classmethod
+    def get_budget(cls):
+        '''
+        :return: budget in bytes, 0 if not set
+        '''
+        if cls.__budget is None: cls.__budget = QSettings().value(cls.SETTINGS_KEY, 0.0, float)
+
+        return int(cls.__budget * 1e9)
+
+    @classmethod
+    def set_budget(cls, budget):
+        '''
+        :param budget: budget in GB, 0 to remove it
+        '''
+        if budget < 0: raise ValueError("Memory budget should be >= 0")
+
+        cls.__budget = float(budget)
+        QSettings().setValue(cls.SETTINGS_KEY, cls.__budget)
+
+        cls.check()
+
+    @classmethod
+    def get_usage(cls):
+        '''
+        :return: list of (widget title, resident bytes, spilled bytes), sorted by resident bytes
+        '''
+        usage = []
+        for widget in list(cls.__widgets.keys()):
+            resident, spilled = cls.__get_bytes(cls.__get_arrays(widget))
+            usage.append((widget.windowTitle(), resident, spilled))
+
+        return sorted(usage, key=lambda item: item[1], reverse=True)
+
+    @classmethod
+    def get_resident_bytes(cls):
+        # the same beam is usually held by several widgets: counted once
+        arrays = []
+        for widget in list(cls.__widgets.keys()): arrays += cls.__get_arrays(widget)
+
+        return cls.__get_bytes(arrays)[0]
+
+    @classmethod
+    def check(cls):
+        now = time.monotonic()
+        for widget, state in list(cls.__widgets.items()):
+            fingerprint = cls.__get_fingerprint(widget)
+            if fingerprint != state[0]: cls.__widgets[widget] = [fingerprint, now]
+
+        budget = cls.get_budget()
+
+        if budget > 0 and cls.get_resident_bytes() > budget:
+            idle_widgets = sorted(cls.__widgets.keys(), key=lambda widget: cls.__widgets[widget][1])
+
+            for free_memory in [cls.__evict, cls.__spill]:
+                for widget in idle_widgets:
+                    free_memory(widget)
+                    cls.__widgets[widget][0] = cls.__get_fingerprint(widget) # not a change of the data
+
+                    if cls.get_resident_bytes() <= budget: return
+
+    @classmethod
+    def __on_timeout(cls):
+        try:
+            cls.check()
+        except Exception as exception:
+            print("Memory check failed: " + str(exception))
+
+    @classmethod
+    def __evict(cls, widget):
+        for attribute in cls.REGENERABLE_ATTRIBUTES:
+            data = getattr(widget, attribute, None)
+
+            if isinstance(data, LazyFootprint): data.release()
+
+    @classmethod
+    def __spill(cls, widget):
+        for attribute in cls.SPILLABLE_ATTRIBUTES:
+            for beam in cls.__get_beams(getattr(widget, attribute, None)): cls.spill_beam(beam)
+
+    @classmethod
+    def spill_beam(cls, beam: S4Beam):
+        rays = getattr(beam, "rays", None)
+
+        if isinstance(rays, numpy.ndarray) and not isinstance(rays, numpy.memmap) and rays.size > 0:
+            if cls.__temporary_directory is None:
+                cls.__temporary_directory = tempfile.TemporaryDirectory(prefix="shadow4_spill_", ignore_cleanup_errors=True)
+
+            file_descriptor, file_name = tempfile.mkstemp(suffix=".npy", dir=cls.__temporary_directory.name)
+            with os.fdopen(file_descriptor, "wb") as file: numpy.save(file, rays)
+
+            beam.rays = numpy.load(file_name, mmap_mode="c")
+            weakref.finalize(beam, cls.__remove_file, file_name)
+
+    @staticmethod
+    def __remove_file(file_name):
+        try:    os.remove(file_name)
+        except: pass # still mapped (Windows): removed with the temporary directory
+
+    @classmethod
+    def __get_fingerprint(cls, widget):
+        return tuple(sorted(id(array) for array in cls.__get_arrays(widget)))
+
+    @classmethod
+    def __get_arrays(cls, widget):
+        arrays = []
+        for attribute in dict.fromkeys(cls.REGENERABLE_ATTRIBUTES + cls.SPILLABLE_ATTRIBUTES + cls.OTHER_ATTRIBUTES):
+            cls.__collect_arrays(getattr(widget, attribute, None), arrays)
+
+        return arrays
+
+    @classmethod
+    def __collect_arrays(cls, data, arrays):
+        if isinstance(data, numpy.ndarray):            arrays.append(data)
+        elif isinstance(data, S4Beam):                 cls.__collect_arrays(getattr(data, "rays", None), arrays)
+        elif isinstance(data, LazyFootprint):
+            if data.is_materialized():                 cls.__collect_arrays(data.materialize(), arrays)
+        elif isinstance(data, ShadowData):
+            cls.__collect_arrays(data.beam, arrays)
+            if not data.is_footprint_lazy():           cls.__collect_arrays(data.footprint, arrays)
+        elif isinstance(data, (list, tuple)):
+            for item in data:                          cls.__collect_arrays(item, arrays)
+        elif isinstance(data, dict):
+            for item in data.values():                 cls.__collect_arrays(item, arrays)
+
+    @classmethod
+    def __get_beams(cls, data):
+        if isinstance(data, S4Beam): return [data]
+        elif isinstance(data, ShadowData):
+            beams = [data.beam]
+            if not data.is_footprint_lazy(): beams += cls.__get_beams(data.footprint)
+            return beams
+        elif isinstance(data, list): return [beam for item in data for beam in cls.__get_beams(item)]
+        else: return []
+
+    @classmethod
+    def __get_bytes(cls, arrays):
+        '''
+        :return: resident bytes, spilled bytes
+        '''
+        resident = {}
+        spilled  = {}
+        for array in arrays:
+            if isinstance(array, numpy.memmap): spilled[id(array)] = array.nbytes
+            else:                               resident[id(array)] = array.nbytes
+
+        return sum(resident.values()), sum(spilled.values())
@@ -3,6 +3,82 @@ import os, copy, numpy
 from shadow4.beam.s4_beam import S4Beam
 from shadow4.beamline.s4_beamline import S4Beamline
 
+class LazyFootprint:
+    '''
+    Footprint of a beamline element, kept as computed by the trace (if given) and, once released, re-computed only
+    when it is asked for: the element (holding its input beam) is re-traced on a copy. It is meant for the
+    deterministic elements (mirrors, gratings, crystals, multilayers), whose re-tracing gives the same rays.
+    '''
+    def __init__(self, beamline_element, footprint: S4Beam=None):
+        self.__beamline_element = beamline_element
+        self.__footprint        = footprint
+
+    def is_materialized(self):
+        return not self.__footprint is None
+
+    def materialize(self):
+        if self.__footprint is None: _, self.__footprint = copy.copy(self.__beamline_element).trace_beam()
+
+        return self.__footprint
+
+    def release(self):
+        self.__footprint = None
+
+    def duplicate(self):
+        return LazyFootprint(self.__beamline_element)
+
+class PersistentBeamline(S4Beamline):
+    '''
+    S4Beamline stored as a persistent linked list of its elements: duplicating it or appending an element costs O(1),
+    and the beamlines derived from the same upstream beamline (one per downstream widget) share its elements instead
+    of deep-copying them.
+
+    The shared elements must not be modified: whoever changes one (e.g. to re-trace it) has to work on a copy.
+    '''
+    def __init__(self, light_source=None, beamline_elements_list=None):
+        self.__last_node = None # (element, previous node)
+        self.__elements  = None # tuple of the elements, built on demand
+        super().__init__(light_source=light_source, beamline_elements_list=beamline_elements_list)
+
+    @property
+    def _beamline_elements_list(self):
+        if self.__elements is None:
+            elements = []
+            node     = self.__last_node
+            while not node is None:
+                elements.append(node[0])
+                node = node[1]
+            self.__elements = tuple(reversed(elements))
+
+        return self.__elements
+
+    @_beamline_elements_list.setter
+    def _beamline_elements_list(self, beamline_elements_list):
+        self.__last_node = None
+        self.__elements  = None
+        for beamline_element in beamline_elements_list: self.__last_node = (beamline_element, self.__last_node)
+
+    def append_beamline_element(self, beamline_element):
+        self.__last_node = (beamline_element, self.__last_node)
+        self.__elements  = None
+
+    def duplicate(self):
+        beamline = PersistentBeamline(light_source=self.get_light_source())
+        beamline.__last_node = self.__last_node
+        beamline.__elements  = self.__elements
+
+        return beamline
+
+    @classmethod
+    def initialize_from_beamline(cls, beamline: S4Beamline):
+        '''
+        Persistent beamline to append the elements to. A S4Beamline is converted once, sharing (not copying) its elements.
+        '''
+        if beamline is None:                           return cls()
+        elif isinstance(beamline, PersistentBeamline): return beamline.duplicate()
+        else:                                          return cls(light_source=beamline.get_light_source(),
+                                                                  beamline_elements_list=list(beamline.get_beamline_elements()))
+
 class ShadowData:
     class ScanningData(object):
         def __init__(self,
@@ -39,11 +115,59 @@ class ShadowData:
         def get_additional_parameter(self, name):
             return self.__additional_parameters[name]
 
+    class RandomStream(object):
+        '''
+        Origin of the source rays of the beam: the rays first_ray_index + 1, ... first_ray_index + number_of_rays
+        of a run of the source with the given seed.
+        spawn_key is the key of the stream in the tree of SeedManager(base_seed), None if the seed was used directly.
+        Seed 0 means continuation of a previous stream: the rays cannot be regenerated by themselves.
+        '''
+        def __init__(self, base_seed, spawn_key, seed, number_of_rays, first_ray_index=0):
+            self.__base_seed       = base_seed
+            self.__spawn_key       = None if spawn_key is None else tuple(spawn_key)
+            self.__seed            = seed
+            self.__number_of_rays  = number_of_rays
+            self.__first_ray_index = first_ray_index
+
+        @property
+        def base_seed(self):
+            return self.__base_seed
+
+        @property
+        def spawn_key(self):
+            return self.__spawn_key
+
+        @property
+        def seed(self):
+            return self.__seed
+
+        @property
+        def number_of_rays(self):
+            return self.__number_of_rays
+
+        @property
+        def first_ray_index(self):
+            return self.__first_ray_index
+
+        def is_regenerable(self):
+            return self.__seed != 0
+
+        def __repr__(self):
+            return "RandomStream(base_seed=%s, spawn_key=%s, seed=%s, number_of_rays=%s, first_ray_index=%s)" % \
+                   (self.__base_seed, self.__spawn_key, self.__seed, self.__number_of_rays, self.__first_ray_index)
+
+    # memory layout of the N x 18 ray arrays: with column-major rays, beam.get_column(col) (col <= 18) is a contiguous
+    # view and reading a few columns (plots, histograms) does not go through the whole array. The display widgets can
+    # retrace on column-major copies ("Rays of the retraced copies", see shadow4_compact.get_beam_copy)
+    ROW_MAJOR    = 0
+    COLUMN_MAJOR = 1
+
     def __init__(self,
                  beam: S4Beam=None,
                  footprint: S4Beam=None,
                  number_of_rays:int=0,
-                 beamline:S4Beamline=None):
+                 beamline:S4Beamline=None,
+                 rays_layout:int=None):
         if (beam is None):
             if number_of_rays > 0: self.__beam = S4Beam(number_of_rays)
             else:                  self.__beam = S4Beam()
@@ -53,9 +177,12 @@ class ShadowData:
             self.__footprint = footprint
 
         self.__scanning_data = None
+        self.__random_stream = None
         self.__initial_flux  = None
         self.__beamline      = beamline  # added by srio
 
+        if not rays_layout is None: self.set_rays_layout(rays_layout)
+
     @property
     def beam(self) -> S4Beam:
         return self.__beam
@@ -66,11 +193,19 @@ class ShadowData:
 
     @property
     def footprint(self) -> S4Beam:
+        if isinstance(self.__footprint, LazyFootprint): self.__footprint = self.__footprint.materialize()
+
         return self.__footprint
 
     @footprint.setter
     def footprint(self, footprint: S4Beam):
-        self._footprint = footprint
+        self.__footprint = footprint
+
+    def has_footprint(self):
+        return not self.__footprint is None
+
+    def is_footprint_lazy(self):
+        return isinstance(self.__footprint, LazyFootprint) and not self.__footprint.is_materialized()
 
     @property
     def beamline(self) -> S4Beamline:
@@ -96,6 +231,14 @@ class ShadowData:
     def scanning_data(self, scanning_data : ScanningData):
         self.__scanning_data = scanning_data
 
+    @property
+    def random_stream(self) -> RandomStream:
+        return self.__random_stream
+
+    @random_stream.setter
+    def random_stream(self, random_stream : RandomStream):
+        self.__random_stream = random_stream
+
     def get_flux(self, nolost=1):
         if not self.__beam is None and not self.__initial_flux is None:
             return (self.__beam.intensity(nolost) / self.get_number_of_rays(0)) * self.get_initial_flux()
@@ -109,6 +252,35 @@ class ShadowData:
         elif nolost == 2: return self.__beam.rays[numpy.where(self.__beam.rays[:, 9] < 0)].shape[0]
         else: raise ValueError("nolost flag value not valid")
 
+    def get_rays_layout(self):
+        rays = getattr(self.__beam, "rays", None)
+
+        if not isinstance(rays, numpy.ndarray) or rays.ndim != 2 or not rays.flags.f_contiguous or rays.flags.c_contiguous: return ShadowData.ROW_MAJOR
+        else:                                                                                                                 return ShadowData.COLUMN_MAJOR
+
+    def set_rays_layout(self, rays_layout):
+        '''
+        Converts the rays of beam and footprint (a copy only if the layout changes). The tools creating new arrays
+        (e.g. S4Beam.append_beam) return row-major rays.
+        '''
+        if rays_layout == ShadowData.COLUMN_MAJOR:  convert = numpy.asfortranarray
+        elif rays_layout == ShadowData.ROW_MAJOR:   convert = numpy.ascontiguousarray
+        else: raise ValueError("Rays layout not valid")
+
+        footprints = self.__footprint if isinstance(self.__footprint, list) else [self.__footprint]
+
+        for beam in [self.__beam] + footprints:
+            if isinstance(beam, S4Beam) and isinstance(getattr(beam, "rays", None), numpy.ndarray): beam.rays = convert(beam.rays)
+
+    def __reduce_ex__(self, protocol):
+        # protocol 5: out-of-band rays and beamline by version (see shadow4_transport)
+        if protocol >= 5:
+            from orangecontrib.shadow4.util.shadow4_transport import ShadowDataPickler
+
+            return ShadowDataPickler.reduce(self)
+        else:
+            return super().__reduce_ex__(protocol)
+
     def load_from_file(self, file_name):
         if not self.__beam is None:
             if os.path.exists(file_name): self.__beam.load_h5(file_name)
@@ -122,10 +294,13 @@ class ShadowData:
         beam      = S4Beam()
         footprint = None if self.__footprint is None else S4Beam()
 
+        # not computed yet: the copy re-traces on its own, if ever asked for
+        if self.is_footprint_lazy(): footprint = self.__footprint.duplicate()
+
         if copy_rays:
             beam.rays = copy.deepcopy(self.beam.rays)
             beam._N_cleaned = self.beam._N_cleaned
-            if not self.footprint is None:
+            if not self.is_footprint_lazy() and not self.footprint is None:
                 if isinstance(self.footprint, S4Beam):
                     footprint = S4Beam()
                     footprint.rays = copy.deepcopy(self.footprint.rays)
@@ -145,6 +320,7 @@ class ShadowData:
                                      footprint=footprint)
 
         new_shadow_beam.scanning_data = self.__scanning_data
+        new_shadow_beam.random_stream = self.__random_stream
         new_shadow_beam.initial_flux  = self.__initial_flux
 
         if copy_beamline: new_shadow_beam.beamline = self.__beamline.duplicate()
@@ -157,7 +333,7 @@ class ShadowData:
             data_1: ShadowData = data_1
             data_2: ShadowData = data_2
 
-            has_footprint = not (data_1.footprint is None or data_2.footprint is None)
+            has_footprint = data_1.has_footprint() and data_2.has_footprint()
 
             rays_1 = None
             rays_2 = None
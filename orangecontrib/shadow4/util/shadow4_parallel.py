@@ -0,0 +1,262 @@
+import os
+import copy
+import numpy
+import threading
+import itertools
+import multiprocessing
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from shadow4.beamline.s4_beamline import S4Beamline
+
+MAXIMUM_SEED = 2**31 - 1
+
+class SeedManager:
+    '''
+    Tree of independent random streams, from numpy.random.SeedSequence(base_seed) and its spawned children: the stream
+    with spawn key (i, j, ...) is the j-th child of the i-th child of the root (e.g. iteration i of a loop, chunk or
+    worker j). Any stream is computed directly from its key, so it can be regenerated by itself.
+
+    The shadow4 sources take an integer seed: every stream gives the seed of one run of a source, reproducible and
+    never 0 (0 means "do not seed" for the shadow4 sources).
+    '''
+    def __init__(self, base_seed):
+        self.__base_seed = int(base_seed)
+
+    @property
+    def base_seed(self):
+        return self.__base_seed
+
+    def get_seed(self, *spawn_key):
+        seed_sequence = numpy.random.SeedSequence(entropy=self.__base_seed, spawn_key=tuple(int(child) for child in spawn_key))
+
+        return int(seed_sequence.generate_state(1, dtype=numpy.uint32)[0] % (MAXIMUM_SEED - 1)) + 1
+
+    def spawn_seeds(self, number_of_seeds, parent_key=(), first_child=0):
+        return [self.get_seed(*parent_key, child) for child in range(first_child, first_child + number_of_seeds)]
+
+def spawn_seeds(base_seed, number_of_seeds, first_child=0):
+    '''
+    Independent, reproducible integer seeds for the shadow4 light sources: the first level of SeedManager(base_seed).
+    '''
+    return SeedManager(base_seed).spawn_seeds(number_of_seeds, first_child=first_child)
+
+def check_beamline_for_seeds(beamline: S4Beamline):
+    if beamline is None: raise ValueError("No beamline available in Shadow Data")
+
+    light_source = beamline.get_light_source()
+
+    if light_source is None:
+        raise ValueError("No light source in beamline")
+    if not (hasattr(light_source, "get_seed") and hasattr(light_source, "set_seed")):
+        raise ValueError("Light source " + type(light_source).__name__ + " does not accept a Monte Carlo seed")
+
+def get_beamline_without_beams(beamline: S4Beamline):
+    '''
+    Copy of the beamline sharing the light source and the optical elements, but without the input beams stored
+    in the beamline elements: it is what is needed to re-trace the beamline, and it is cheap to send to other processes.
+    '''
+    beamline_without_beams = S4Beamline(light_source=beamline.get_light_source())
+
+    for index in range(beamline.get_beamline_elements_number()):
+        element = copy.copy(beamline.get_beamline_element_at(index))
+        element.set_input_beam(None)
+        beamline_without_beams.append_beamline_element(element)
+
+    return beamline_without_beams
+
+def trace_beamline_with_seed(beamline: S4Beamline, seed, number_of_rays=None):
+    '''
+    Regenerates the source of the beamline with the given seed and traces all the beamline elements.
+    The beamline is not modified (the tracing works on a copy).
+
+    :return: seed, output beam of the last element, footprint of the last element
+    '''
+    beamline     = copy.deepcopy(beamline)
+    light_source = beamline.get_light_source()
+
+    light_source.set_seed(seed)
+    if not number_of_rays is None: light_source.set_nrays(int(number_of_rays))
+
+    beam      = light_source.get_beam()
+    footprint = None
+
+    for index in range(beamline.get_beamline_elements_number()):
+        element = beamline.get_beamline_element_at(index)
+        element.set_input_beam(beam)
+        beam, footprint = element.trace_beam()
+
+    return seed, beam, footprint
+
+def trace_packed_beamline_with_seed(packed_beamline, seed, number_of_rays=None):
+    '''
+    As trace_beamline_with_seed, on a beamline packed by BeamlineCache: it is unpickled only once in every worker.
+
+    :return: seed, ShadowData with output beam and footprint of the last element (without beamline)
+    '''
+    from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+    from orangecontrib.shadow4.util.shadow4_transport import BeamlineCache
+
+    seed, beam, footprint = trace_beamline_with_seed(BeamlineCache.unpack(*packed_beamline), seed, number_of_rays)
+
+    return seed, ShadowData(beam=beam, footprint=footprint)
+
+def get_number_of_workers(number_of_workers=0):
+    if number_of_workers is None or number_of_workers <= 0: return max(1, os.cpu_count() or 1)
+    else:                                                   return int(number_of_workers)
+
+class ParallelSeedTracer:
+    '''
+    Traces a beamline with several seeds in worker processes.
+    Results are returned in the order of the seeds, each one as soon as it and all the previous ones are done.
+
+    At most maximum_in_flight seeds (default: twice the number of workers) are submitted and not yet consumed: the
+    workers trace the next seeds while the caller processes the current result, and a slow caller does not pile up
+    beams in memory.
+
+    The beamline is pickled once for all the seeds (BeamlineCache), the results come back as Shadow Data (out-of-band
+    rays where the result pipe pickles with protocol 5).
+    '''
+    def __init__(self, number_of_workers=0, maximum_in_flight=0):
+        self.__number_of_workers = get_number_of_workers(number_of_workers)
+        self.__maximum_in_flight = 2*self.__number_of_workers if maximum_in_flight is None or maximum_in_flight <= 0 else int(maximum_in_flight)
+
+    @property
+    def number_of_workers(self):
+        return self.__number_of_workers
+
+    def trace(self, beamline: S4Beamline, seeds, number_of_rays=None):
+        check_beamline_for_seeds(beamline)
+
+        if self.__number_of_workers == 1 or len(seeds) == 1:
+            beamline = get_beamline_without_beams(beamline)
+
+            for seed in seeds: yield trace_beamline_with_seed(beamline, seed, number_of_rays)
+        else:
+            from orangecontrib.shadow4.util.shadow4_transport import BeamlineCache
+
+            packed_beamline = BeamlineCache.pack(beamline)
+
+            # spawn: forking a process holding the Qt event loop is not safe
+            executor = ProcessPoolExecutor(max_workers=min(self.__number_of_workers, len(seeds)),
+                                           mp_context=multiprocessing.get_context("spawn"))
+
+            futures = deque()
+            try:
+                seeds = iter(seeds)
+
+                for seed in itertools.islice(seeds, self.__maximum_in_flight):
+                    futures.append(executor.submit(trace_packed_beamline_with_seed, packed_beamline, seed, number_of_rays))
+
+                while len(futures) > 0:
+                    seed, shadow_data = futures.popleft().result()
+
+                    next_seed = next(seeds, None)
+                    if not next_seed is None: futures.append(executor.submit(trace_packed_beamline_with_seed, packed_beamline, next_seed, number_of_rays))
+
+                    yield seed, shadow_data.beam, shadow_data.footprint
+            finally:
+                executor.shutdown(wait=False, cancel_futures=True)
+
+def trace_element_on_shared_beam(element, beam_handle):
+    '''
+    Traces a beamline element on the read-only input beam shared by SharedBeam.
+
+    :return: traced element (without input beam), ShadowData with the output beam and the footprint
+    '''
+    from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+    from orangecontrib.shadow4.util.shadow4_transport import SharedBeam
+
+    def trace(input_beam):
+        element.set_input_beam(input_beam)
+        try:    return element.trace_beam()
+        finally: element.set_input_beam(None)
+
+    beam, footprint = SharedBeam.read_beam(beam_handle, trace)
+
+    return element, ShadowData(beam=beam, footprint=footprint)
+
+class ParallelScanTracer:
+    '''
+    Traces the beamline elements built for the values of a scan, all on the same input beam, in worker processes.
+    The input beam is copied once in shared memory and read there by the workers, the results come back as Shadow Data.
+
+    The results are taken in the order of the elements with get_next_result, at most maximum_in_flight elements
+    (default: twice the number of workers) being traced and not yet taken. close() has to be called when the
+    scan is over or abandoned.
+    '''
+    def __init__(self, input_beam, elements, number_of_workers=0, maximum_in_flight=0):
+        self.__input_beam        = input_beam
+        self.__elements          = iter(elements)
+        self.__number_of_workers = min(get_number_of_workers(number_of_workers), max(1, len(elements)))
+        self.__maximum_in_flight = 2*self.__number_of_workers if maximum_in_flight is None or maximum_in_flight <= 0 else int(maximum_in_flight)
+        self.__next_index        = 0
+        self.__futures           = deque()
+        self.__executor          = None
+        self.__shared_beam       = None
+
+        if self.__number_of_workers > 1:
+            from orangecontrib.shadow4.util.shadow4_transport import SharedBeam
+
+            self.__shared_beam = SharedBeam(input_beam)
+            # spawn: forking a process holding the Qt event loop is not safe
+            self.__executor    = ProcessPoolExecutor(max_workers=self.__number_of_workers, mp_context=multiprocessing.get_context("spawn"))
+
+            self.__submit()
+
+    @property
+    def number_of_workers(self):
+        return self.__number_of_workers
+
+    @property
+    def next_index(self):
+        return self.__next_index
+
+    def __submit(self):
+        for element in self.__elements:
+            self.__futures.append(self.__executor.submit(trace_element_on_shared_beam, element, self.__shared_beam.handle))
+            if len(self.__futures) == self.__maximum_in_flight: break
+
+    def get_next_result(self):
+        '''
+        :return: traced element (without input beam), output beam, footprint
+        '''
+        if self.__executor is None:
+            element = next(self.__elements)
+            element.set_input_beam(self.__input_beam)
+            beam, footprint = element.trace_beam()
+            element.set_input_beam(None)
+        else:
+            if len(self.__futures) == 0: raise StopIteration()
+
+            element, shadow_data = self.__futures.popleft().result()
+            self.__submit()
+
+            beam, footprint = shadow_data.beam, shadow_data.footprint
+
+        self.__next_index += 1
+
+        return element, beam, footprint
+
+    def close(self):
+        if not self.__executor is None:
+            futures     = list(self.__futures)
+            shared_beam = self.__shared_beam
+            lock        = threading.Lock()
+            remaining   = [len(futures)]
+
+            # the input beam is released when no worker can be reading it
+            def release(future):
+                with lock:
+                    remaining[0] -= 1
+                    if remaining[0] == 0: shared_beam.release()
+
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            self.__executor    = None
+            self.__shared_beam = None
+            self.__futures.clear()
+
+            if len(futures) == 0: shared_beam.release()
+            else:
+                for future in futures: future.add_done_callback(release)
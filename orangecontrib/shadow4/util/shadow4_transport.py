@@ -0,0 +1,192 @@
+import uuid
+import pickle
+import weakref
+import numpy
+
+from collections import OrderedDict
+from multiprocessing import shared_memory
+
+from shadow4.beam.s4_beam import S4Beam
+from shadow4.beamline.s4_beamline import S4Beamline
+
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+from orangecontrib.shadow4.util.shadow4_parallel import get_beamline_without_beams
+
+#########################################################################################
+# Transport of Shadow Data between processes.
+#
+# The ray arrays are the bulk of the data: with pickle protocol 5 they travel as out-of-band buffers (no copies into
+# the pickle stream), and a beam read by many processes is left in a shared memory block (only its name travels).
+# The beamline travels separately, without the input beams stored in its elements: it is pickled only once for
+# each version and unpickled only once in every process.
+#
+# The worker processes are spawned by the main process and share its resource tracker: a shared memory block is
+# registered (once) by whoever creates or opens it, and unregistered by the unlink of its owner.
+#########################################################################################
+
+PICKLE_PROTOCOL = 5
+
+def get_beam_on_rays(rays, N_cleaned=None) -> S4Beam:
+    '''
+    Beam using the given array as rays (S4Beam(array=...) copies the array).
+    '''
+    beam = S4Beam(N=0)
+    beam.rays       = rays
+    beam._N_cleaned = N_cleaned
+
+    return beam
+
+class BeamlineCache:
+    '''
+    Beamlines (without input beams) by version. A beamline gets its version (unique to the object) the first time it
+    is packed, and its pickled bytes are kept with it: the beamlines are not modified once sent downstream, a new
+    beamline is built by every trace.
+    '''
+    MAXIMUM_SIZE = 16
+
+    __versions  = weakref.WeakKeyDictionary() # beamline -> version
+    __packed    = OrderedDict() # version -> pickled beamline, in the sending process
+    __beamlines = OrderedDict() # version -> beamline, in the receiving process
+
+    @classmethod
+    def get_version(cls, beamline: S4Beamline):
+        version = cls.__versions.get(beamline, None)
+        if version is None: version = cls.__versions[beamline] = uuid.uuid4().hex
+
+        return version
+
+    @classmethod
+    def pack(cls, beamline: S4Beamline):
+        '''
+        :return: version, pickled beamline
+        '''
+        version = cls.get_version(beamline)
+
+        data = cls.__packed.get(version, None)
+        if data is None:
+            data = pickle.dumps(get_beamline_without_beams(beamline), protocol=PICKLE_PROTOCOL)
+            cls.__packed[version] = data
+            if len(cls.__packed) > cls.MAXIMUM_SIZE: cls.__packed.popitem(last=False)
+        else:
+            cls.__packed.move_to_end(version)
+
+        return version, data
+
+    @classmethod
+    def unpack(cls, version, data) -> S4Beamline:
+        beamline = cls.__beamlines.get(version, None)
+
+        if beamline is None:
+            beamline = pickle.loads(data)
+            cls.__beamlines[version] = beamline
+            if len(cls.__beamlines) > cls.MAXIMUM_SIZE: cls.__beamlines.popitem(last=False)
+        else:
+            cls.__beamlines.move_to_end(version)
+
+        return beamline
+
+    @classmethod
+    def clear(cls):
+        cls.__packed.clear()
+        cls.__beamlines.clear()
+
+class ShadowDataPickler:
+    '''
+    Pickling of the Shadow Data with protocol 5 (ShadowData.__reduce_ex__): the ray arrays are out-of-band buffers,
+    not copied into the pickled bytes, and the beamline travels by version (BeamlineCache).
+    '''
+    @classmethod
+    def reduce(cls, shadow_data: ShadowData):
+        return cls.from_state, (cls.__get_state(shadow_data),)
+
+    @classmethod
+    def __get_state(cls, shadow_data: ShadowData):
+        footprint = shadow_data.footprint
+
+        return {
+            "beam"          : cls.__get_beam_state(shadow_data.beam),
+            "footprint"     : [cls.__get_beam_state(fp) for fp in footprint] if isinstance(footprint, list) else cls.__get_beam_state(footprint),
+            "initial_flux"  : shadow_data.initial_flux,
+            "scanning_data" : shadow_data.scanning_data,
+            "random_stream" : shadow_data.random_stream,
+            "beamline"      : None if shadow_data.beamline is None else BeamlineCache.pack(shadow_data.beamline),
+        }
+
+    @classmethod
+    def __get_beam_state(cls, beam: S4Beam):
+        if beam is None: return None
+        else:            return (pickle.PickleBuffer(numpy.ascontiguousarray(beam.rays, dtype=numpy.float64)), beam.rays.shape, beam._N_cleaned)
+
+    @classmethod
+    def from_state(cls, state) -> ShadowData:
+        footprint = state["footprint"]
+
+        shadow_data = ShadowData(beam=cls.__beam_from_state(state["beam"]),
+                                 footprint=[cls.__beam_from_state(fp) for fp in footprint] if isinstance(footprint, list) else cls.__beam_from_state(footprint),
+                                 beamline=None if state["beamline"] is None else BeamlineCache.unpack(*state["beamline"]))
+        shadow_data.initial_flux  = state["initial_flux"]
+        shadow_data.scanning_data = state["scanning_data"]
+        shadow_data.random_stream = state["random_stream"]
+
+        return shadow_data
+
+    @classmethod
+    def __beam_from_state(cls, beam_state):
+        if beam_state is None: return None
+
+        buffer, shape, N_cleaned = beam_state
+
+        # the beams are built on the received buffers without copies (read-only buffers are copied, since the beams
+        # are modified in place by the tools)
+        rays = numpy.frombuffer(buffer, dtype=numpy.float64).reshape(shape)
+        if not rays.flags.writeable: rays = rays.copy()
+
+        return get_beam_on_rays(rays, N_cleaned)
+
+class SharedBeam:
+    '''
+    Beam copied once into a shared memory block and read by any number of processes, e.g. the input beam of all the
+    values of a scan. Only the handle travels; the owner releases the block when the readers are done.
+    '''
+    def __init__(self, beam: S4Beam):
+        rays = beam.rays
+
+        self.__block = shared_memory.SharedMemory(create=True, size=max(1, rays.nbytes))
+        numpy.ndarray(rays.shape, dtype=numpy.float64, buffer=self.__block.buf)[:] = rays
+
+        self.__handle = (self.__block.name, rays.shape, beam._N_cleaned)
+
+    @property
+    def handle(self):
+        return self.__handle
+
+    @staticmethod
+    def read_beam(handle, function):
+        '''
+        Calls function(beam) with a read-only beam built on the shared rays, without copies (the shadow4 beamline
+        elements trace a duplicate of their input beam), and closes the block after the call: the function must not
+        keep the beam.
+
+        :return: result of the function
+        '''
+        name, shape, N_cleaned = handle
+
+        block = shared_memory.SharedMemory(name=name, create=False)
+        try:
+            rays = numpy.ndarray(shape, dtype=numpy.float64, buffer=block.buf)
+            rays.flags.writeable = False
+
+            return function(get_beam_on_rays(rays, N_cleaned))
+        finally:
+            rays = None
+            try:
+                block.close()
+            except BufferError:
+                # the beam was kept: the block is unmapped with its last view
+                pass
+
+    def release(self):
+        if not self.__block is None:
+            self.__block.close()
+            self.__block.unlink()
+            self.__block = None
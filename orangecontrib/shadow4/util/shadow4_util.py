@@ -1350,7 +1350,13 @@ class TriggerToolsDecorator(object):
     def set_trigger_parameters_for_sources(self, trigger):
         if trigger and trigger.new_object == True:
             if trigger.has_additional_parameter("seed_increment"):
-                self.seed += trigger.get_additional_parameter("seed_increment")
+                seed_increment = trigger.get_additional_parameter("seed_increment")
+
+                if getattr(self, "independent_streams", 0) == 1: # stream of the tree of this iteration, from the first one of the loop
+                    if trigger.has_additional_parameter("seed_loop_iteration"): self.run_index  = trigger.get_additional_parameter("seed_loop_iteration") * seed_increment
+                    else:                                                        self.run_index += seed_increment
+                else:
+                    self.seed += seed_increment
 
             if trigger.has_additional_parameter("variable_name"):
                 variable_name         = trigger.get_additional_parameter("variable_name").strip()
@@ -1358,25 +1364,7 @@ class TriggerToolsDecorator(object):
                 variable_value        = trigger.get_additional_parameter("variable_value")
                 variable_um           = trigger.get_additional_parameter("variable_um")
 
-                def check_number(x):
-                    try:    return float(x)
-                    except: return x
-
-                if "," in variable_name:
-                    variable_names = variable_name.split(",")
-
-                    if isinstance(variable_value, str) and "," in variable_value:
-                        variable_values = variable_value.split(",")
-                        for variable_name, variable_value in zip(variable_names, variable_values):
-                            setattr(self, variable_name.strip(), check_number(variable_value))
-                            self.check_options(variable_name)
-                    else:
-                        for variable_name in variable_names:
-                            setattr(self, variable_name.strip(), check_number(variable_value))
-                            self.check_options(variable_name)
-                else:
-                    setattr(self, variable_name, check_number(variable_value))
-                    self.check_options(variable_name)
+                variable_name, variable_value = self.set_scanned_variable(variable_name, variable_value)
 
                 scanning_data = ShadowData.ScanningData(variable_name, variable_value, variable_display_name, variable_um)
             else:
@@ -1384,6 +1372,34 @@ class TriggerToolsDecorator(object):
 
             self.run_shadow4(scanning_data=scanning_data)
 
+    def set_scanned_variable(self, variable_name, variable_value):
+        '''
+        Sets the scanned variable(s): comma separated names take the same value or the comma separated values.
+
+        :return: the (last) name and value set
+        '''
+        def check_number(x):
+            try:    return float(x)
+            except: return x
+
+        if "," in variable_name:
+            variable_names = variable_name.split(",")
+
+            if isinstance(variable_value, str) and "," in variable_value:
+                variable_values = variable_value.split(",")
+                for variable_name, variable_value in zip(variable_names, variable_values):
+                    setattr(self, variable_name.strip(), check_number(variable_value))
+                    self.check_options(variable_name)
+            else:
+                for variable_name in variable_names:
+                    setattr(self, variable_name.strip(), check_number(variable_value))
+                    self.check_options(variable_name)
+        else:
+            setattr(self, variable_name, check_number(variable_value))
+            self.check_options(variable_name)
+
+        return variable_name, variable_value
+
     def check_options(self, variable_name):
         pass
 
@@ -1396,32 +1412,145 @@ class TriggerToolsDecorator(object):
                     variable_value        = trigger.get_additional_parameter("variable_value")
                     variable_um           = trigger.get_additional_parameter("variable_um")
 
-                    def check_number(x):
-                        try:    return float(x)
-                        except: return x
+                    scanned_variable_name, scanned_variable_value = self.set_scanned_variable(variable_name, variable_value)
 
-                    if "," in variable_name:
-                        variable_names = variable_name.split(",")
+                    scanning_data = ShadowData.ScanningData(scanned_variable_name, scanned_variable_value, variable_display_name, variable_um)
 
-                        if isinstance(variable_value, str) and "," in variable_value:
-                            variable_values = variable_value.split(",")
-                            for variable_name, variable_value in zip(variable_names, variable_values):
-                                setattr(self, variable_name.strip(), check_number(variable_value))
-                                self.check_options(variable_name)
-                        else:
-                            for variable_name in variable_names:
-                                setattr(self, variable_name.strip(), check_number(variable_value))
-                                self.check_options(variable_name)
-                    else:
-                        setattr(self, variable_name, check_number(variable_value))
-                        self.check_options(variable_name)
-
-                    scanning_data = ShadowData.ScanningData(variable_name, variable_value, variable_display_name, variable_um)
+                    if variable_name in self.get_drift_variables():
+                        self.run_shadow4_with_drift(scanning_data)
+                        return
+                    elif trigger.has_additional_parameter("variable_values"): # batch scan: all the values are known
+                        self.run_shadow4_in_batch(scanning_data,
+                                                  variable_name,
+                                                  trigger.get_additional_parameter("variable_values"),
+                                                  trigger.get_additional_parameter("variable_index"),
+                                                  trigger.get_additional_parameter("number_of_workers") if trigger.has_additional_parameter("number_of_workers") else 0)
+                        return
                 else:
                     scanning_data = None
 
                 self.run_shadow4(scanning_data=scanning_data)
 
+    def get_drift_variables(self):
+        '''
+        Variables changing only a drift in vacuum after the element: their scans do not need a new trace.
+        '''
+        return []
+
+    def run_shadow4_with_drift(self, scanning_data):
+        self.run_shadow4(scanning_data=scanning_data)
+
+    def run_shadow4_in_batch(self, scanning_data, variable_name, variable_values, variable_index, number_of_workers=0):
+        '''
+        Run for the value variable_values[variable_index] of a batch scan (already set), the other values being
+        known in advance: by default the values are run one by one.
+        '''
+        self.run_shadow4(scanning_data=scanning_data)
+
+from orangewidget import gui as orangegui
+from orangecontrib.shadow4.util.shadow4_loops import ChunkedSource
+from orangecontrib.shadow4.util.shadow4_parallel import SeedManager
+
+class ChunkedSourceDecorator(object):
+    '''
+    Chunked generation of the rays in the source widgets: the rays are sampled and sent downstream in chunks of fixed
+    size, and every plain Trigger received (new object, without seed increment or scanned variable) sends the next
+    chunk, until the total number of rays is reached. A Trigger received after the last chunk sends an interrupting
+    Trigger on the output and the next run starts a new stream. The chunks are asked for by the OASYS Loop Point:
+
+        Loop Point (Trigger Out) -> Source (Trigger) -> ... -> Beam Accumulating Point (Shadow Data)
+        Beam Accumulating Point (Trigger) -> Loop Point (Trigger In)
+        Source (Trigger) -> Beam Accumulating Point (Trigger): the end of the stream closes the accumulation
+
+    with at least as many new objects in the Loop Point as chunks. In a Seed Loop or a Scan Loop every iteration would
+    start a new stream and send only its first chunk: there the chunked generation is rejected.
+    To be listed before TriggerToolsDecorator in the base classes.
+
+    With independent streams, the seed is the root of a SeedManager tree: the run i of a seed loop uses the stream (i,)
+    instead of seed + increment, and its chunk j the stream (i, j). The stream of the rays is recorded in ShadowData.
+    The index of the run (setting run_index of the widget) is set by the seed loop, and restarts with every loop.
+    '''
+    chunked_source        = None
+    chunked_scanning_data = None
+    random_stream         = None
+
+    def add_chunked_generation_fields(self, parent_box, labelWidth=250):
+        orangegui.comboBox(parent_box, self, "independent_streams", label="Random streams", labelWidth=labelWidth,
+                           items=["Seed (+ increment in loops)", "Independent (seed tree)"], sendSelectedValue=False, orientation="horizontal", callback=self.set_independent_streams)
+
+        self.run_index_box = gui.widgetBox(parent_box, "", addSpace=False, orientation="vertical")
+        le_run_index = gui.lineEdit(self.run_index_box, self, "run_index", "Run index (stream of the tree)", labelWidth=labelWidth, valueType=int, orientation="horizontal")
+        le_run_index.setReadOnly(True)
+
+        orangegui.comboBox(parent_box, self, "chunked_generation", label="Generate rays in chunks", labelWidth=labelWidth,
+                           items=["No", "Yes"], sendSelectedValue=False, orientation="horizontal", callback=self.set_chunked_generation)
+
+        self.chunk_size_box = gui.widgetBox(parent_box, "", addSpace=False, orientation="vertical")
+        gui.lineEdit(self.chunk_size_box, self, "chunk_size", "Rays per chunk", labelWidth=labelWidth, valueType=int, orientation="horizontal")
+
+        self.set_independent_streams()
+        self.set_chunked_generation()
+
+    def set_independent_streams(self):
+        self.run_index_box.setVisible(self.independent_streams == 1)
+
+    def set_chunked_generation(self):
+        self.chunk_size_box.setVisible(self.chunked_generation == 1)
+
+    def check_chunked_generation(self):
+        if self.chunked_generation == 1: self.chunk_size = congruence.checkStrictlyPositiveNumber(self.chunk_size, "Rays per chunk")
+
+    def set_random_stream(self, light_source):
+        '''
+        Seed of the current run, to be set before writing the script of the light source.
+        '''
+        if self.independent_streams == 1: light_source.set_seed(SeedManager(self.seed).get_seed(self.run_index))
+
+    def get_beam_from_light_source(self, light_source, scanning_data=None):
+        if getattr(self, "_next_chunk_requested", False):
+            self._next_chunk_requested = False
+        elif self.chunked_generation == 1:
+            if self.independent_streams == 1: self.chunked_source = ChunkedSource(light_source, self.number_of_rays, self.chunk_size, SeedManager(self.seed), (self.run_index,))
+            else:                             self.chunked_source = ChunkedSource(light_source, self.number_of_rays, self.chunk_size)
+            self.chunked_scanning_data  = scanning_data
+        else:
+            self.chunked_source = None
+
+        if self.chunked_source is None:
+            beam = light_source.get_beam()
+
+            if self.independent_streams == 1: self.random_stream = ShadowData.RandomStream(self.seed, (self.run_index,), light_source.get_seed(), light_source.get_nrays())
+            else:                             self.random_stream = ShadowData.RandomStream(self.seed, None, light_source.get_seed(), light_source.get_nrays())
+
+            return beam
+        else:
+            beam = self.chunked_source.get_next_beam()
+            self.random_stream = self.chunked_source.get_random_stream()
+            print("***** chunk %d of %d, %d rays generated" % (self.chunked_source.chunk_index, self.chunked_source.number_of_chunks, self.chunked_source.generated_rays))
+            return beam
+
+    def set_trigger_parameters_for_sources(self, trigger):
+        is_loop_trigger = trigger and trigger.new_object == True and \
+                          (trigger.has_additional_parameter("seed_increment") or trigger.has_additional_parameter("variable_name"))
+
+        if is_loop_trigger and self.chunked_generation == 1:
+            self.chunked_source = None
+            self.prompt_exception(ValueError("Chunked generation is not available in a Seed Loop or a Scan Loop: the chunks are asked for by a Loop Point"))
+        elif trigger and trigger.new_object == True and not self.chunked_source is None and not is_loop_trigger:
+            if self.chunked_source.is_completed():
+                # the loop asking for more rays would wait forever: it is told that the stream is over, and the
+                # next run starts a new stream
+                print("***** all the chunks have been sent")
+                self.chunked_source = None
+                self.setStatusMessage("All the chunks have been sent")
+                self.Outputs.trigger.send(TriggerIn(interrupt=True))
+            else:
+                self._next_chunk_requested = True
+                try:     self.run_shadow4(scanning_data=self.chunked_scanning_data)
+                finally: self._next_chunk_requested = False
+        else:
+            super().set_trigger_parameters_for_sources(trigger)
+
 class Properties(object):
     def __init__(self, props=None):
         self._props = {}
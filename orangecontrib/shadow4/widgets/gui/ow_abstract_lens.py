@@ -203,6 +203,8 @@ class OWAbstractLens(OWOpticalElement):
     # ----------------------------------------------------
     # from OpticalElement
 
+    def get_drift_variables(self): return [] # the image space can be a medium (refraction index, absorption): not a drift in vacuum
+
     def get_coordinates_instance(self):
         return ElementCoordinates(
                 p=self.source_plane_distance,
@@ -10,6 +10,8 @@ from AnyQt.QtCore import QRect
 import oasys2.widget.gui as oasysgui
 from oasys2.widget.gui import ConfirmDialog, MessageDialog
 
+from orangecontrib.shadow4.util.shadow4_memory import MemoryManager
+
 class AutomaticElement(OWWidget):
     want_main_area = 1
     is_automatic_run = Setting(True)
@@ -38,6 +40,8 @@ class AutomaticElement(OWWidget):
         else:
             self.TABS_AREA_HEIGHT = 615
 
+        MemoryManager.register(self)
+
     def call_reset_settings(self):
         if ConfirmDialog.confirmed(parent=self, message="Confirm Reset of the Fields?"):
             try:    self._reset_settings()
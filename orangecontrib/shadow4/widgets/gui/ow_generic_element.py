@@ -8,7 +8,7 @@ from oasys2.widget.util.widget_objects import TriggerIn
 
 from shadow4.beam.s4_beam import S4Beam
 from orangecontrib.shadow4.widgets.gui.ow_automatic_element import AutomaticElement
-from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData, LazyFootprint
 from orangecontrib.shadow4.util.shadow4_util import ShadowPlot, ShadowCongruence
 from orangecontrib.shadow4.util.python_script import PythonScript
 
@@ -55,6 +55,8 @@ class GenericElement(AutomaticElement):
 
         self._initialize_tabs()
 
+        self.tabs.currentChanged.connect(self.__on_tab_changed)
+
         self.shadow_output = oasysgui.textArea(height=580, width=800)
 
         out_box = gui.widgetBox(out_tab, "System Output", addSpace=True, orientation="horizontal")
@@ -177,7 +179,7 @@ class GenericElement(AutomaticElement):
                         self._plot_xy_preview(output_beam, progressBarValue + 12, variables[2][0], variables[2][1], plot_canvas_index=2, title=titles[2], xtitle=xtitles[2], ytitle=ytitles[2])
                         self._plot_xy_preview(output_beam, progressBarValue + 16, variables[3][0], variables[3][1], plot_canvas_index=3, title=titles[3], xtitle=xtitles[3], ytitle=ytitles[3])
                         self._plot_histo_preview(output_beam, progressBarValue + 20, variables[4], plot_canvas_index=4, title=titles[4], xtitle=xtitles[4], ytitle=ytitles[4])
-                        if self.has_footprint: self._plot_xy_preview(footprint, progressBarValue + 20, 2, 1, plot_canvas_index=5, title="Footprint", xtitle="Y [m]", ytitle="X [m]", is_footprint=True)
+                        if self.__is_footprint_to_plot(footprint): self._plot_footprint(footprint, progressBarValue + 20)
 
                     elif self.view_type == 0:
                         self._plot_xy_detailed(output_beam, progressBarValue + 4, variables[0][0], variables[0][1], plot_canvas_index=0, title=titles[0], xtitle=xtitles[0], ytitle=ytitles[0], xum=xums[0], yum=yums[0])
@@ -185,7 +187,7 @@ class GenericElement(AutomaticElement):
                         self._plot_xy_detailed(output_beam, progressBarValue + 12, variables[2][0], variables[2][1], plot_canvas_index=2, title=titles[2], xtitle=xtitles[2], ytitle=ytitles[2], xum=xums[2], yum=yums[2])
                         self._plot_xy_detailed(output_beam, progressBarValue + 16, variables[3][0], variables[3][1], plot_canvas_index=3, title=titles[3], xtitle=xtitles[3], ytitle=ytitles[3], xum=xums[3], yum=yums[3])
                         self._plot_histo_detailed(output_beam, progressBarValue + 20, variables[4], plot_canvas_index=4, title=titles[4], xtitle=xtitles[4], ytitle=ytitles[4], xum=xums[4])
-                        if self.has_footprint: self._plot_xy_detailed(footprint, progressBarValue + 20, 2, 1, plot_canvas_index=5, title="Footprint", xtitle="Y [m]", ytitle="X [m]", xum=("Y [m]"), yum=("X [m]"), is_footprint=True)
+                        if self.__is_footprint_to_plot(footprint): self._plot_footprint(footprint, progressBarValue + 20)
 
                 except Exception as e:
                     self.view_type_combo.setEnabled(True)
@@ -199,6 +201,32 @@ class GenericElement(AutomaticElement):
         self.plotted_beam   = output_beam
         self.footprint_beam = footprint
 
+    def _plot_footprint(self, footprint, progressBarValue):
+        if isinstance(footprint, LazyFootprint): footprint = footprint.materialize()
+
+        if self.view_type == 1:   self._plot_xy_preview(footprint, progressBarValue, 2, 1, plot_canvas_index=5, title="Footprint", xtitle="Y [m]", ytitle="X [m]", is_footprint=True)
+        elif self.view_type == 0: self._plot_xy_detailed(footprint, progressBarValue, 2, 1, plot_canvas_index=5, title="Footprint", xtitle="Y [m]", ytitle="X [m]", xum=("Y [m]"), yum=("X [m]"), is_footprint=True)
+
+    def _is_footprint_shown(self):
+        return self.has_footprint and self.view_type != 2 and self.tabs.currentIndex() == len(self.tab) - 1
+
+    def __is_footprint_to_plot(self, footprint):
+        # a lazy footprint is traced only if the Footprint tab is shown
+        if not self.has_footprint: return False
+        elif isinstance(footprint, LazyFootprint): return footprint.is_materialized() or self._is_footprint_shown()
+        else: return True
+
+    def __on_tab_changed(self, index):
+        if self.has_footprint and index == len(self.tab) - 1 and self.tabs.count() == len(self.tab) and self.view_type != 2 and \
+                isinstance(self.footprint_beam, LazyFootprint) and self.plot_canvas[5] is None and not self.plotted_beam is None:
+            self.progressBarInit()
+            try:
+                self._plot_footprint(self.footprint_beam, progressBarValue=100)
+            except Exception as exception:
+                self.prompt_exception(exception)
+            finally:
+                self.progressBarFinished()
+
     def _write_stdout(self, text):
         cursor = self.shadow_output.textCursor()
         cursor.movePosition(QTextCursor.End)
@@ -1,5 +1,6 @@
 import numpy
 import sys
+import copy
 
 from AnyQt.QtWidgets import QLabel, QSizePolicy
 from AnyQt.QtGui import QPixmap
@@ -20,9 +21,12 @@ from syned.beamline.beamline import Beamline
 from shadow4.tools.logger import set_verbose
 
 from orangecontrib.shadow4.widgets.gui.ow_generic_element import GenericElement
-from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData, LazyFootprint, PersistentBeamline
 
 from orangecontrib.shadow4.util.shadow4_util import ShadowCongruence, TriggerToolsDecorator
+from orangecontrib.shadow4.util.shadow4_parallel import ParallelScanTracer
+from orangecontrib.shadow4.util.shadow4_caustic import ImagePlaneRetracer
+from orangecontrib.shadow4.util.shadow4_cache import get_cache_key
 from oasys2.widget.util.widget_objects import TriggerIn
 
 NO_FILE_SPECIFIED = "<specify file name>"
@@ -53,6 +57,9 @@ class OWOpticalElement(GenericElement, WidgetDecorator, TriggerToolsDecorator):
     oe_orientation_angle            = Setting(0)
     oe_orientation_angle_user_value = Setting(0.0)
 
+    __batch_scan      = None # (key of the scan, ParallelScanTracer)
+    __drift_reference = None # (key of the trace, traced element, ImagePlaneRetracer)
+
     def __init__(self, show_automatic_box=True, has_footprint=False, show_tab_advanced_settings=True, show_tab_help=False):
         super().__init__(show_automatic_box=show_automatic_box, has_footprint=has_footprint)
 
@@ -296,65 +303,214 @@ class OWOpticalElement(GenericElement, WidgetDecorator, TriggerToolsDecorator):
         if not scanning_data: scanning_data = None # For some not yet understood problem, the variable is False by default instead of None.
         if not self.input_data.scanning_data is None: scanning_data = self.input_data.scanning_data # from a loop starting elsewhere
 
+        self.__drift_reference = None
+
         try:
             set_verbose()
             self.shadow_output.setText("")
 
             sys.stdout = EmittingStream(textWritten=self._write_stdout)
 
-            beamline = self.input_data.beamline.duplicate()
-            element = self.get_beamline_element_instance()
-            element.set_optical_element(self.get_optical_element_instance())
-            element.set_coordinates(self.get_coordinates_instance())
-            element.set_movements(self.get_movements_instance())
+            beamline = PersistentBeamline.initialize_from_beamline(self.input_data.beamline)
+            element = self.__get_beamline_element()
             element.set_input_beam(self.input_data.beam)
 
             print(element.info())
 
             beamline.append_beamline_element(element)
 
-            #
-            # script
-            #
-            script = beamline.to_python_code()
-            script += "\n\n\n# test plot"
-            script += "\nif True:"
-            script += "\n   from srxraylib.plot.gol import plot_scatter"
-            script += "\n   plot_scatter(beam.get_photon_energy_eV(nolost=1), beam.get_column(23, nolost=1), title='(Intensity,Photon Energy)', plot_histograms=0)"
-            script += "\n   plot_scatter(1e6 * beam.get_column(1, nolost=1), 1e6 * beam.get_column(3, nolost=1), title='(X,Z) in microns')"
-            self.shadow4_script.set_code(script)
+            self.__set_script(beamline)
 
             #
             # run
             #
             output_beam, footprint = element.trace_beam()
 
-            self._post_trace_operations(output_beam, footprint, element, beamline)
+            self.__send_results(output_beam, footprint, element, beamline, scanning_data)
+        except Exception as exception:
+            try:    self._initialize_tabs()
+            except: pass
+            self.prompt_exception(exception)
+        finally:
+            self.progressBarFinished()
 
-            self._set_plot_quality()
+    def get_drift_variables(self):
+        return ["image_plane_distance"]
 
-            self.progressBarInit()
+    def run_shadow4_with_drift(self, scanning_data):
+        '''
+        Scan of the image plane distance: the element is traced once, at the first value, and its output beam is
+        retraced to the image plane of the following values. Any other change of the settings or of the input beam
+        makes a new trace.
+        '''
+        if self.input_data is None:
+            self.prompt_exception(ValueError("No input beam"))
+            return
+        if not self.input_data.scanning_data is None: scanning_data = self.input_data.scanning_data # from a loop starting elsewhere
 
-            self._plot_results(output_beam, footprint, progressBarValue=80)
-            self._plot_additional_results(output_beam, footprint, element, beamline)
+        try:
+            set_verbose()
+            self.shadow_output.setText("")
 
-            #
-            # send beam and trigger
-            #
-            output_data = ShadowData(beam=output_beam, beamline=beamline, footprint=footprint)
-            output_data.scanning_data = scanning_data
+            sys.stdout = EmittingStream(textWritten=self._write_stdout)
 
-            self.Outputs.shadow_data.send(output_data)
-            self.Outputs.syned_data.send(beamline)
-            self.Outputs.trigger.send(TriggerIn(new_object=True))
+            drift_key = (id(self.input_data.beam), self.__get_settings_key(excluded=self.get_drift_variables()))
 
+            if self.__drift_reference is None or self.__drift_reference[0] != drift_key:
+                self.__drift_reference = None
+
+                element = self.__get_beamline_element()
+                element.set_input_beam(self.input_data.beam)
+
+                output_beam, footprint = element.trace_beam()
+
+                retracer = ImagePlaneRetracer(output_beam, element.get_coordinates().q())
+                traced   = True
+            else:
+                _, reference_element, retracer = self.__drift_reference
+
+                p, _, angle_radial, angle_radial_out, angle_azimuthal = reference_element.get_coordinates().get_positions()
+
+                coordinates = copy.copy(reference_element.get_coordinates())
+                coordinates.set_positions(p=p, q=self.image_plane_distance, angle_radial=angle_radial, angle_radial_out=angle_radial_out, angle_azimuthal=angle_azimuthal)
+
+                element = copy.copy(reference_element) # traced: same optical element, input beam and angles
+                element.set_coordinates(coordinates)
+
+                output_beam = retracer.get_beam(self.image_plane_distance)
+                footprint   = None # the footprint does not depend on the image plane: re-traced from the element if asked for
+                traced      = False
+
+                print("Image plane moved from " + str(retracer.reference_distance) + " to " + str(self.image_plane_distance) + ": retraced, not traced")
+
+            print(element.info())
+
+            beamline = PersistentBeamline.initialize_from_beamline(self.input_data.beamline)
+            beamline.append_beamline_element(element)
+
+            self.__set_script(beamline)
+            self.__send_results(output_beam, footprint, element, beamline, scanning_data)
+
+            if traced:
+                # after the post trace operations, that can update the settings (e.g. the angles of the crystals)
+                drift_key = (id(self.input_data.beam), self.__get_settings_key(excluded=self.get_drift_variables()))
+
+                self.__drift_reference = (drift_key, element, retracer)
         except Exception as exception:
+            self.__drift_reference = None
             try:    self._initialize_tabs()
             except: pass
             self.prompt_exception(exception)
         finally:
             self.progressBarFinished()
 
+    def __get_settings_key(self, excluded=[]):
+        names = sorted(set(name for cls in type(self).__mro__ for name, value in vars(cls).items() if isinstance(value, Setting)) - set(excluded))
+
+        return get_cache_key([(name, getattr(self, name, None)) for name in names])
+
+    def run_shadow4_in_batch(self, scanning_data, variable_name, variable_values, variable_index, number_of_workers=0):
+        '''
+        At the first value of a batch scan, the beamline elements of all the values are built and traced in worker
+        processes on the same input beam; every trigger of the loop then sends the result of its value.
+        '''
+        if self.input_data is None:
+            self.prompt_exception(ValueError("No input beam"))
+            return
+        if not self.input_data.scanning_data is None: scanning_data = self.input_data.scanning_data # from a loop starting elsewhere
+
+        try:
+            set_verbose()
+            self.shadow_output.setText("")
+
+            sys.stdout = EmittingStream(textWritten=self._write_stdout)
+
+            batch_key = (id(self.input_data.beam), variable_name, tuple(variable_values))
+
+            if self.__batch_scan is None or self.__batch_scan[0] != batch_key or self.__batch_scan[1].next_index != variable_index:
+                self.__close_batch_scan()
+
+                if variable_index != 0: raise ValueError("Batch scan not started from its first value")
+
+                elements = []
+                try:
+                    for variable_value in variable_values:
+                        self.set_scanned_variable(variable_name, variable_value)
+                        elements.append(self.__get_beamline_element())
+                finally:
+                    self.set_scanned_variable(variable_name, variable_values[variable_index])
+
+                self.__batch_scan = (batch_key, ParallelScanTracer(self.input_data.beam, elements, number_of_workers=number_of_workers))
+
+                print("Batch scan: " + str(len(elements)) + " values traced on " + str(self.__batch_scan[1].number_of_workers) + " workers")
+
+            element, output_beam, footprint = self.__batch_scan[1].get_next_result()
+            element.set_input_beam(self.input_data.beam)
+
+            if variable_index == len(variable_values) - 1: self.__close_batch_scan()
+
+            print(element.info())
+
+            beamline = PersistentBeamline.initialize_from_beamline(self.input_data.beamline)
+            beamline.append_beamline_element(element)
+
+            self.__set_script(beamline)
+            self.__send_results(output_beam, footprint, element, beamline, scanning_data)
+        except Exception as exception:
+            self.__close_batch_scan()
+            try:    self._initialize_tabs()
+            except: pass
+            self.prompt_exception(exception)
+        finally:
+            self.progressBarFinished()
+
+    def __close_batch_scan(self):
+        if not self.__batch_scan is None:
+            self.__batch_scan[1].close()
+            self.__batch_scan = None
+
+    def __get_beamline_element(self):
+        element = self.get_beamline_element_instance()
+        element.set_optical_element(self.get_optical_element_instance())
+        element.set_coordinates(self.get_coordinates_instance())
+        element.set_movements(self.get_movements_instance())
+
+        return element
+
+    def __set_script(self, beamline):
+        script = beamline.to_python_code()
+        script += "\n\n\n# test plot"
+        script += "\nif True:"
+        script += "\n   from srxraylib.plot.gol import plot_scatter"
+        script += "\n   plot_scatter(beam.get_photon_energy_eV(nolost=1), beam.get_column(23, nolost=1), title='(Intensity,Photon Energy)', plot_histograms=0)"
+        script += "\n   plot_scatter(1e6 * beam.get_column(1, nolost=1), 1e6 * beam.get_column(3, nolost=1), title='(X,Z) in microns')"
+        self.shadow4_script.set_code(script)
+
+    def __send_results(self, output_beam, footprint, element, beamline, scanning_data):
+        # the footprint of the trace is kept only if the Footprint tab is shown, otherwise it is traced again (from the
+        # element and its input beam) when it is asked for: by the Footprint tab or by the downstream widgets
+        if self.has_footprint: footprint = LazyFootprint(element, footprint if self._is_footprint_shown() else None)
+
+        self._post_trace_operations(output_beam, footprint, element, beamline)
+
+        self._set_plot_quality()
+
+        self.progressBarInit()
+
+        self._plot_results(output_beam, footprint, progressBarValue=80)
+        self._plot_additional_results(output_beam, footprint, element, beamline)
+
+        #
+        # send beam and trigger
+        #
+        output_data = ShadowData(beam=output_beam, beamline=beamline, footprint=footprint)
+        output_data.scanning_data = scanning_data
+        output_data.random_stream = self.input_data.random_stream
+
+        self.Outputs.shadow_data.send(output_data)
+        self.Outputs.syned_data.send(beamline)
+        self.Outputs.trigger.send(TriggerIn(new_object=True))
+
     def _post_trace_operations(self, output_beam, footprint, element, beamline): pass
     def _plot_additional_results(self, output_beam, footprint, element, beamline): pass
 
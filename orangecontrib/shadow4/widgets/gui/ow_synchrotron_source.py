@@ -12,12 +12,12 @@ from syned.beamline.beamline import Beamline
 
 from orangecontrib.shadow4.widgets.gui.ow_electron_beam import OWElectronBeam
 from orangecontrib.shadow4.util.shadow4_objects import ShadowData
-from orangecontrib.shadow4.util.shadow4_util import TriggerToolsDecorator, TriggerIn
+from orangecontrib.shadow4.util.shadow4_util import TriggerToolsDecorator, ChunkedSourceDecorator, TriggerIn
 
 from shadow4.tools.logger import set_verbose
 from shadow4.beamline.s4_beamline import S4Beamline
 
-class OWSynchrotronSource(OWElectronBeam, WidgetDecorator, TriggerToolsDecorator):
+class OWSynchrotronSource(OWElectronBeam, WidgetDecorator, ChunkedSourceDecorator, TriggerToolsDecorator):
     class Inputs:
         trigger     = TriggerToolsDecorator.get_trigger_input()
         syned_data  = WidgetDecorator.syned_input_data(multi_input=True)
@@ -30,6 +30,11 @@ class OWSynchrotronSource(OWElectronBeam, WidgetDecorator, TriggerToolsDecorator
     number_of_rays = Setting(500)
     seed           = Setting(5676561)
 
+    chunked_generation  = Setting(0)
+    chunk_size          = Setting(100000)
+    independent_streams = Setting(0)
+    run_index           = Setting(0)
+
     light_source = None
 
     def __init__(self, show_energy_spread=False):
@@ -72,6 +77,7 @@ class OWSynchrotronSource(OWElectronBeam, WidgetDecorator, TriggerToolsDecorator
     def check_data(self):
         self.number_of_rays = congruence.checkPositiveNumber(self.number_of_rays, "Number of rays")
         self.seed           = congruence.checkPositiveNumber(self.seed, "Seed")
+        self.check_chunked_generation()
 
         self.check_electron_beam() # from OWElectronBeam
         self.check_magnetic_structure()
@@ -97,6 +103,7 @@ class OWSynchrotronSource(OWElectronBeam, WidgetDecorator, TriggerToolsDecorator
             light_source = self.get_light_source()
 
             if not light_source is None: # None if user has canceled the operation
+                self.set_random_stream(light_source)
                 self.light_source = None
                 set_verbose()
                 self.shadow_output.setText("")
@@ -120,7 +127,7 @@ class OWSynchrotronSource(OWElectronBeam, WidgetDecorator, TriggerToolsDecorator
                 t00 = time.time()
                 print("\n\n***** S4LightSource info: ", light_source.info())
                 print("***** starting calculation...")
-                output_beam = light_source.get_beam()
+                output_beam = self.get_beam_from_light_source(light_source, scanning_data)
                 t11 = time.time() - t00
                 print("***** time for %d rays: %f s, %f min, " % (self.number_of_rays, t11, t11 / 60))
 
@@ -140,6 +147,7 @@ class OWSynchrotronSource(OWElectronBeam, WidgetDecorator, TriggerToolsDecorator
                                          number_of_rays=self.number_of_rays,
                                          beamline=S4Beamline(light_source=light_source))
                 output_data.scanning_data = scanning_data
+                output_data.random_stream = self.random_stream
 
                 self.Outputs.shadow_data.send(output_data)
                 self.Outputs.trigger.send(TriggerIn(new_object=True))
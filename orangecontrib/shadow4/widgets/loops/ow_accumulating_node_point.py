@@ -6,6 +6,7 @@ from orangewidget.widget import Input, Output
 
 from orangewidget.settings import Setting
 from oasys2.widget import gui as oasysgui
+from oasys2.widget.util import congruence
 from oasys2.widget.gui import ConfirmDialog, Styles
 from oasys2.widget.util.widget_objects import TriggerIn
 from oasys2.canvas.util.canvas_util import add_widget_parameters_to_module
@@ -14,6 +15,8 @@ from orangecontrib.shadow4.util.shadow4_objects import ShadowData, S4Beam
 from orangecontrib.shadow4.util.shadow4_util import ShadowCongruence
 from orangecontrib.shadow4.widgets.gui.ow_automatic_element import AutomaticElement
 from orangecontrib.shadow4.util.shadow4_util import TriggerToolsDecorator
+from orangecontrib.shadow4.util.shadow4_parallel import ParallelSeedTracer, spawn_seeds
+from orangecontrib.shadow4.util.shadow4_loops import ConvergenceMonitor, LoopCheckpoint
 
 class AccumulatingLoopPoint(AutomaticElement):
     name = "Beam Accumulating Point"
@@ -27,6 +30,7 @@ class AccumulatingLoopPoint(AutomaticElement):
 
     class Inputs:
         shadow_data = Input("Shadow Data", ShadowData, default=True, auto_summary=False)
+        trigger     = Input("Trigger", TriggerIn, auto_summary=False)
 
     class Outputs:
         shadow_data = Output("Shadow Data", ShadowData, default=True, auto_summary=False)
@@ -49,12 +53,34 @@ class AccumulatingLoopPoint(AutomaticElement):
 
     keep_go_rays = Setting(1)
 
+    convergence_columns           = Setting("1, 3")
+    target_relative_uncertainty   = Setting(0.01)
+    minimum_number_of_iterations  = Setting(3)
+    maximum_number_of_iterations  = Setting(100)
+
+    current_relative_uncertainty = 0.0
+
+    save_checkpoints     = Setting(0)
+    checkpoint_file_name = Setting("accumulation_checkpoint.h5")
+    checkpoint_interval  = Setting(10)
+
+    current_iteration = 0
+
+    parallel_fan_out         = Setting(0)
+    number_of_parallel_seeds = Setting(4)
+    number_of_workers        = Setting(0)
+
     def __init__(self):
         super().__init__(show_automatic_box=False)
         self.is_automatic_run = True
 
+        self.convergence_monitor = None
+        self.accumulated_seeds   = []
+        self.accumulated_streams = set()
+        self.last_checkpoint_iteration = 0
+
         self.setFixedWidth(570)
-        self.setFixedHeight(380)
+        self.setFixedHeight(730)
 
         self.controlArea.setFixedWidth(560)
 
@@ -66,15 +92,16 @@ class AccumulatingLoopPoint(AutomaticElement):
         button = gui.button(button_box, self, "Reset Accumulation", callback=self.callResetSettings)
         button.setStyleSheet(Styles.button_blue)
 
-        left_box_1 = oasysgui.widgetBox(self.controlArea, "Accumulating Loop Management", addSpace=False, orientation="vertical", height=260)
+        left_box_1 = oasysgui.widgetBox(self.controlArea, "Accumulating Loop Management", addSpace=False, orientation="vertical", height=320)
 
         gui.comboBox(left_box_1, self, "kind_of_accumulation", label="Accumulated Quantity", labelWidth=350,
-                     items=["Number of Good Rays ", "Intensity of Good Rays"],
+                     items=["Number of Good Rays ", "Intensity of Good Rays", "Statistical Convergence"],
                      callback=self.set_KindOfAccumulation,
                      sendSelectedValue=False, orientation="horizontal")
 
         self.left_box_1_1 = oasysgui.widgetBox(left_box_1, "", addSpace=False, orientation="vertical", height=35)
         self.left_box_1_2 = oasysgui.widgetBox(left_box_1, "", addSpace=False, orientation="vertical", height=35)
+        self.left_box_1_3 = oasysgui.widgetBox(left_box_1, "", addSpace=False, orientation="vertical", height=110)
 
         oasysgui.lineEdit(self.left_box_1_1, self, "number_of_accumulated_rays", "Number of accumulated good rays\n(before sending signal)", labelWidth=350, valueType=float,
                            orientation="horizontal")
@@ -82,7 +109,14 @@ class AccumulatingLoopPoint(AutomaticElement):
         oasysgui.lineEdit(self.left_box_1_2, self, "number_of_accumulated_rays", "Intenisty of accumulated good rays\n(before sending signal)", labelWidth=350, valueType=float,
                            orientation="horizontal")
 
-        self.set_KindOfAccumulation()
+        oasysgui.lineEdit(self.left_box_1_3, self, "convergence_columns", "Monitored columns (FWHM, sigma, centroid)", labelWidth=300, valueType=str,
+                          orientation="horizontal")
+        oasysgui.lineEdit(self.left_box_1_3, self, "target_relative_uncertainty", "Target relative uncertainty", labelWidth=350, valueType=float,
+                          orientation="horizontal")
+        oasysgui.lineEdit(self.left_box_1_3, self, "minimum_number_of_iterations", "Minimum number of iterations", labelWidth=350, valueType=int,
+                          orientation="horizontal")
+        oasysgui.lineEdit(self.left_box_1_3, self, "maximum_number_of_iterations", "Maximum number of iterations", labelWidth=350, valueType=int,
+                          orientation="horizontal")
 
         gui.comboBox(left_box_1, self, "keep_go_rays", label="Remove lost rays from beam", labelWidth=350, items=["No", "Yes"], sendSelectedValue=False, orientation="horizontal")
 
@@ -104,11 +138,74 @@ class AccumulatingLoopPoint(AutomaticElement):
         le.setReadOnly(True)
         le.setStyleSheet("color: black; background-color: rgb(243, 240, 160);")
 
+        self.le_current_relative_uncertainty = oasysgui.lineEdit(left_box_1, self, "current_relative_uncertainty", "Current worst relative uncertainty", labelWidth=350, valueType=float, orientation="horizontal")
+        self.le_current_relative_uncertainty.setReadOnly(True)
+        self.le_current_relative_uncertainty.setStyleSheet(Styles.line_edit_read_only)
+
+        left_box_2 = oasysgui.widgetBox(self.controlArea, "Parallel Seed Fan-out", addSpace=False, orientation="vertical", height=120)
+
+        gui.comboBox(left_box_2, self, "parallel_fan_out", label="Re-trace incoming beamline with new seeds", labelWidth=350,
+                     items=["No", "Yes"], callback=self.set_ParallelFanOut, sendSelectedValue=False, orientation="horizontal")
+
+        self.left_box_2_1 = oasysgui.widgetBox(left_box_2, "", addSpace=False, orientation="vertical", height=55)
+
+        oasysgui.lineEdit(self.left_box_2_1, self, "number_of_parallel_seeds", "Number of parallel seeds per received beam", labelWidth=350, valueType=int,
+                          orientation="horizontal")
+        oasysgui.lineEdit(self.left_box_2_1, self, "number_of_workers", "Number of worker processes (0 = all CPUs)", labelWidth=350, valueType=int,
+                          orientation="horizontal")
+
+        self.set_ParallelFanOut()
+
+        left_box_3 = oasysgui.widgetBox(self.controlArea, "Checkpoint", addSpace=False, orientation="vertical", height=160)
+
+        gui.comboBox(left_box_3, self, "save_checkpoints", label="Save checkpoints of the accumulation", labelWidth=350,
+                     items=["No", "Yes"], callback=self.set_SaveCheckpoints, sendSelectedValue=False, orientation="horizontal")
+
+        self.left_box_3_1 = oasysgui.widgetBox(left_box_3, "", addSpace=False, orientation="vertical", height=60)
+
+        file_box = oasysgui.widgetBox(self.left_box_3_1, "", addSpace=False, orientation="horizontal")
+
+        self.le_checkpoint_file_name = oasysgui.lineEdit(file_box, self, "checkpoint_file_name", "Checkpoint file", labelWidth=120, valueType=str, orientation="horizontal")
+        gui.button(file_box, self, "...", callback=self.select_checkpoint_file)
+
+        oasysgui.lineEdit(self.left_box_3_1, self, "checkpoint_interval", "Save every (iterations)", labelWidth=350, valueType=int, orientation="horizontal")
+
+        self.set_SaveCheckpoints()
+
+        button = gui.button(left_box_3, self, "Resume from Checkpoint", callback=self.resume_from_checkpoint)
+        button.setFixedHeight(30)
+
+        self.convergence_box = oasysgui.widgetBox(self.controlArea, "Convergence", addSpace=False, orientation="vertical", height=300)
+
+        self.convergence_plot = oasysgui.plotWindow(roi=False, control=False, position=True)
+        self.convergence_plot.setGraphXLabel("Iteration")
+        self.convergence_plot.setGraphYLabel("Relative uncertainty")
+        self.convergence_plot.setGraphYLogarithmic(True)
+        self.convergence_box.layout().addWidget(self.convergence_plot)
+
+        self.set_KindOfAccumulation()
+
         gui.rubber(self.controlArea)
 
     def set_KindOfAccumulation(self):
         self.left_box_1_1.setVisible(self.kind_of_accumulation==0)
         self.left_box_1_2.setVisible(self.kind_of_accumulation==1)
+        self.left_box_1_3.setVisible(self.kind_of_accumulation==2)
+        self.convergence_box.setVisible(self.kind_of_accumulation==2)
+
+        self.setFixedHeight(1040 if self.kind_of_accumulation==2 else 730)
+
+        self.convergence_monitor = None
+
+    def set_ParallelFanOut(self):
+        self.left_box_2_1.setVisible(self.parallel_fan_out==1)
+
+    def set_SaveCheckpoints(self):
+        self.left_box_3_1.setVisible(self.save_checkpoints==1)
+
+    def select_checkpoint_file(self):
+        self.le_checkpoint_file_name.setText(oasysgui.selectSaveFileFromDialog(self, self.checkpoint_file_name, default_file_name="accumulation_checkpoint.h5",
+                                                                               file_extension_filter="HDF5 Files (*.h5 *.hdf5 *.hdf)"))
 
     def send_signal(self):
         self.Outputs.shadow_data.send(self.input_data)
@@ -120,62 +217,264 @@ class AccumulatingLoopPoint(AutomaticElement):
             self.current_intensity = 0.0
             self.current_number_of_lost_rays = 0
             self.current_number_of_total_rays = 0
+            self.current_iteration = 0
             self.input_data = None
 
+            self.accumulated_seeds = []
+            self.accumulated_streams = set()
+            self.last_checkpoint_iteration = 0
+
+            self._reset_convergence()
+
     @Inputs.shadow_data
     def set_shadow_data(self, input_data: ShadowData):
         if ShadowCongruence.check_empty_data(input_data):
             proceed = True
-            beam : S4Beam     = input_data.beam
-            footprint: S4Beam = input_data.footprint
+            beam : S4Beam = input_data.beam
 
             if not ShadowCongruence.check_good_beam(beam):
                 if not ConfirmDialog.confirmed(parent=self, message="Beam contains bad values, skip it?"):
                     proceed = False
 
             if proceed:
-                scanning_data = input_data.scanning_data
-
-                go = numpy.where(beam.rays[:, 9] == 1)
+                stream_id = LoopCheckpoint.get_stream_id(input_data)
 
-                nr_good  = len(beam.rays[go])
-                nr_total = len(beam.rays)
-                nr_lost  = nr_total - nr_good
-
-                intensity = beam.histo1(1, nolost=1, ref=23)['intensity']
+                if not stream_id is None and stream_id in self.accumulated_streams:
+                    # after a resume the loop upstream starts again from its first seed: the beams already in the
+                    # checkpoint are skipped, until the new ones
+                    self.setStatusMessage("Skipped beam already accumulated: " + str(input_data.random_stream))
+                    self.Outputs.trigger.send(TriggerIn(new_object=True))
+                    return
 
-                self.current_number_of_rays       += nr_good
-                self.current_intensity            += intensity
-                self.current_number_of_lost_rays  += nr_lost
-                self.current_number_of_total_rays += nr_total
+                try:
+                    # the settings are checked when the accumulation starts, before any counter is updated
+                    if self.kind_of_accumulation == 2: self._get_convergence_monitor()
 
-                self.le_current_intensity.setText("{:10.3f}".format(self.current_intensity))
+                    scanning_data = input_data.scanning_data
 
-                if self.keep_go_rays == 1:
-                    beam.rays = copy.deepcopy(beam.rays[go])
-                    if not footprint is None: footprint.rays = copy.deepcopy(footprint.rays[go])
+                    self._accumulate(input_data)
+                except Exception as exception:
+                    self.prompt_exception(exception)
+                    return
 
-                if not self.input_data is None:
-                    self.input_data = ShadowData.merge_shadow_data(self.input_data, input_data, which_flux=3, which_beamline=0)
-                else:
-                    beam.rays[:, 11] = numpy.arange(1, len(beam.rays) + 1, 1)  # ray_index
-                    if not footprint is None: footprint.rays[:, 11] = numpy.arange(1, len(footprint.rays) + 1, 1)
-
-                    self.input_data = input_data
+                if self.parallel_fan_out == 1 and not self._is_accumulation_completed():
+                    try:
+                        self._accumulate_parallel_seeds(input_data)
+                    except Exception as exception:
+                        self.prompt_exception(exception)
 
                 self.input_data.scanning_data = scanning_data
 
-                if (self.kind_of_accumulation == 0 and self.current_number_of_rays < self.number_of_accumulated_rays) or \
-                   (self.kind_of_accumulation == 1 and self.current_intensity < self.number_of_accumulated_rays):
+                if not self._is_accumulation_completed():
+                    if self.save_checkpoints == 1 and LoopCheckpoint.is_due(self.current_iteration, self.last_checkpoint_iteration, self.checkpoint_interval):
+                        try:
+                            self.write_checkpoint()
+                        except Exception as exception:
+                            self.prompt_exception(exception)
+
                     self.Outputs.trigger.send(TriggerIn(new_object=True))
                 else:
                     self.send_signal()
+                    self._reset_accumulation()
+
+    @Inputs.trigger
+    def set_trigger(self, trigger: TriggerIn):
+        # the source has no more rays (e.g. all its chunks have been sent): the accumulation ends with what it has
+        if trigger and trigger.interrupt and not self.input_data is None:
+            self.send_signal()
+            self._reset_accumulation()
+
+    def _reset_accumulation(self):
+        self.current_number_of_rays       = 0
+        self.current_intensity            = 0.0
+        self.current_number_of_lost_rays  = 0
+        self.current_number_of_total_rays = 0
+        self.current_iteration            = 0
+
+        self.input_data = None
+
+        self.convergence_monitor       = None
+        self.accumulated_seeds         = []
+        self.accumulated_streams       = set()
+        self.last_checkpoint_iteration = 0
+
+    def _is_accumulation_completed(self):
+        if self.kind_of_accumulation == 2:
+            return self.convergence_monitor.is_converged(self.target_relative_uncertainty, self.minimum_number_of_iterations) or \
+                   self.convergence_monitor.number_of_iterations >= self.maximum_number_of_iterations
+        else:
+            return (self.kind_of_accumulation == 0 and self.current_number_of_rays >= self.number_of_accumulated_rays) or \
+                   (self.kind_of_accumulation == 1 and self.current_intensity >= self.number_of_accumulated_rays)
+
+    def _get_convergence_monitor(self):
+        if self.convergence_monitor is None:
+            self.target_relative_uncertainty  = congruence.checkStrictlyPositiveNumber(self.target_relative_uncertainty, "Target relative uncertainty")
+            self.minimum_number_of_iterations = congruence.checkStrictlyPositiveNumber(self.minimum_number_of_iterations, "Minimum number of iterations")
+            self.maximum_number_of_iterations = congruence.checkStrictlyPositiveNumber(self.maximum_number_of_iterations, "Maximum number of iterations")
+
+            try:
+                columns = [int(column) for column in str(self.convergence_columns).split(",") if column.strip() != ""]
+            except ValueError:
+                raise ValueError("Monitored columns should be a comma separated list of column numbers")
+            for column in columns:
+                if column < 1 or column > 18: raise ValueError("Monitored columns should be in the range [1, 18]")
+
+            self.convergence_monitor = ConvergenceMonitor(columns=columns)
+
+        return self.convergence_monitor
+
+    def _reset_convergence(self):
+        self.convergence_monitor = None
+        self.current_relative_uncertainty = 0.0
+        self.convergence_plot.clear()
+
+    def _update_convergence(self, beam: S4Beam):
+        # every received beam is an independent sample: the uncertainties are the standard errors of the means
+        self._get_convergence_monitor().add_beam(beam)
+        self._update_convergence_display()
+
+    def _update_convergence_display(self):
+        convergence_monitor = self.convergence_monitor
+
+        self.current_relative_uncertainty = convergence_monitor.get_worst_relative_uncertainty()
+        self.le_current_relative_uncertainty.setText("{:10.6f}".format(self.current_relative_uncertainty))
+
+        iterations, curves = convergence_monitor.get_convergence_curves()
+
+        self.convergence_plot.clear()
+        for name, curve in curves.items():
+            finite = numpy.isfinite(curve)
+            if numpy.any(finite): self.convergence_plot.addCurve(iterations[finite], curve[finite], legend=name, symbol='o')
+        self.convergence_plot.addCurve([1, max(2, iterations[-1])], [self.target_relative_uncertainty]*2, legend="target", color="black", linestyle="--")
+        self.convergence_plot.resetZoom()
+
+    def _accumulate(self, input_data: ShadowData, seed=None):
+        beam : S4Beam     = input_data.beam
+        footprint: S4Beam = input_data.footprint
+
+        go = numpy.where(beam.rays[:, 9] == 1)
+
+        nr_good  = len(beam.rays[go])
+        nr_total = len(beam.rays)
+        nr_lost  = nr_total - nr_good
+
+        intensity = beam.histo1(1, nolost=1, ref=23)['intensity']
+
+        if self.kind_of_accumulation == 2: self._update_convergence(beam) # first: if it fails, nothing is accumulated
+
+        self.current_number_of_rays       += nr_good
+        self.current_intensity            += intensity
+        self.current_number_of_lost_rays  += nr_lost
+        self.current_number_of_total_rays += nr_total
+        self.current_iteration            += 1
+
+        if seed is None: seed = self._get_source_seed(input_data)
+        self.accumulated_seeds.append(seed)
+
+        stream_id = LoopCheckpoint.get_stream_id(input_data)
+        if not stream_id is None: self.accumulated_streams.add(stream_id)
+
+        self.le_current_intensity.setText("{:10.3f}".format(self.current_intensity))
+
+        if self.keep_go_rays == 1:
+            beam.rays = copy.deepcopy(beam.rays[go])
+            if not footprint is None: footprint.rays = copy.deepcopy(footprint.rays[go])
+
+        if not self.input_data is None:
+            self.input_data = ShadowData.merge_shadow_data(self.input_data, input_data, which_flux=3, which_beamline=0)
+        else:
+            beam.rays[:, 11] = numpy.arange(1, len(beam.rays) + 1, 1)  # ray_index
+            if not footprint is None: footprint.rays[:, 11] = numpy.arange(1, len(footprint.rays) + 1, 1)
+
+            self.input_data = input_data
+
+    @staticmethod
+    def _get_source_seed(input_data: ShadowData):
+        try:    return int(input_data.beamline.get_light_source().get_seed())
+        except (AttributeError, TypeError, ValueError): return -1 # unknown: no beamline, no light source or no seed
+
+    def write_checkpoint(self):
+        congruence.checkDir(self.checkpoint_file_name)
+
+        parameters = {
+            "kind_of_accumulation"         : self.kind_of_accumulation,
+            "current_iteration"            : self.current_iteration,
+            "current_number_of_rays"       : self.current_number_of_rays,
+            "current_intensity"            : self.current_intensity,
+            "current_number_of_lost_rays"  : self.current_number_of_lost_rays,
+            "current_number_of_total_rays" : self.current_number_of_total_rays,
+            "convergence_columns"          : self.convergence_columns,
+        }
+        arrays = {"seeds"   : numpy.array(self.accumulated_seeds, dtype=numpy.int64),
+                  "streams" : numpy.array(sorted(self.accumulated_streams), dtype=numpy.int64)}
+        if not self.convergence_monitor is None:
+            arrays.update({"convergence/" + name : array for name, array in self.convergence_monitor.get_state().items()})
+
+        LoopCheckpoint.write(self.checkpoint_file_name, loop_name=self.name, parameters=parameters, arrays=arrays, shadow_data=self.input_data)
+
+        self.last_checkpoint_iteration = self.current_iteration
+
+    def resume_from_checkpoint(self):
+        try:
+            if not self.input_data is None and \
+                    not ConfirmDialog.confirmed(parent=self, message="The current accumulated beam will be replaced, proceed?"): return
+
+            parameters, arrays, shadow_data = LoopCheckpoint.read(congruence.checkFile(self.checkpoint_file_name), loop_name=self.name)
+
+            if shadow_data is None: raise ValueError("Checkpoint contains no accumulated beam")
+
+            self.kind_of_accumulation = int(parameters["kind_of_accumulation"])
+            self.convergence_columns  = str(parameters["convergence_columns"])
+            self.set_KindOfAccumulation()
+
+            self.current_iteration            = int(parameters["current_iteration"])
+            self.current_number_of_rays       = int(parameters["current_number_of_rays"])
+            self.current_intensity            = float(parameters["current_intensity"])
+            self.current_number_of_lost_rays  = int(parameters["current_number_of_lost_rays"])
+            self.current_number_of_total_rays = int(parameters["current_number_of_total_rays"])
+            self.le_current_intensity.setText("{:10.3f}".format(self.current_intensity))
+
+            self.accumulated_seeds         = [int(seed) for seed in arrays.get("seeds", [])]
+            self.accumulated_streams       = set(int(stream_id) for stream_id in arrays.get("streams", []))
+            self.last_checkpoint_iteration = self.current_iteration
+
+            self.input_data = shadow_data
+
+            if self.kind_of_accumulation == 2:
+                self._get_convergence_monitor().set_state({name[len("convergence/"):] : array for name, array in arrays.items() if name.startswith("convergence/")})
+                self._update_convergence_display()
+
+            self.setStatusMessage("Resumed at iteration " + str(self.current_iteration) +
+                                  ("" if len(self.accumulated_seeds) == 0 else ", last seed: " + str(self.accumulated_seeds[-1])))
+
+            # the loop restarts asking for the next beam: the beams of the random streams already accumulated are
+            # skipped when they come again (only seeded streams are recognized: with seed 0 they are accumulated again)
+            if not self._is_accumulation_completed(): self.Outputs.trigger.send(TriggerIn(new_object=True))
+            else:                                     self.send_signal()
+        except Exception as exception:
+            self.prompt_exception(exception)
+
+    def _accumulate_parallel_seeds(self, input_data: ShadowData):
+        # the received beamline is the whole source-to-here chain: it is re-traced in worker processes with
+        # independent seeds spawned from the seed of the source, and the results are accumulated in seed order.
+        self.number_of_parallel_seeds = congruence.checkStrictlyPositiveNumber(self.number_of_parallel_seeds, "Number of parallel seeds")
+
+        beamline = input_data.beamline
+        seeds    = spawn_seeds(beamline.get_light_source().get_seed(), self.number_of_parallel_seeds)
+        tracer   = ParallelSeedTracer(number_of_workers=self.number_of_workers)
+
+        self.setStatusMessage("Tracing " + str(len(seeds)) + " seeds on " + str(tracer.number_of_workers) + " workers")
+
+        for index, (seed, beam, footprint) in enumerate(tracer.trace(beamline, seeds)):
+            seed_data = ShadowData(beam=beam, footprint=footprint, beamline=beamline)
+            seed_data.initial_flux = input_data.initial_flux
+
+            self._accumulate(seed_data, seed=seed)
+
+            self.setStatusMessage("Accumulated seed " + str(index + 1) + " of " + str(len(seeds)))
 
-                    self.current_number_of_rays       = 0
-                    self.current_intensity            = 0.0
-                    self.current_number_of_lost_rays  = 0
-                    self.current_number_of_total_rays = 0
+            if self._is_accumulation_completed(): break
 
-                    self.input_data = None
+        self.setStatusMessage("")
 
 add_widget_parameters_to_module(__name__)
\ No newline at end of file
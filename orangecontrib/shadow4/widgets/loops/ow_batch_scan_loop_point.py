@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# #########################################################################
+# Copyright (c) 2018, UChicago Argonne, LLC. All rights reserved.         #
+#                                                                         #
+# Copyright 2018. UChicago Argonne, LLC. This software was produced       #
+# under U.S. Government contract DE-AC02-06CH11357 for Argonne National   #
+# Laboratory (ANL), which is operated by UChicago Argonne, LLC for the    #
+# U.S. Department of Energy. The U.S. Government has rights to use,       #
+# reproduce, and distribute this software.  NEITHER THE GOVERNMENT NOR    #
+# UChicago Argonne, LLC MAKES ANY WARRANTY, EXPRESS OR IMPLIED, OR        #
+# ASSUMES ANY LIABILITY FOR THE USE OF THIS SOFTWARE.  If software is     #
+# modified to produce derivative works, such modified software should     #
+# be clearly marked, so as not to confuse it with the version available   #
+# from ANL.                                                               #
+#                                                                         #
+# Additionally, redistribution and use in source and binary forms, with   #
+# or without modification, are permitted provided that the following      #
+# conditions are met:                                                     #
+#                                                                         #
+#     * Redistributions of source code must retain the above copyright    #
+#       notice, this list of conditions and the following disclaimer.     #
+#                                                                         #
+#     * Redistributions in binary form must reproduce the above copyright #
+#       notice, this list of conditions and the following disclaimer in   #
+#       the documentation and/or other materials provided with the        #
+#       distribution.                                                     #
+#                                                                         #
+#     * Neither the name of UChicago Argonne, LLC, Argonne National       #
+#       Laboratory, ANL, the U.S. Government, nor the names of its        #
+#       contributors may be used to endorse or promote products derived   #
+#       from this software without specific prior written permission.     #
+#                                                                         #
+# THIS SOFTWARE IS PROVIDED BY UChicago Argonne, LLC AND CONTRIBUTORS     #
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT       #
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS       #
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL UChicago     #
+# Argonne, LLC OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,        #
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,    #
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;        #
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER        #
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT      #
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN       #
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE         #
+# POSSIBILITY OF SUCH DAMAGE.                                             #
+# #########################################################################
+
+import numpy
+
+from AnyQt.QtWidgets import QMessageBox
+
+from orangewidget import gui
+from orangewidget.widget import Input, Output
+
+from orangewidget.settings import Setting
+from oasys2.widget import gui as oasysgui
+from oasys2.widget.util import congruence
+from oasys2.widget.widget import OWLoopWidget, OWAction
+from oasys2.widget.gui import ConfirmDialog, Styles
+from oasys2.widget.util.widget_objects import TriggerIn, TriggerOut
+from oasys2.canvas.util.canvas_util import add_widget_parameters_to_module
+
+from orangecontrib.shadow4.util.shadow4_loops import LoopDispatcher
+
+class BatchScanLoopPoint(OWLoopWidget):
+
+    name = "Batch Scanning Variable Loop Point"
+    description = "Loops: Batch Scanning Variable Loop Point"
+    icon = "icons/batch_scan.png"
+    maintainer = "Luca Rebuffi"
+    maintainer_email = "lrebuffi(@at@)anl.gov"
+    priority = 4
+    category = "User Defined"
+    keywords = ["data", "scan", "variable", "batch", "parallel"]
+
+    class Inputs:
+        trigger_in = Input("Trigger", TriggerIn, default=True, auto_summary=False)
+
+    class Outputs:
+        trigger_out = Output("Trigger", TriggerOut, default=True, auto_summary=False)
+
+    want_main_area = 0
+
+    variable_name         = Setting("<variable name>")
+    variable_display_name = Setting("<variable display name>")
+    variable_um           = Setting("<u.m.>")
+
+    kind_of_loop     = Setting(0)
+    loop_from        = Setting(0.0)
+    loop_to          = Setting(1.0)
+    number_of_points = Setting(11)
+    list_of_values   = Setting("")
+
+    number_of_workers = Setting(0)
+
+    current_new_object = 0
+    current_value      = ""
+
+    #################################
+    process_last = True
+    #################################
+
+    def __init__(self):
+        self.runaction = OWAction("Start", self)
+        self.runaction.triggered.connect(self.startLoop)
+        self.addAction(self.runaction)
+
+        self.runaction = OWAction("Stop", self)
+        self.runaction.triggered.connect(self.stopLoop)
+        self.addAction(self.runaction)
+
+        self.variable_values = []
+
+        # the values are traced in advance by the receiving widget: one result sent for each trigger
+        self.dispatcher = LoopDispatcher(send_iteration=self.send_iteration, on_completed=self.end_loop)
+
+        self.setFixedWidth(400)
+        self.setFixedHeight(520)
+
+        button_box = oasysgui.widgetBox(self.controlArea, "", addSpace=True, orientation="horizontal")
+
+        self.start_button = gui.button(button_box, self, "Start", callback=self.startLoop)
+        self.start_button.setFixedHeight(35)
+
+        stop_button = gui.button(button_box, self, "Stop", callback=self.stopLoop)
+        stop_button.setStyleSheet("color: red; font-weight: bold; height: 35px;")
+
+        self.stop_button = stop_button
+
+        left_box_1 = oasysgui.widgetBox(self.controlArea, "Variable", addSpace=True, orientation="vertical", width=380, height=110)
+
+        oasysgui.lineEdit(left_box_1, self, "variable_name", "Variable Name", labelWidth=150, valueType=str, orientation="horizontal")
+        oasysgui.lineEdit(left_box_1, self, "variable_display_name", "Variable Display Name", labelWidth=150, valueType=str, orientation="horizontal")
+        oasysgui.lineEdit(left_box_1, self, "variable_um", "Variable Units", labelWidth=150, valueType=str, orientation="horizontal")
+
+        left_box_2 = oasysgui.widgetBox(self.controlArea, "Values", addSpace=True, orientation="vertical", width=380, height=190)
+
+        gui.comboBox(left_box_2, self, "kind_of_loop", label="Kind of Loop", labelWidth=250,
+                     items=["From Range", "From List"], callback=self.set_KindOfLoop, sendSelectedValue=False, orientation="horizontal")
+
+        self.left_box_2_1 = oasysgui.widgetBox(left_box_2, "", addSpace=False, orientation="vertical", height=130)
+        self.left_box_2_2 = oasysgui.widgetBox(left_box_2, "", addSpace=False, orientation="vertical", height=130)
+
+        oasysgui.lineEdit(self.left_box_2_1, self, "loop_from", "From", labelWidth=250, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(self.left_box_2_1, self, "loop_to", "To", labelWidth=250, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(self.left_box_2_1, self, "number_of_points", "Number of Points", labelWidth=250, valueType=int, orientation="horizontal")
+
+        oasysgui.widgetLabel(self.left_box_2_2, "Values (one per line)")
+        self.values_area = oasysgui.textArea(height=100)
+        self.values_area.setText(self.list_of_values)
+        self.left_box_2_2.layout().addWidget(self.values_area)
+
+        self.set_KindOfLoop()
+
+        left_box_3 = oasysgui.widgetBox(self.controlArea, "Batch", addSpace=True, orientation="vertical", width=380, height=110)
+
+        oasysgui.lineEdit(left_box_3, self, "number_of_workers", "Number of worker processes (0 = all CPUs)", labelWidth=280, valueType=int, orientation="horizontal")
+
+        self.le_current_new_object = oasysgui.lineEdit(left_box_3, self, "current_new_object", "Current Point", labelWidth=250, valueType=int, orientation="horizontal")
+        self.le_current_new_object.setReadOnly(True)
+        self.le_current_new_object.setStyleSheet(Styles.line_edit_read_only)
+
+        self.le_current_value = oasysgui.lineEdit(left_box_3, self, "current_value", "Current Value", labelWidth=250, valueType=str, orientation="horizontal")
+        self.le_current_value.setReadOnly(True)
+        self.le_current_value.setStyleSheet(Styles.line_edit_read_only)
+
+        gui.rubber(self.controlArea)
+
+    def set_KindOfLoop(self):
+        self.left_box_2_1.setVisible(self.kind_of_loop == 0)
+        self.left_box_2_2.setVisible(self.kind_of_loop == 1)
+
+    def get_variable_values(self):
+        if self.kind_of_loop == 0:
+            congruence.checkStrictlyPositiveNumber(self.number_of_points, "Number of Points")
+
+            return [float(value) for value in numpy.linspace(self.loop_from, self.loop_to, self.number_of_points)]
+        else:
+            self.list_of_values = self.values_area.toPlainText()
+
+            values = [value.strip() for value in self.list_of_values.split("\n") if value.strip() != ""]
+            if len(values) == 0: raise ValueError("No values in the list")
+
+            return values
+
+    def startLoop(self):
+        try:
+            if self.variable_name.strip() == "" or self.variable_name.strip() == "<variable name>": raise ValueError("Variable Name not specified")
+            congruence.checkPositiveNumber(self.number_of_workers, "Number of worker processes")
+
+            self.variable_values = self.get_variable_values()
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+            return
+
+        self.start_button.setEnabled(False)
+        self.dispatcher.start(1, len(self.variable_values))
+
+    def stopLoop(self):
+        if ConfirmDialog.confirmed(parent=self, message="Confirm Interruption of the Loop?"):
+            self.setStatusMessage("Interrupted by user")
+            self.dispatcher.stop()
+
+    def send_iteration(self, iteration):
+        self.current_new_object = iteration
+        self.current_value      = str(self.variable_values[iteration - 1])
+        self.setStatusMessage("Running point " + str(self.current_new_object) + " of " + str(len(self.variable_values)))
+
+        self.Outputs.trigger_out.send(TriggerOut(new_object=True, additional_parameters={"variable_name"         : self.variable_name,
+                                                                                          "variable_display_name" : self.variable_display_name,
+                                                                                          "variable_value"        : self.variable_values[iteration - 1],
+                                                                                          "variable_um"           : self.variable_um,
+                                                                                          "variable_values"       : self.variable_values,
+                                                                                          "variable_index"        : iteration - 1,
+                                                                                          "number_of_workers"     : self.number_of_workers}))
+
+    def end_loop(self):
+        self.current_new_object = 0
+        self.current_value      = ""
+        self.start_button.setEnabled(True)
+        self.setStatusMessage("")
+        self.Outputs.trigger_out.send(TriggerOut(new_object=False))
+
+    @Inputs.trigger_in
+    def passTrigger(self, trigger):
+        if trigger:
+            if trigger.interrupt:
+                self.dispatcher.interrupt()
+            elif trigger.new_object:
+                if self.current_new_object == 0:
+                    QMessageBox.critical(self, "Error", "Loop has to be started properly: press the button Start", QMessageBox.Ok)
+                    return
+
+                self.dispatcher.acknowledge()
+
+add_widget_parameters_to_module(__name__)
@@ -63,12 +63,13 @@ from oasys2.widget import gui as oasysgui
 from oasys2.widget.util import congruence
 from oasys2.widget.gui import ConfirmDialog
 from oasys2.widget.util.widget_util import EmittingStream
-from oasys2.widget.util.scanning import StatisticalDataCollection, HistogramDataCollection, DoublePlotWidget, write_histo_and_stats_file_hdf5, write_histo_and_stats_file
+from oasys2.widget.util.scanning import StatisticalDataCollection, HistogramDataCollection, HistogramData, DoublePlotWidget, write_histo_and_stats_file_hdf5, write_histo_and_stats_file
 
 from orangecontrib.shadow4.util.shadow4_objects import ShadowData
 from orangecontrib.shadow4.util.shadow4_util import ShadowCongruence, ShadowPlot
 from orangecontrib.shadow4.widgets.gui.ow_automatic_element import AutomaticElement
 from orangecontrib.shadow4.util.scanning import ScanHistoWidget, Scan3DHistoWidget
+from orangecontrib.shadow4.util.shadow4_loops import LoopCheckpoint
 
 from shadow4.beamline.s4_beamline import S4Beamline
 from shadow4.beam.s4_beam import S4Beam
@@ -119,17 +120,29 @@ class Histogram(AutomaticElement):
 
     is_conversion_active = Setting(1)
 
+    save_checkpoints     = Setting(0)
+    checkpoint_file_name = Setting("histogram_scan_checkpoint.h5")
+    checkpoint_interval  = Setting(1)
+
     last_ticket        = None
     current_histo_data = None
     current_stats      = None
     last_histo_data    = None
     histo_index        = -1
+    current_iteration  = 0
+
+    last_checkpoint_iteration = 0
+    done_iterations           = None # ids of the beams (iterative mode) or of the scanned values (scanning mode) plotted
+    iterations_to_skip        = None
 
     input_data: ShadowData = None
 
     def __init__(self):
         super().__init__()
 
+        self.done_iterations    = []
+        self.iterations_to_skip = set()
+
         self.refresh_button = gui.button(self.controlArea, self, "Refresh", callback=self.plot_results,
                                          height=45, width=self.CONTROL_AREA_WIDTH-5)
         gui.separator(self.controlArea, 10)
@@ -313,6 +326,24 @@ class Histogram(AutomaticElement):
                                          items=["No", "Yes"],
                                          sendSelectedValue=False, orientation="horizontal")
 
+        checkpoint_box = oasysgui.widgetBox(tab_gen, "Checkpoint", addSpace=True, orientation="vertical", height=150)
+
+        gui.comboBox(checkpoint_box, self, "save_checkpoints", label="Save checkpoints", labelWidth=250,
+                     items=["No", "Yes"], callback=self.set_SaveCheckpoints, sendSelectedValue=False, orientation="horizontal")
+
+        self.checkpoint_box_1 = oasysgui.widgetBox(checkpoint_box, "", addSpace=False, orientation="vertical", height=60)
+
+        file_box = oasysgui.widgetBox(self.checkpoint_box_1, "", addSpace=False, orientation="horizontal")
+
+        self.le_checkpoint_file_name = oasysgui.lineEdit(file_box, self, "checkpoint_file_name", "File", labelWidth=50, valueType=str, orientation="horizontal")
+        gui.button(file_box, self, "...", callback=self.select_checkpoint_file)
+
+        oasysgui.lineEdit(self.checkpoint_box_1, self, "checkpoint_interval", "Save every (iterations)", labelWidth=250, valueType=int, orientation="horizontal")
+
+        self.set_SaveCheckpoints()
+
+        gui.button(checkpoint_box, self, "Resume from Checkpoint", callback=self.resume_from_checkpoint, height=30)
+
         self.main_tabs = oasysgui.tabWidget(self.mainArea)
         plot_tab = oasysgui.createTabPage(self.main_tabs, "Plots")
         plot_tab_stats = oasysgui.createTabPage(self.main_tabs, "Stats")
@@ -345,6 +376,11 @@ class Histogram(AutomaticElement):
         self.last_histo_data = None
 
         self.histo_index = -1
+        self.current_iteration = 0
+
+        self.last_checkpoint_iteration = 0
+        self.done_iterations           = []
+        self.iterations_to_skip        = set()
 
         if not self.plot_canvas is None:
             self.main_tabs.removeTab(1)
@@ -398,9 +434,16 @@ class Histogram(AutomaticElement):
         self.image_plane_box.setVisible(self.image_plane==1)
         self.image_plane_box_empty.setVisible(self.image_plane==0)
 
+    def set_SaveCheckpoints(self):
+        self.checkpoint_box_1.setVisible(self.save_checkpoints==1)
+
+    def select_checkpoint_file(self):
+        self.le_checkpoint_file_name.setText(oasysgui.selectSaveFileFromDialog(self, self.checkpoint_file_name, default_file_name="histogram_scan_checkpoint.h5",
+                                                                               file_extension_filter="HDF5 Files (*.h5 *.hdf5 *.hdf)"))
+
     ##########################
 
-    def replace_fig(self, shadow_data: ShadowData, var, xrange, title, xtitle, ytitle, xum):
+    def create_plot_canvas(self):
         if self.plot_canvas is None:
             if self.iterative_mode < 2:
                 self.plot_canvas = ShadowPlot.DetailedHistoWidget(y_scale_factor=1.14)
@@ -413,6 +456,9 @@ class Histogram(AutomaticElement):
 
             self.image_box.layout().addWidget(self.plot_canvas)
 
+    def replace_fig(self, shadow_data: ShadowData, var, xrange, title, xtitle, ytitle, xum):
+        self.create_plot_canvas()
+
         if self.iterative_mode==0:
             self.last_ticket = None
             self.current_histo_data = None
@@ -488,38 +534,151 @@ class Histogram(AutomaticElement):
 
                 self.last_histo_data = histo_data
 
-                if self.sigma_fwhm_size==0: # sigma
-                    sizes = self.current_stats.get_sigmas()
-                    label_size = "Sigma " + xum
-                elif self.sigma_fwhm_size==1: # FWHM
-                    sizes = self.current_stats.get_fwhms()
-                    label_size = "FWHM " + xum
-                else: # centroid
-                    sizes = self.current_stats.get_centroids()
-                    label_size = "Centroid " + xum
-
-                if self.absolute_relative_intensity == 0: #relative
-                    if self.peak_integral_intensity==0: # peak
-                        intensities =  self.current_stats.get_relative_peak_intensities()
-                        label_intensity = "Relative Peak Intensity"
-                    else:
-                        intensities = self.current_stats.get_relative_integral_intensities()
-                        label_intensity = "Relative Integral Intensity"
-                else:
-                    if self.peak_integral_intensity==0: # peak
-                        intensities =  self.current_stats.get_absolute_peak_intensities()
-                        label_intensity = "Absolute Peak Intensity"
-                    else:
-                        intensities = self.current_stats.get_absolute_integral_intensities()
-                        label_intensity = "Absolute Integral Intensity"
+                self.plot_stats(shadow_data.scanning_data.scanned_variable_display_name + um, xum)
+
+        if self.iterative_mode > 0:
+            self.current_iteration += 1
+
+            iteration_id = self.get_iteration_id(shadow_data)
+            if not iteration_id is None: self.done_iterations.append(iteration_id)
+
+            if self.save_checkpoints == 1 and LoopCheckpoint.is_due(self.current_iteration, self.last_checkpoint_iteration, self.checkpoint_interval):
+                try:
+                    self.write_checkpoint()
+                except Exception as exception:
+                    QMessageBox.critical(self, "Error", "Checkpoint not saved: " + str(exception), QMessageBox.Ok)
+
+    def plot_stats(self, scan_variable_label, xum):
+        if self.sigma_fwhm_size==0: # sigma
+            sizes = self.current_stats.get_sigmas()
+            label_size = "Sigma " + xum
+        elif self.sigma_fwhm_size==1: # FWHM
+            sizes = self.current_stats.get_fwhms()
+            label_size = "FWHM " + xum
+        else: # centroid
+            sizes = self.current_stats.get_centroids()
+            label_size = "Centroid " + xum
+
+        if self.absolute_relative_intensity == 0: #relative
+            if self.peak_integral_intensity==0: # peak
+                intensities =  self.current_stats.get_relative_peak_intensities()
+                label_intensity = "Relative Peak Intensity"
+            else:
+                intensities = self.current_stats.get_relative_integral_intensities()
+                label_intensity = "Relative Integral Intensity"
+        else:
+            if self.peak_integral_intensity==0: # peak
+                intensities =  self.current_stats.get_absolute_peak_intensities()
+                label_intensity = "Absolute Peak Intensity"
+            else:
+                intensities = self.current_stats.get_absolute_integral_intensities()
+                label_intensity = "Absolute Integral Intensity"
+
+        self.plot_canvas_stats.plotCurves(self.current_stats.get_scan_values(),
+                                          sizes,
+                                          intensities,
+                                          "Statistics",
+                                          scan_variable_label,
+                                          label_size,
+                                          label_intensity)
+
+    def write_checkpoint(self):
+        congruence.checkDir(self.checkpoint_file_name)
+
+        parameters = {
+            "iterative_mode"      : self.iterative_mode,
+            "x_column_index"      : self.x_column_index,
+            "weight_column_index" : self.weight_column_index,
+            "number_of_bins"      : self.number_of_bins,
+            "current_iteration"   : self.current_iteration,
+            "histo_index"         : self.histo_index,
+        }
+        arrays = {"done_iterations" : numpy.array(self.done_iterations, dtype=numpy.int64)}
+
+        if self.iterative_mode == 1:
+            last_ticket = self.last_ticket[0] if isinstance(self.last_ticket, tuple) else self.last_ticket
+
+            if not last_ticket is None:
+                arrays.update({"last_ticket/" + key : value for key, value in last_ticket.items() if not value is None})
+        elif self.iterative_mode == 2:
+            if not self.current_histo_data is None: arrays["histo_data"] = self.current_histo_data.data
+            if not self.current_stats is None:      arrays["stats"]      = self.current_stats.data
+            if not self.last_histo_data is None:    parameters["last_histo_data_offset"] = self.last_histo_data.offset
+
+            if not self.input_data is None and not self.input_data.scanning_data is None:
+                um = self.input_data.scanning_data.scanned_variable_um
+                parameters["scan_variable_label"] = self.input_data.scanning_data.scanned_variable_display_name + ("" if um.strip() == "" else " [" + um + "]")
+
+        LoopCheckpoint.write(self.checkpoint_file_name, loop_name=self.name, parameters=parameters, arrays=arrays)
+
+        self.last_checkpoint_iteration = self.current_iteration
+
+    def resume_from_checkpoint(self):
+        try:
+            parameters, arrays, _ = LoopCheckpoint.read(congruence.checkFile(self.checkpoint_file_name), loop_name=self.name)
+
+            if not self.current_iteration == 0 and \
+                    not ConfirmDialog.confirmed(parent=self, message="Stored data will be replaced, proceed?"): return
+
+            self.iterative_mode = int(parameters["iterative_mode"])
+            self.set_IterativeMode() # clears the stored data and the plots
+
+            self.x_column_index      = int(parameters["x_column_index"])
+            self.weight_column_index = int(parameters["weight_column_index"])
+            self.number_of_bins      = int(parameters["number_of_bins"])
+            self.current_iteration   = int(parameters["current_iteration"])
+            self.histo_index         = int(parameters["histo_index"])
+
+            # the loop upstream restarts from its first iteration: the ones already done are skipped when they come again
+            self.last_checkpoint_iteration = self.current_iteration
+            self.done_iterations           = [int(iteration_id) for iteration_id in arrays.get("done_iterations", [])]
+            self.iterations_to_skip        = set(self.done_iterations)
+
+            if self.iterative_mode == 1:
+                last_ticket = {key[len("last_ticket/"):] : value for key, value in arrays.items() if key.startswith("last_ticket/")}
+                self.last_ticket = None if len(last_ticket) == 0 else last_ticket
+            elif self.iterative_mode == 2:
+                if "histo_data" in arrays:
+                    self.current_histo_data = HistogramDataCollection()
+                    self.current_histo_data.data = arrays["histo_data"]
+                if "stats" in arrays:
+                    self.current_stats = StatisticalDataCollection()
+                    self.current_stats.data = arrays["stats"]
+                if "last_histo_data_offset" in parameters:
+                    self.last_histo_data = HistogramData(offset=float(parameters["last_histo_data_offset"]))
+
+                if not self.current_stats is None:
+                    scan_variable_label = str(parameters.get("scan_variable_label", ""))
+                    x, auto_title, xum  = self.get_titles()
+
+                    self.create_plot_canvas()
+                    self.plot_stats(scan_variable_label, xum)
+
+                    if not self.current_histo_data is None:
+                        for index in range(self.current_histo_data.data.shape[1]):
+                            self.plot_canvas.plot_histogram_data(HistogramData(histogram=self.current_histo_data.get_intensity(index),
+                                                                               bins=self.current_histo_data.get_position(index),
+                                                                               scan_value=self.current_histo_data.get_scan_value(index)),
+                                                                 col=x,
+                                                                 ref=self.weight_column_index,
+                                                                 title=self.title,
+                                                                 xtitle=auto_title,
+                                                                 ytitle="Number of Rays",
+                                                                 histo_index=index,
+                                                                 scan_variable_name=scan_variable_label,
+                                                                 offset=0.0 if self.last_histo_data is None else self.last_histo_data.offset,
+                                                                 show_reference=False,
+                                                                 add_labels=self.add_labels==1,
+                                                                 has_colormap=self.has_colormap==1)
+
+            QMessageBox.information(self, "Resume from Checkpoint",
+                                    "Stored data restored at iteration " + str(self.current_iteration) + ": when the loop restarts, " +
+                                    "the " + str(len(self.iterations_to_skip)) + " iterations already done are skipped",
+                                    QMessageBox.Ok)
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
 
-                self.plot_canvas_stats.plotCurves(self.current_stats.get_scan_values(),
-                                                  sizes,
-                                                  intensities,
-                                                  "Statistics",
-                                                  shadow_data.scanning_data.scanned_variable_display_name + um,
-                                                  label_size,
-                                                  label_intensity)
+            if self.IS_DEVELOP: raise exception
 
     def plot_histo(self, var_x, title, xtitle, ytitle, xum):
         data_to_plot : ShadowData = self.input_data
@@ -588,6 +747,13 @@ class Histogram(AutomaticElement):
 
                 self.number_of_bins = congruence.checkPositiveNumber(self.number_of_bins, "Number of Bins")
 
+                iteration_id = self.get_iteration_id(self.input_data)
+                if iteration_id in self.iterations_to_skip:
+                    self.iterations_to_skip.discard(iteration_id)
+                    print("Iteration already in the checkpoint: skipped")
+
+                    return False
+
                 x, auto_title, xum = self.get_titles()
 
                 self.plot_histo(x, title=self.title, xtitle=auto_title, ytitle="Number of Rays", xum=xum)
@@ -604,6 +770,18 @@ class Histogram(AutomaticElement):
 
             return False
 
+    def get_iteration_id(self, shadow_data: ShadowData):
+        '''
+        id of the iteration of the loop upstream bringing the data: the scanned value (scanning mode) or the random
+        stream of the beam (iterative mode). None if not recognizable.
+        '''
+        if self.iterative_mode == 1:
+            return LoopCheckpoint.get_stream_id(shadow_data)
+        elif self.iterative_mode == 2 and not shadow_data.scanning_data is None:
+            return LoopCheckpoint.get_id(shadow_data.scanning_data.scanned_variable_value)
+        else:
+            return None
+
     def get_titles(self):
         auto_title = self.x_column.currentText().split(":", 2)[1]
 
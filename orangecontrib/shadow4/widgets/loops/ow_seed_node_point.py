@@ -55,11 +55,14 @@ from orangewidget.widget import Input, Output
 
 from orangewidget.settings import Setting
 from oasys2.widget import gui as oasysgui
+from oasys2.widget.util import congruence
 from oasys2.widget.widget import OWLoopWidget, OWAction
 from oasys2.widget.gui import ConfirmDialog, Styles
 from oasys2.widget.util.widget_objects import TriggerIn, TriggerOut
 from oasys2.canvas.util.canvas_util import add_widget_parameters_to_module
 
+from orangecontrib.shadow4.util.shadow4_loops import LoopDispatcher
+
 class SourceSeedLoopPoint(OWLoopWidget):
 
     name = "Source Seed Loop Point"
@@ -81,8 +84,6 @@ class SourceSeedLoopPoint(OWLoopWidget):
 
     number_of_new_objects = Setting(1)
     current_new_object = 0
-    run_loop = True
-    suspend_loop = False
 
     seed_increment=Setting(1)
 
@@ -107,6 +108,8 @@ class SourceSeedLoopPoint(OWLoopWidget):
         self.runaction.triggered.connect(self.restartLoop)
         self.addAction(self.runaction)
 
+        self.dispatcher = LoopDispatcher(send_iteration=self.send_iteration, on_completed=self.end_loop)
+
         self.setFixedWidth(400)
         self.setFixedHeight(270)
 
@@ -144,73 +147,64 @@ class SourceSeedLoopPoint(OWLoopWidget):
         gui.rubber(self.controlArea)
 
     def startLoop(self):
-        self.current_new_object = 1
-        self.start_button.setEnabled(False)
-        self.setStatusMessage("Running " + self.get_object_name() + " " + str(self.current_new_object) + " of " + str(self.number_of_new_objects))
+        try:
+            self.number_of_new_objects = congruence.checkStrictlyPositiveNumber(self.number_of_new_objects, "Number of new " + self.get_object_name() + "s")
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+            return
 
-        self.Outputs.trigger_out.send(TriggerOut(new_object=True, additional_parameters={"seed_increment" : self.seed_increment}))
+        self.start_button.setEnabled(False)
+        self.dispatcher.start(1, self.number_of_new_objects)
 
     def stopLoop(self):
         if ConfirmDialog.confirmed(parent=self, message="Confirm Interruption of the Loop?"):
-            self.run_loop = False
             self.setStatusMessage("Interrupted by user")
+            self.dispatcher.stop()
 
     def suspendLoop(self):
         try:
             if ConfirmDialog.confirmed(parent=self, message="Confirm Suspension of the Loop?"):
-                self.run_loop = False
-                self.suspend_loop = True
+                self.dispatcher.suspend()
                 self.stop_button.setEnabled(False)
                 self.re_start_button.setEnabled(True)
                 self.setStatusMessage("Suspended by user")
         except:
             pass
 
-
     def restartLoop(self):
         try:
-            self.run_loop = True
-            self.suspend_loop = False
             self.stop_button.setEnabled(True)
             self.re_start_button.setEnabled(False)
-            self.passTrigger(TriggerIn(new_object=True))
+            self.dispatcher.resume()
         except:
             pass
 
+    def send_iteration(self, iteration):
+        self.current_new_object = iteration
+        self.setStatusMessage("Running " + self.get_object_name() + " " + str(self.current_new_object) + " of " + str(self.number_of_new_objects))
+
+        self.Outputs.trigger_out.send(TriggerOut(new_object=True, additional_parameters={"seed_increment"      : self.seed_increment,
+                                                                                         "seed_loop_iteration" : iteration}))
+
+    def end_loop(self):
+        self.current_new_object = 0
+        self.start_button.setEnabled(True)
+        self.stop_button.setEnabled(True)
+        self.re_start_button.setEnabled(False)
+        self.setStatusMessage("")
+        self.Outputs.trigger_out.send(TriggerOut(new_object=False))
+
     @Inputs.trigger_in
     def passTrigger(self, trigger):
-        if self.run_loop:
-            if trigger:
-                if trigger.interrupt:
-                    self.current_new_object = 0
-                    self.start_button.setEnabled(True)
-                    self.setStatusMessage("")
-                    self.Outputs.trigger_out.send(TriggerOut(new_object=False))
-                elif trigger.new_object:
-                    if self.current_new_object == 0:
-                        QMessageBox.critical(self, "Error", "Loop has to be started properly: press the button Start", QMessageBox.Ok)
-                        return
-
-                    if self.current_new_object < self.number_of_new_objects:
-                        self.current_new_object += 1
-                        self.setStatusMessage("Running " + self.get_object_name() + " " + str(self.current_new_object) + " of " + str(self.number_of_new_objects))
-                        self.start_button.setEnabled(False)
-                        self.Outputs.trigger_out.send(TriggerOut(new_object=True,
-                                                                 additional_parameters={"seed_increment" : self.seed_increment}))
-                    else:
-                        self.current_new_object = 0
-                        self.start_button.setEnabled(True)
-                        self.setStatusMessage("")
-                        self.Outputs.trigger_out.send(TriggerOut(new_object=False))
-        else:
-            if not self.suspend_loop:
-                self.current_new_object = 0
-                self.start_button.setEnabled(True)
-
-            self.Outputs.trigger_out.send(TriggerOut(new_object=False))
-            self.setStatusMessage("")
-            self.run_loop = True
-            self.suspend_loop = False
+        if trigger:
+            if trigger.interrupt:
+                self.dispatcher.interrupt()
+            elif trigger.new_object:
+                if self.current_new_object == 0:
+                    QMessageBox.critical(self, "Error", "Loop has to be started properly: press the button Start", QMessageBox.Ok)
+                    return
+
+                self.dispatcher.acknowledge()
 
     def get_object_name(self):
         return "Beam"
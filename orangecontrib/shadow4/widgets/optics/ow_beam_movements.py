@@ -19,7 +19,7 @@ from syned.widget.widget_decorator import WidgetDecorator
 from shadow4.beamline.optical_elements.ideal_elements.s4_beam_movement import S4BeamMovement, S4BeamMovementElement
 from shadow4.tools.logger import set_verbose
 
-from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData, PersistentBeamline
 from orangecontrib.shadow4.util.shadow4_util import ShadowCongruence
 
 class OWBeamMovement(GenericElement, WidgetDecorator, TriggerToolsDecorator):
@@ -227,7 +227,7 @@ class OWBeamMovement(GenericElement, WidgetDecorator, TriggerToolsDecorator):
 
             output_beam, _ = element.trace_beam()
 
-            beamline = self.input_data.beamline.duplicate()
+            beamline = PersistentBeamline.initialize_from_beamline(self.input_data.beamline)
             beamline.append_beamline_element(element)
 
             self._set_plot_quality()
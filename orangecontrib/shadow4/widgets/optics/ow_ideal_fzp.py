@@ -59,6 +59,8 @@ class OWIdealFZP(OWOpticalElement):
         oasysgui.lineEdit(box_ideal_fzp, self, "diameter_microns", "FZP diameter [microns]", labelWidth=260,
                           valueType=float, orientation="horizontal", tooltip="diameter_microns")
 
+    def get_drift_variables(self): return [] # the image plane distance is not used by the trace
+
     def get_coordinates_instance(self):
         return ElementCoordinates(
                 p=self.source_plane_distance,
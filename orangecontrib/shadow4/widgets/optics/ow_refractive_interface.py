@@ -202,6 +202,8 @@ class OWRefractiveInterface(OWOpticalElementWithSurfaceShape):
 
         gui.button(view_shape_box, self, "Render Surface Shape", callback=self.view_surface_shape_data)
 
+    def get_drift_variables(self): return [] # the image space is the second medium: not a drift in vacuum
+
     def get_optical_element_instance(self):
         try:     name = self.getNode().title
         except:  name = "Refractive Interface"
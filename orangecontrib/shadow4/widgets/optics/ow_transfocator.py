@@ -151,6 +151,8 @@ class OWTransfocator(OWOpticalElement):
                      label="CrossSec file", addSpace=True, orientation="horizontal")
 
 
+    def get_drift_variables(self): return [] # made of lenses: the image space can be a medium (refraction index, absorption)
+
     def get_optical_element_instance(self):
         try:
             name = self.getNode().title
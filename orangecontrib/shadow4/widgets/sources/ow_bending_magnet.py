@@ -14,6 +14,7 @@ from shadow4.sources.bending_magnet.s4_bending_magnet_light_source import S4Bend
 
 from orangecontrib.shadow4.widgets.gui.ow_synchrotron_source import OWSynchrotronSource
 from orangecontrib.shadow4.widgets.gui.plots import plot_data1D
+from orangecontrib.shadow4.util.shadow4_cache import LRUCache, BendingMagnetSamplingTables, get_cache_key
 
 class OWBendingMagnet(OWSynchrotronSource):
     name = "Bending Magnet"
@@ -29,6 +30,8 @@ class OWBendingMagnet(OWSynchrotronSource):
 
     plot_bm_graph = 1
 
+    spectrum_cache = LRUCache(maximum_size=8)
+
     def __init__(self):
         super().__init__()
 
@@ -44,6 +47,7 @@ class OWBendingMagnet(OWSynchrotronSource):
         box_2 = oasysgui.widgetBox(tab_bas, "Sampling rays", addSpace=True, orientation="vertical")
         oasysgui.lineEdit(box_2, self, "number_of_rays", "Number of Rays", tooltip="Number of Rays", labelWidth=250, valueType=int, orientation="horizontal")
         oasysgui.lineEdit(box_2, self, "seed", "Seed", tooltip="Seed (0=clock)", labelWidth=250, valueType=int, orientation="horizontal")
+        self.add_chunked_generation_fields(box_2)
 
 
         # bm adv settings
@@ -107,7 +111,7 @@ class OWBendingMagnet(OWSynchrotronSource):
         else:
             if self.light_source is None: return
 
-            e, f, w = self.light_source.calculate_spectrum()
+            e, f, w = self.__calculate_spectrum()
 
             self.plot_widget_item(e, f, 0,
                                   title="BM spectrum (current = %5.1f)"%self.ring_current,
@@ -117,6 +121,17 @@ class OWBendingMagnet(OWSynchrotronSource):
                                   title="BM spectrum (current = %5.1f)"%self.ring_current,
                                   xtitle="Photon energy [eV]",ytitle="Spectral power [W/eV]")
 
+    def __calculate_spectrum(self):
+        electron_beam = self.light_source.get_electron_beam()
+        bm            = self.light_source.get_magnetic_structure()
+
+        key = get_cache_key(electron_beam.energy(), electron_beam.current(), bm.radius(), bm.length(), bm._EMIN, bm._EMAX, bm._NG_E)
+
+        return self.spectrum_cache.get_or_compute(key, self.light_source.calculate_spectrum)
+
+    def get_beam_from_light_source(self, light_source, scanning_data=None):
+        with BendingMagnetSamplingTables.use(): return super().get_beam_from_light_source(light_source, scanning_data)
+
     def plot_widget_item(self,x,y,bm_plot_slot_index,title="",xtitle="",ytitle=""):
         self.bm_tab[bm_plot_slot_index].layout().removeItem(self.bm_tab[bm_plot_slot_index].layout().itemAt(0))
         plot_widget_id = plot_data1D(x.copy(),y.copy(),title=title,xtitle=xtitle,ytitle=ytitle,symbol='.')
@@ -20,10 +20,12 @@ from shadow4.beamline.s4_beamline import S4Beamline
 from shadow4.sources.source_geometrical.source_geometrical import SourceGeometrical
 from shadow4.tools.logger import set_verbose
 
-from orangecontrib.shadow4.util.shadow4_util import TriggerToolsDecorator
+from orangecontrib.shadow4.util.shadow4_util import TriggerToolsDecorator, ChunkedSourceDecorator
+from orangecontrib.shadow4.util.shadow4_cache import UserDefinedSpectrum
+from orangecontrib.shadow4.util.shadow4_loops import SourceAcceptance, AcceptanceMap, RejectionSource, RejectionLightSource
 from oasys2.widget.util.widget_objects import TriggerIn
 
-class OWGeometrical(GenericElement, TriggerToolsDecorator):
+class OWGeometrical(GenericElement, ChunkedSourceDecorator, TriggerToolsDecorator):
     name = "Geometrical Source"
     description = "Shadow Source: Geometrical Source"
     icon = "icons/geometrical.png"
@@ -39,6 +41,11 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
     number_of_rays = Setting(5000)
     seed = Setting(5676561)
 
+    chunked_generation = Setting(0)
+    chunk_size = Setting(100000)
+    independent_streams = Setting(0)
+    run_index = Setting(0)
+
     spatial_type = Setting(1)
 
     rect_width = Setting(0.1)
@@ -156,7 +163,7 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
         ##############################
         # MONTECARLO
 
-        left_box_1 = oasysgui.widgetBox(tab_basic, "Montecarlo", addSpace=True, orientation="vertical", height=100)
+        left_box_1 = oasysgui.widgetBox(tab_basic, "Montecarlo", addSpace=True, orientation="vertical", height=175)
 
         gui.separator(left_box_1)
 
@@ -166,6 +173,7 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
                           valueType=int, orientation="horizontal", tooltip="number_of_rays")
         oasysgui.lineEdit(self.sample_box_1, self, "seed", "Seed (0=clock)", labelWidth=260, valueType=int,
                           orientation="horizontal", tooltip="seed")
+        self.add_chunked_generation_fields(self.sample_box_1, labelWidth=260)
 
         ##############################
         # GEOMETRY
@@ -449,11 +457,10 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
 
         ##############################
 
-        # TODO implement
-        '''left_box_4 = oasysgui.widgetBox(tab_basic, "Reject Rays", addSpace=True, orientation="vertical", height=130)
+        left_box_4 = oasysgui.widgetBox(tab_basic, "Reject Rays", addSpace=True, orientation="vertical", height=130)
 
         gui.comboBox(left_box_4, self, "optimize_source", label="Optimize Source",
-                     items=["No", "Using file with phase/space volume)", "Using file with slit/acceptance"],
+                     items=["No", "Using file with phase space volume", "Using file with slit/acceptance", "Using acceptance map (pilot trace)"],
                      tooltip="optimize_source",
                      labelWidth=120, callback=self.set_OptimizeSource, orientation="horizontal")
         self.optimize_file_name_box = oasysgui.widgetBox(left_box_4, "", addSpace=False, orientation="vertical")
@@ -472,7 +479,7 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
                           tooltip="max_number_of_rejected_rays", labelWidth=280, valueType=int,
                           orientation="horizontal")
 
-        self.set_OptimizeSource()'''
+        self.set_OptimizeSource()
 
 
         gui.rubber(self.controlArea)
@@ -490,6 +497,7 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
         self.set_Depth()
         self.set_PhotonEnergyDistribution()
         # self.set_Polarization()
+        self.set_OptimizeSource()
 
     def set_OptimizeSource(self):
         self.optimize_file_name_box.setVisible(self.optimize_source != 0)
@@ -582,6 +590,32 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
     def selectOptimizeFile(self):
         self.le_optimize_file_name.setText(oasysgui.selectFileFromDialog(self, self.optimize_file_name, "Open Optimize Source Parameters File"))
 
+    def check_optimize_source(self):
+        if self.optimize_source != 0:
+            congruence.checkFile(self.optimize_file_name)
+            self.max_number_of_rejected_rays = congruence.checkPositiveNumber(self.max_number_of_rejected_rays, "Max number of rejected rays")
+            if self.chunked_generation == 1: raise ValueError("Chunked generation is not available with the source optimization")
+
+    def get_acceptance(self):
+        # optimize_source: 1 = phase space volume, 2 = slit/acceptance, 3 = acceptance map (from the Acceptance Map widget)
+        if self.optimize_source == 3: return AcceptanceMap.load(self.optimize_file_name)
+        else:                         return SourceAcceptance.load(self.optimize_source, self.optimize_file_name)
+
+    def get_beam_with_acceptance(self, light_source, acceptance):
+        rejection_source = RejectionSource(light_source,
+                                           acceptance,
+                                           self.number_of_rays,
+                                           self.max_number_of_rejected_rays)
+        output_beam = rejection_source.get_beam()
+
+        print("***** source optimization: %d rays accepted out of %d generated (efficiency %g)" % (rejection_source.accepted_rays,
+                                                                                                 rejection_source.generated_rays,
+                                                                                                 rejection_source.efficiency))
+        if rejection_source.accepted_rays < self.number_of_rays:
+            print("***** max number of rejected rays reached: %d rays instead of %d" % (rejection_source.accepted_rays, self.number_of_rays))
+
+        return output_beam
+
 
     def checkFields(self):
         # TODO: complete?
@@ -687,7 +721,7 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
         elif self.photon_energy_distribution == 4: # "Gaussian":
             gs.set_energy_distribution_gaussian(center=self.gaussian_central_value,sigma=self.gaussian_sigma,unit=unit)
         elif self.photon_energy_distribution == 5: # "User defined":
-            a = numpy.loadtxt(self.user_defined_file)
+            a = UserDefinedSpectrum.load(self.user_defined_file)
             gs.set_energy_distribution_userdefined(a[:,0],a[:,1],unit=unit)
 
 
@@ -699,8 +733,8 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
         return gs
 
     @Inputs.trigger
-    def set_trigger_parameters_for_optics(self, trigger):
-        super(OWGeometrical, self).set_trigger_parameters_for_optics(trigger)
+    def set_trigger_parameters_for_sources(self, trigger):
+        super(OWGeometrical, self).set_trigger_parameters_for_sources(trigger)
 
     def run_shadow4(self, scanning_data: ShadowData.ScanningData = None):
         try:
@@ -712,7 +746,11 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
 
             self.progressBarInit()
 
+            self.check_chunked_generation()
+            self.check_optimize_source()
+
             light_source = self.get_lightsource()
+            self.set_random_stream(light_source)
 
             # script
             script = light_source.to_python_code()
@@ -729,7 +767,14 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
             # run shadow4
             t00 = time.time()
             # beam = light_source.get_beam(NRAYS=self.number_of_rays, SEED=self.seed)
-            output_beam = light_source.get_beam()
+            with UserDefinedSpectrum.use():
+                if self.optimize_source == 0:
+                    output_beam = self.get_beam_from_light_source(light_source, scanning_data)
+                else:
+                    acceptance         = self.get_acceptance()
+                    output_beam        = self.get_beam_with_acceptance(light_source, acceptance)
+                    self.random_stream = None # rejected rays in between: not a stream to regenerate
+                    light_source       = RejectionLightSource(light_source, acceptance, self.max_number_of_rejected_rays) # the beamline regenerates accepted rays
             t11 = time.time() - t00
             print("***** time for %d rays: %f s, %f min, " % (self.number_of_rays, t11, t11 / 60))
 
@@ -747,6 +792,7 @@ class OWGeometrical(GenericElement, TriggerToolsDecorator):
                                      number_of_rays=self.number_of_rays,
                                      beamline=S4Beamline(light_source=light_source))
             output_data.scanning_data = scanning_data
+            output_data.random_stream = self.random_stream
 
             self.Outputs.shadow_data.send(output_data)
             self.Outputs.trigger.send(TriggerIn(new_object=True))
@@ -14,6 +14,7 @@ from shadow4.sources.undulator.s4_undulator_light_source import S4UndulatorLight
 
 from orangecontrib.shadow4.widgets.gui.ow_synchrotron_source import OWSynchrotronSource
 from orangecontrib.shadow4.widgets.gui.plots import plot_data1D, plot_data2D, plot_data3D
+from orangecontrib.shadow4.util.shadow4_cache import DiskCache, PrivateAttributes, get_cache_key
 
 class OWUndulator(OWSynchrotronSource):
     name = "Undulator Light Source"
@@ -58,6 +59,10 @@ class OWUndulator(OWSynchrotronSource):
 
     plot_undulator_graph = Setting(1)
 
+    use_radiation_cache = Setting(1)
+
+    radiation_cache = DiskCache("undulator_radiation")
+
     def __init__(self):
         super().__init__(show_energy_spread=True)
 
@@ -105,6 +110,7 @@ class OWUndulator(OWSynchrotronSource):
         left_box_12 = oasysgui.widgetBox(tab_undulator, "Sampling rays", addSpace=False, orientation="vertical")
         oasysgui.lineEdit(left_box_12, self, "number_of_rays", "Number of rays", labelWidth=260, valueType=int, orientation="horizontal")
         oasysgui.lineEdit(left_box_12, self, "seed", "Seed", tooltip="Seed (0=clock)", labelWidth=250, valueType=int, orientation="horizontal")
+        self.add_chunked_generation_fields(left_box_12)
 
         #
         # advanced settings
@@ -126,6 +132,9 @@ class OWUndulator(OWSynchrotronSource):
         oasysgui.lineEdit(left_box_11, self, "distance", "Distance to far field plane [m]", tooltip="distance",
                           labelWidth=300, valueType=float, orientation="horizontal")
 
+        orangegui.comboBox(left_box_11, self, "use_radiation_cache", label="Cache radiation on disk", tooltip="use_radiation_cache",
+                           items=["No", "Yes"], labelWidth=260, orientation="horizontal")
+
         # size sampling/ backpropagation
         left_box_11 = oasysgui.widgetBox(tab_advanced, "Size/backpropagation", addSpace=False, orientation="vertical")
 
@@ -268,10 +277,38 @@ class OWUndulator(OWSynchrotronSource):
             if self.is_monochromatic: light_source.set_energy_monochromatic_at_resonance(harmonic_number=self.harmonic)
             else:                     light_source.set_energy_at_resonance(harmonic_number=self.harmonic, delta_e=self.delta_e)
 
-
+        if self.use_radiation_cache == 1: self.__set_radiation_from_cache(light_source)
 
         return light_source
 
+    def __set_radiation_from_cache(self, light_source):
+        # the radiation depends only on these parameters: with a cached radiation, get_beam only samples the rays
+        results = PrivateAttributes(light_source, "S4UndulatorLightSource", ["result_radiation"])
+        if not results.is_available():
+            print(results.get_warning("radiation cache"))
+            return
+
+        electron_beam = light_source.get_electron_beam()
+        undulator     = light_source.get_magnetic_structure()
+
+        key = get_cache_key(electron_beam.energy(), electron_beam.current(),
+                            undulator.period_length(), undulator.number_of_periods(), undulator.K(), undulator.code_undul_phot,
+                            undulator._emin, undulator._emax, undulator._ng_e, undulator._maxangle, undulator._ng_t, undulator._ng_p, undulator._ng_j,
+                            undulator._flag_size, undulator._distance, undulator._magnification,
+                            undulator._flag_backprop_recalculate_source, undulator._flag_backprop_weight, undulator._weight_ratio,
+                            undulator._srw_range, undulator._srw_resolution, undulator._srw_semianalytical)
+
+        radiation = self.radiation_cache.load(key)
+
+        if radiation is None:
+            self.radiation_cache.save(key, light_source.get_result_dictionary()) # calculated here, saved as a copy
+        else:
+            # a private copy: the sampling adds entries to the dictionary and scales the backpropagated radiation in place
+            radiation["info"] = light_source.info()
+
+            results.set("result_radiation", radiation)
+            print("***** radiation from the cache: " + self.radiation_cache.get_directory())
+
     def get_title_for_stack_view_flux(self, idx):
         photon_energy = self.light_source.get_result_dictionary()['photon_energy']
         return "Units: Photons/s/eV/rad2; Photon energy: %8.3f eV"%(photon_energy[idx])
@@ -13,6 +13,7 @@ from shadow4.sources.wiggler.s4_wiggler_optimized_light_source import S4WigglerO
 
 from orangecontrib.shadow4.widgets.gui.ow_synchrotron_source import OWSynchrotronSource
 from orangecontrib.shadow4.widgets.gui.plots import plot_data1D
+from orangecontrib.shadow4.util.shadow4_cache import DiskCache, PrivateAttributes, get_cache_key, get_local_copy, get_file_hash
 
 class OWWiggler(OWSynchrotronSource):
     name = "Wiggler Light Source"
@@ -55,8 +56,12 @@ class OWWiggler(OWSynchrotronSource):
     optim_slit_gap_z = Setting(1.0)
     optim_max_iterations = Setting(10)
 
+    use_trajectory_cache = Setting(1)
+
     beam_out = None
 
+    trajectory_cache = DiskCache("wiggler_trajectory")
+
     def __init__(self):
         super().__init__()
 
@@ -109,12 +114,13 @@ class OWWiggler(OWSynchrotronSource):
         self.set_shift_beta_X_flag()
 
         # Calculation Box
-        left_box_11 = oasysgui.widgetBox(tab_wiggler, "Sampling rays", addSpace=False, orientation="vertical", height=200)
+        left_box_11 = oasysgui.widgetBox(tab_wiggler, "Sampling rays", addSpace=False, orientation="vertical", height=275)
 
         oasysgui.lineEdit(left_box_11, self, "e_min", "Min photon energy [eV]", tooltip="e_min", labelWidth=260, valueType=float, orientation="horizontal")
         oasysgui.lineEdit(left_box_11, self, "e_max", "Max photon energy [eV]", tooltip="e_max", labelWidth=260, valueType=float, orientation="horizontal")
         oasysgui.lineEdit(left_box_11, self, "number_of_rays", "Number of rays", tooltip="number_of_rays", labelWidth=260, valueType=int, orientation="horizontal")
         oasysgui.lineEdit(left_box_11, self, "seed", "Seed", tooltip="seed", labelWidth=250, valueType=int, orientation="horizontal")
+        self.add_chunked_generation_fields(left_box_11)
 
         self.set_shift_X_flag()
         self.set_shift_beta_X_flag()
@@ -123,12 +129,14 @@ class OWWiggler(OWSynchrotronSource):
         # wiggler adv settings
         tab_advanced = oasysgui.createTabPage(self.tabs_control_area, "Advanced")
 
-        left_box_adv = oasysgui.widgetBox(tab_advanced, "Advanced settings", addSpace=False, orientation="vertical", height=180)
+        left_box_adv = oasysgui.widgetBox(tab_advanced, "Advanced settings", addSpace=False, orientation="vertical", height=205)
         oasysgui.lineEdit(left_box_adv, self, "ng_e", "Number of Points in energy scan", labelWidth=260, tooltip="ng_e", valueType=int, orientation="horizontal")
         oasysgui.lineEdit(left_box_adv, self, "ng_j", "Number of Points in e trajectory (per period)", labelWidth=280, tooltip="ng_j", valueType=int, orientation="horizontal")
         oasysgui.lineEdit(left_box_adv, self, "psi_interval_number_of_points", "Number of Points in sampling vertical angle", labelWidth=280, tooltip="psi_interval_number_of_points", valueType=int, orientation="horizontal")
         orangegui.comboBox(left_box_adv, self, "flag_interpolation", tooltip="flag_interpolation", label="Sample psi via interpolation",
                            items=["No (accurate, exact Bessel)", "Yes (good for mono or quasi monochromatic)", "Yes (ray by ray)"], labelWidth=260, orientation="horizontal")
+        orangegui.comboBox(left_box_adv, self, "use_trajectory_cache", tooltip="use_trajectory_cache", label="Cache trajectory and CDF on disk",
+                           items=["No", "Yes"], labelWidth=260, orientation="horizontal")
 
         # adv / optimization
         left_box_opt = oasysgui.widgetBox(tab_advanced, "Optimized source by rejection (acceptance slit)", addSpace=False, orientation="vertical", height=300)
@@ -304,10 +312,50 @@ class OWWiggler(OWSynchrotronSource):
                                                optim_beamline_element=None,
                                                          )
 
+        if self.use_trajectory_cache == 1: self.__set_trajectory_from_cache(light_source)
 
+        return light_source
 
+    def __set_trajectory_from_cache(self, light_source):
+        # trajectory and CDF depend only on these parameters: with them cached, get_beam only samples the rays
+        results = PrivateAttributes(light_source, "S4WigglerLightSource", ["calculate_radiation", "result_trajectory", "result_parameters", "result_cdf"])
+        if not results.is_available():
+            print(results.get_warning("trajectory cache"))
+            return
 
-        return light_source
+        electron_beam = light_source.get_electron_beam()
+        wiggler       = light_source.get_magnetic_structure()
+
+        if wiggler._magnetic_field_periodic == 1:
+            field = (wiggler.K_vertical(), wiggler.period_length(), wiggler.number_of_periods())
+        else:
+            local_file_name = get_local_copy(wiggler._file_with_magnetic_field) # a URL is downloaded only once
+            field = get_file_hash(local_file_name)
+
+        key = get_cache_key(type(light_source).__name__, electron_beam._energy_in_GeV, wiggler._magnetic_field_periodic, field,
+                            wiggler._NG_J, wiggler._shift_x_flag, wiggler._shift_x_value, wiggler._shift_betax_flag, wiggler._shift_betax_value,
+                            wiggler._EMIN, wiggler._EMAX, 1 if wiggler.is_monochromatic() else wiggler._NG_E)
+
+        cached = self.trajectory_cache.load(key)
+
+        if cached is None:
+            if wiggler._magnetic_field_periodic == 0:
+                file_with_magnetic_field = wiggler._file_with_magnetic_field
+                wiggler._file_with_magnetic_field = local_file_name
+            try:
+                results.get("calculate_radiation")()
+            finally:
+                if wiggler._magnetic_field_periodic == 0: wiggler._file_with_magnetic_field = file_with_magnetic_field # the script keeps the original
+
+            self.trajectory_cache.save(key, {"trajectory" : results.get("result_trajectory"),
+                                             "parameters" : results.get("result_parameters"),
+                                             "cdf"        : results.get("result_cdf")})
+        else:
+            results.set("result_trajectory", cached["trajectory"])
+            results.set("result_parameters", cached["parameters"])
+            results.set("result_cdf",        cached["cdf"])
+
+            print("***** trajectory and CDF from the cache: " + self.trajectory_cache.get_directory())
 
     def refresh_specific_plots(self):
         if self.plot_wiggler_graph == 0:
@@ -0,0 +1,129 @@
+import os
+
+from orangewidget import gui
+from orangewidget.settings import Setting
+
+from AnyQt.QtWidgets import QMessageBox
+
+from orangewidget.widget import Input
+
+from oasys2.widget import gui as oasysgui
+from oasys2.widget.util import congruence
+from oasys2.widget.widget import OWWidget, OWAction
+from oasys2.canvas.util.canvas_util import add_widget_parameters_to_module
+
+from orangecontrib.shadow4.util.shadow4_objects import ShadowData
+from orangecontrib.shadow4.util.shadow4_util import ShadowCongruence
+from orangecontrib.shadow4.util.shadow4_loops import AcceptanceMap
+
+class OWAcceptanceMap(OWWidget):
+    name = "Acceptance Map"
+    description = "Tools: Acceptance Map of the source (pilot trace)"
+    icon = "icons/acceptance_map.png"
+    maintainer = "Luca Rebuffi"
+    maintainer_email = "lrebuffi(@at@)anl.gov"
+    priority = 8.2
+    category = "Tools"
+    keywords = ["source", "acceptance", "pilot", "optimize", "reject"]
+
+    want_main_area = 0
+
+    pilot_number_of_rays     = Setting(200000)
+    pilot_seed               = Setting(5676561)
+    number_of_bins           = Setting(16)
+    margin_bins              = Setting(1)
+    acceptance_map_file_name = Setting("acceptance_map.npz")
+
+    class Inputs:
+        shadow_data = Input("Shadow Data", ShadowData, default=True, auto_summary=False)
+
+    input_data = None
+
+    def __init__(self):
+        super().__init__()
+
+        self.runaction = OWAction("Run Pilot Trace", self)
+        self.runaction.triggered.connect(self.run_pilot_trace)
+        self.addAction(self.runaction)
+
+        self.setFixedWidth(590)
+        self.setFixedHeight(480)
+
+        left_box_1 = oasysgui.widgetBox(self.controlArea, "Pilot Trace", addSpace=True, orientation="vertical", width=570, height=210)
+
+        oasysgui.lineEdit(left_box_1, self, "pilot_number_of_rays", "Number of rays", tooltip="pilot_number_of_rays", labelWidth=300, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(left_box_1, self, "pilot_seed", "Seed", tooltip="pilot_seed", labelWidth=300, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(left_box_1, self, "number_of_bins", "Bins per coordinate (x, z, x', z', E)", tooltip="number_of_bins", labelWidth=300, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(left_box_1, self, "margin_bins", "Margin around the useful bins", tooltip="margin_bins", labelWidth=300, valueType=int, orientation="horizontal")
+
+        file_box = oasysgui.widgetBox(left_box_1, "", addSpace=True, orientation="horizontal", width=550, height=35)
+
+        self.le_acceptance_map_file_name = oasysgui.lineEdit(file_box, self, "acceptance_map_file_name", "Acceptance Map File",
+                                                             tooltip="acceptance_map_file_name", labelWidth=140, valueType=str, orientation="horizontal")
+        self.le_acceptance_map_file_name.setFixedWidth(330)
+
+        gui.button(file_box, self, "...", callback=self.selectFile)
+
+        button = gui.button(self.controlArea, self, "Run Pilot Trace", callback=self.run_pilot_trace)
+        button.setFixedHeight(45)
+        button.setFixedWidth(570)
+
+        result_box = oasysgui.widgetBox(self.controlArea, "Result", addSpace=True, orientation="vertical", width=570, height=150)
+
+        self.result_text = oasysgui.textArea(height=110)
+        result_box.layout().addWidget(self.result_text)
+
+        gui.rubber(self.controlArea)
+
+    def selectFile(self):
+        self.le_acceptance_map_file_name.setText(
+            oasysgui.selectSaveFileFromDialog(self, self.acceptance_map_file_name, default_file_name="acceptance_map.npz",
+                                              file_extension_filter="Numpy Files (*.npz)"))
+
+    @Inputs.shadow_data
+    def set_shadow_data(self, input_data: ShadowData):
+        if ShadowCongruence.check_empty_data(input_data):
+            self.input_data = input_data
+        else:
+            QMessageBox.critical(self, "Error", "Empty input data or empty beam", QMessageBox.Ok)
+
+    def run_pilot_trace(self):
+        self.setStatusMessage("")
+
+        try:
+            if not ShadowCongruence.check_empty_data(self.input_data): raise ValueError("Empty input data or empty beam")
+            if self.input_data.beamline is None:                        raise ValueError("No beamline available in Shadow Data")
+
+            congruence.checkStrictlyPositiveNumber(self.pilot_number_of_rays, "Number of rays")
+            congruence.checkStrictlyPositiveNumber(self.pilot_seed, "Seed")
+            congruence.checkStrictlyPositiveNumber(self.number_of_bins, "Bins per coordinate")
+            congruence.checkPositiveNumber(self.margin_bins, "Margin")
+            congruence.checkFileName(self.acceptance_map_file_name)
+
+            acceptance_map, statistics = AcceptanceMap.from_pilot_trace(self.input_data.beamline,
+                                                                        self.pilot_number_of_rays,
+                                                                        self.pilot_seed,
+                                                                        self.number_of_bins,
+                                                                        self.margin_bins)
+            acceptance_map.save(self.acceptance_map_file_name)
+
+            text  = "Pilot transmission:            %g\n" % statistics["transmission"]
+            text += "Source rays in accepted region: %g\n" % statistics["accepted fraction"]
+            text += "Expected speed-up:             %.1f\n" % statistics["speed-up"]
+            text += "Estimated coverage:            %g\n" % statistics["estimated coverage"]
+            if not statistics["estimated coverage"] >= 0.99:
+                text += "\nWarning: the map may lose surviving rays, increase the pilot rays or the margin"
+            self.result_text.setText(text)
+
+            _, file_name = os.path.split(self.acceptance_map_file_name)
+
+            self.setStatusMessage("Current: " + file_name)
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+add_widget_parameters_to_module(__name__)
+
+if __name__ == "__main__":
+    from orangewidget.utils.widgetpreview import WidgetPreview
+
+    WidgetPreview(OWAcceptanceMap).run()
@@ -19,6 +19,7 @@ from orangecontrib.shadow4.util.shadow4_util import ShadowCongruence
 from orangecontrib.shadow4.widgets.gui.ow_automatic_element import AutomaticElement
 from orangecontrib.shadow4.widgets.gui.plots import plot_data1D, plot_data2D, plot_data3D
 from orangecontrib.shadow4.util.python_script import PythonScript
+from orangecontrib.shadow4.util.shadow4_caustic import BeamRetracer, FocusFinder, get_fwhms
 
 from srxraylib.util.h5_simple_writer import H5SimpleWriter
 
@@ -55,9 +56,25 @@ class OWCaustic(AutomaticElement):
     x_min = Setting(-0.2)
     x_max = Setting( 0.2)
 
+    caustic_type   = Setting(0)
+    z_min          = Setting(-0.2)
+    z_max          = Setting( 0.2)
+    display_column = Setting(0)
+    display_plane  = Setting(0)
+
+    caustic_cube     = None
+    caustic_cube_key = None
+
     save_h5_file_flag = Setting(0)
     save_h5_file_name = Setting("caustic.h5")
 
+    focus_direction = Setting(0)
+    focus_size      = Setting(0)
+
+    focus_position       = 0.0
+    focus_waist_size     = 0.0
+    focus_depth_of_focus = 0.0
+
     def __init__(self, show_automatic_box=True):
         super().__init__(show_automatic_box=show_automatic_box)
 
@@ -80,15 +97,50 @@ class OWCaustic(AutomaticElement):
         oasysgui.lineEdit(box_y, self, "y_max", "Y max"+ " [m]", labelWidth=260, valueType=float, orientation="horizontal")
 
 
-        gui.comboBox(general_box, self, "shadow_column", label="Scan direction",labelWidth=220,
+        gui.comboBox(general_box, self, "caustic_type", label="Caustic",labelWidth=220,
+                                     items=["1D (scan direction)","2D (X-Z cube)"],
+                                     sendSelectedValue=False, orientation="horizontal", callback=self.set_visible)
+
+        self.box_1d = oasysgui.widgetBox(general_box, "", orientation="vertical")
+
+        gui.comboBox(self.box_1d, self, "shadow_column", label="Scan direction",labelWidth=220,
                                      items=["X (col 1)","Z (col 3)", "R (col 20)"],
                                      sendSelectedValue=False, orientation="horizontal")
 
-        box_x = oasysgui.widgetBox(general_box, "Scan direction", orientation="vertical", height=100)
+        box_x = oasysgui.widgetBox(general_box, "Scan direction (X in 2D)", orientation="vertical", height=100)
         oasysgui.lineEdit(box_x, self, "npoints_x", "Points", labelWidth=260, valueType=int,orientation="horizontal")
         oasysgui.lineEdit(box_x, self, "x_min", "min"+ " [m]", labelWidth=260, valueType=float, orientation="horizontal")
         oasysgui.lineEdit(box_x, self, "x_max", "max"+ " [m]", labelWidth=260, valueType=float, orientation="horizontal")
 
+        self.box_2d = oasysgui.widgetBox(general_box, "Z (col 3)", orientation="vertical", height=160)
+        oasysgui.lineEdit(self.box_2d, self, "npoints_z", "Points", labelWidth=260, valueType=int,orientation="horizontal")
+        oasysgui.lineEdit(self.box_2d, self, "z_min", "min"+ " [m]", labelWidth=260, valueType=float, orientation="horizontal")
+        oasysgui.lineEdit(self.box_2d, self, "z_max", "max"+ " [m]", labelWidth=260, valueType=float, orientation="horizontal")
+
+        gui.comboBox(self.box_2d, self, "display_column", label="Displayed caustic",labelWidth=220,
+                                     items=["X (col 1)","Z (col 3)"],
+                                     sendSelectedValue=False, orientation="horizontal", callback=self.plot_cube)
+        oasysgui.lineEdit(self.box_2d, self, "display_plane", "Displayed X-Z plane (index)", labelWidth=260, valueType=int, orientation="horizontal",
+                          callback=self.plot_cube)
+
+        focus_box = oasysgui.widgetBox(self.controlArea, "Find Focus", orientation="vertical")
+
+        gui.comboBox(focus_box, self, "focus_direction", label="Direction", labelWidth=220,
+                                     items=["H (col 1)", "V (col 3)", "Both"],
+                                     sendSelectedValue=False, orientation="horizontal")
+
+        gui.comboBox(focus_box, self, "focus_size", label="Beam size", labelWidth=220,
+                                     items=["RMS", "FWHM"],
+                                     sendSelectedValue=False, orientation="horizontal")
+
+        gui.button(focus_box, self, "Find Focus", callback=self.find_focus, height=30)
+
+        for attribute, label in [("focus_position",       "Waist position [m]"),
+                                 ("focus_waist_size",     "Waist size [um]"),
+                                 ("focus_depth_of_focus", "Depth of focus [m]")]:
+            le = oasysgui.lineEdit(focus_box, self, attribute, label, labelWidth=220, valueType=float, orientation="horizontal")
+            le.setReadOnly(True)
+
         gui.separator(self.controlArea, height=200)
 
         box_file = oasysgui.widgetBox(general_box, "File", orientation="vertical", height=100)
@@ -116,6 +168,9 @@ class OWCaustic(AutomaticElement):
         tmp = oasysgui.createTabPage(tabs_setting, "I0(y)")
         self.box_I0 = gui.widgetBox(tmp, "", orientation="vertical")
 
+        tmp = oasysgui.createTabPage(tabs_setting, "X-Z at plane")
+        self.box_plane = gui.widgetBox(tmp, "", orientation="vertical")
+
         tab_out = oasysgui.createTabPage(tabs_setting, "Output")
         self.output_text = oasysgui.textArea()
         info_box = oasysgui.widgetBox(tab_out, "", orientation="horizontal")
@@ -131,6 +186,8 @@ class OWCaustic(AutomaticElement):
 
     def set_visible(self):
         self.box_file_1.setVisible(self.save_h5_file_flag != 0)
+        self.box_1d.setVisible(self.caustic_type == 0)
+        self.box_2d.setVisible(self.caustic_type == 1)
 
     def writeStdOut(self, text="", initialize=False):
         cursor = self.output_text.textCursor()
@@ -144,7 +201,8 @@ class OWCaustic(AutomaticElement):
     def set_shadow_data(self, shadow_data: ShadowData):
         if ShadowCongruence.check_empty_data(shadow_data):
             if ShadowCongruence.check_empty_beam(shadow_data.beam):
-                self.input_data = shadow_data
+                self.input_data   = shadow_data
+                self.caustic_cube = None
                 if self.is_automatic_run: self.calculate()
             else:
                 MessageDialog.message(self, "Data not displayable: bad content", "Error", "critical")
@@ -168,10 +226,6 @@ class OWCaustic(AutomaticElement):
 
         positions = numpy.linspace(self.y_min, self.y_max, self.npositions)
 
-        out_x = numpy.zeros((self.npoints_x, self.npositions))
-        fwhm = numpy.zeros(self.npositions)
-        center = numpy.zeros(self.npositions)
-
         if self.shadow_column == 0:
             col = 1
         elif self.shadow_column == 1:
@@ -188,44 +242,100 @@ class OWCaustic(AutomaticElement):
 
         self.progressBarSet(10)
         self.setStatusMessage("Retracing...")
-        print(f"{'position index':<20} {'distance [m]':<20} {'peak center at [m]':<20} {'peak value I0':<20} {'fwhm [m]':<20}")
-        print("-" * 20 * 6)
 
-        for i in range(self.npositions):
-            beami = beam_to_analyze.duplicate()
-            beami.retrace(positions[i], resetY=True)
-            tkt_x = beami.histo1(col, xrange=[self.x_min, self.x_max], nbins=self.npoints_x, nolost=self.no_lost, ref=ref)
-            out_x[:, i] = tkt_x["histogram"]
-            fwhm[i] = tkt_x["fwhm"]
+        # all the planes at once, with no copies of the beam
+        retracer = BeamRetracer(beam_to_analyze, nolost=self.no_lost, ref=ref)
 
-            if ref == 23:
-                center[i] = numpy.average(beami.get_column(col, nolost=self.no_lost),
-                                          weights=beami.get_column(23, nolost=self.no_lost))
-            else:
-                center[i] = numpy.average(beami.get_column(col,nolost=self.no_lost))
+        if self.caustic_type == 1:
+            cube_key = (id(beam_to_analyze), self.y_min, self.y_max, self.npositions, self.x_min, self.x_max, self.npoints_x,
+                        self.z_min, self.z_max, self.npoints_z, self.no_lost, ref)
 
-            if numpy.mod(i, 10) == 0:
-                self.progressBarSet(10 + 85 * i / self.npositions)
-                I0 = out_x.T[i, self.npoints_x // 2]
-                print(f"{i           :<30d} "
-                      f"{positions[i]:<30.4g} "
-                      f"{center[i]   :<30.4g} "
-                      f"{I0          :<30.4g} "
-                      f"{fwhm[i]     :<30.4g}")
+            if self.caustic_cube is None or self.caustic_cube_key != cube_key:
+                self.caustic_cube     = retracer.histograms2d(positions, xrange=[self.x_min, self.x_max], zrange=[self.z_min, self.z_max],
+                                                              nbins_x=self.npoints_x, nbins_z=self.npoints_z)
+                self.caustic_cube_key = cube_key
 
-        #
-        # plots
-        #
-        print("\nResult arrays X,Y (shapes): ", out_x.shape, tkt_x["bin_center"].shape, positions.shape )
-        x = tkt_x["bin_center"]
-        y = positions
+            self.progressBarSet(90)
 
-        if self.shadow_column == 0:
-            col_title="X (col 1)"
-        elif self.shadow_column == 1:
-            col_title = "Z (col 3)"
-        elif self.shadow_column == 2:
-            col_title = "R (col 20)"
+            print("\nResult cube (planes, X, Z) (shape): ", self.caustic_cube["cube"].shape)
+
+            self.plot_cube(save_file=self.save_h5_file_flag == 1)
+        else:
+            tkt_x = retracer.histograms(col, positions, xrange=[self.x_min, self.x_max], nbins=self.npoints_x)
+
+            out_x  = tkt_x["histogram"]
+            fwhm   = tkt_x["fwhm"]
+            center = tkt_x["center"]
+
+            self.progressBarSet(90)
+
+            self.print_caustic(out_x, positions, fwhm, center)
+
+            print("\nResult arrays X,Y (shapes): ", out_x.shape, tkt_x["bin_center"].shape, positions.shape )
+
+            if self.shadow_column == 0:
+                col_title="X (col 1)"
+            elif self.shadow_column == 1:
+                col_title = "Z (col 3)"
+            elif self.shadow_column == 2:
+                col_title = "R (col 20)"
+
+            self.plot_caustic(out_x, tkt_x["bin_center"], positions, fwhm, center, col_title, [self.x_min, self.x_max],
+                              save_file=self.save_h5_file_flag == 1)
+
+        self.setStatusMessage("")
+        self.progressBarFinished()
+
+    def plot_cube(self, save_file=False):
+        # from the cached cube: changing the displayed column or plane does not retrace
+        if self.caustic_cube is None: return
+
+        cube      = self.caustic_cube["cube"]
+        positions = numpy.linspace(self.caustic_cube_key[1], self.caustic_cube_key[2], self.caustic_cube_key[3])
+
+        if self.display_column == 0:
+            out_x, x, col_title, xrange = cube.sum(axis=2).T, self.caustic_cube["bin_center_x"], "X (col 1)", [self.x_min, self.x_max]
+            bins = self.caustic_cube["bins_x"]
+        else:
+            out_x, x, col_title, xrange = cube.sum(axis=1).T, self.caustic_cube["bin_center_z"], "Z (col 3)", [self.z_min, self.z_max]
+            bins = self.caustic_cube["bins_z"]
+
+        # only the rays inside the X-Z window contribute to the projections
+        intensity = out_x.sum(axis=0)
+        center    = numpy.divide(numpy.sum(out_x * x[:, numpy.newaxis], axis=0), intensity, out=numpy.full(intensity.shape, numpy.nan), where=intensity != 0)
+
+        fwhm = get_fwhms(out_x, bins)
+
+        self.print_caustic(out_x, positions, fwhm, center)
+        self.plot_caustic(out_x, x, positions, fwhm, center, col_title, xrange, save_file=save_file)
+
+        self.display_plane = min(max(0, self.display_plane), len(positions) - 1)
+
+        plot_canvas = plot_data2D(cube[self.display_plane], 1e6 * self.caustic_cube["bin_center_x"], 1e6 * self.caustic_cube["bin_center_z"],
+                                  title="Y = %g m" % positions[self.display_plane], xtitle="X [um]", ytitle="Z [um]")
+        self.box_plane.layout().removeItem(self.box_plane.layout().itemAt(0))
+        self.box_plane.layout().addWidget(plot_canvas)
+
+        if save_file:
+            h5w = H5SimpleWriter(self.save_h5_file_name, creator="h5_basic_writer.py")
+            h5w.add_stack(positions, 1e6 * self.caustic_cube["bin_center_x"], 1e6 * self.caustic_cube["bin_center_z"], cube,
+                          stack_name="cube", entry_name="caustic",
+                          title_0="Y [m]", title_1="X [um]", title_2="Z [um]")
+
+    def print_caustic(self, out_x, positions, fwhm, center):
+        print(f"{'position index':<20} {'distance [m]':<20} {'peak center at [m]':<20} {'peak value I0':<20} {'fwhm [m]':<20}")
+        print("-" * 20 * 6)
+
+        for i in range(0, len(positions), 10):
+            I0 = out_x.T[i, out_x.shape[0] // 2]
+            print(f"{i           :<30d} "
+                  f"{positions[i]:<30.4g} "
+                  f"{center[i]   :<30.4g} "
+                  f"{I0          :<30.4g} "
+                  f"{fwhm[i]     :<30.4g}")
+
+    def plot_caustic(self, out_x, x, positions, fwhm, center, col_title, xrange, save_file=False):
+        y = positions
 
         plot_canvas = plot_data2D(
                              out_x.T, y, 1e6 * x,
@@ -250,10 +360,10 @@ class OWCaustic(AutomaticElement):
         #center
         self.box_center.layout().removeItem(self.box_center.layout().itemAt(0))
         plot_widget_id = plot_data1D(y, 1e6 * center,title="CENTER",xtitle="y [m]", ytitle="CENTER [um]",symbol='.',
-                                     yrange=[1e6 * self.x_min, 1e6 * self.x_max])
+                                     yrange=[1e6 * xrange[0], 1e6 * xrange[1]])
         self.box_center.layout().addWidget(plot_widget_id)
 
-        if self.save_h5_file_flag:
+        if save_file:
 
             h5w = H5SimpleWriter.initialize_file(self.save_h5_file_name, creator="h5_basic_writer.py")
 
@@ -276,8 +386,41 @@ class OWCaustic(AutomaticElement):
                             entry_name="caustic", dataset_name="I0",
                             title_x="Y [m]", title_y="I at central profile")
 
-        self.setStatusMessage("")
-        self.progressBarFinished()
+    def find_focus(self):
+        # bracketed minimization on the analytical retrace: a few tens of planes instead of the dense scan
+        try:
+            if not ShadowCongruence.check_empty_data(self.input_data):
+                print("No SHADOW Beam")
+                return
+
+            self.writeStdOut(initialize=True)
+            sys.stdout = EmittingStream(textWritten=self.writeStdOut)
+
+            self.setStatusMessage("Finding focus...")
+
+            retracer = BeamRetracer(self.input_data.beam, nolost=self.no_lost, ref=23 if self.use_reflectivity else 0)
+            finder   = FocusFinder(retracer,
+                                   direction=FocusFinder.DIRECTIONS[self.focus_direction],
+                                   kind=FocusFinder.KINDS[self.focus_size],
+                                   xrange=[self.x_min, self.x_max],
+                                   nbins=self.npoints_x)
+
+            result = finder.find_focus(self.y_min, self.y_max)
+
+            self.focus_position       = round(float(result["position"]), 6)
+            self.focus_waist_size     = round(1e6 * float(result["size"]), 6)
+            self.focus_depth_of_focus = round(float(result["depth_of_focus"]), 6)
+
+            print("Waist position [m]: %g" % result["position"])
+            print("Waist size [um]:    %g" % (1e6 * result["size"]))
+            print("Depth of focus [m]: %g (limits: %g, %g, nan = outside [%g, %g])" % (result["depth_of_focus"], *result["depth_of_focus_limits"], self.y_min, self.y_max))
+            print("Planes evaluated:   %d" % result["number_of_evaluations"])
+        except Exception as exception:
+            MessageDialog.message(self, str(exception), "Error", "critical")
+
+            if self.IS_DEVELOP: raise exception
+        finally:
+            self.setStatusMessage("")
 
     def set_script(self):
         # script
@@ -16,8 +16,9 @@ from orangecontrib.shadow4.util.shadow4_objects import ShadowData
 from orangecontrib.shadow4.util.shadow4_util import ShadowCongruence
 from orangecontrib.shadow4.widgets.gui.plots import plot_multi_data1D
 from orangecontrib.shadow4.util.python_script import PythonScript
+from orangecontrib.shadow4.util.shadow4_caustic import focnew_scan_beams_at_elements
 
-from shadow4.tools.beamline_tools import focnew, focnew_scan, focnew_scan_full_beamline
+from shadow4.tools.beamline_tools import focnew, focnew_scan
 from shadow4.tools.logger import set_verbose
 
 class FocNew(AutomaticElement):
@@ -194,7 +195,11 @@ class FocNew(AutomaticElement):
         self.image_box.layout().addWidget(self.plot_canvas_x)
 
     def do_plot_beamline(self):
-        ticket = focnew_scan_full_beamline(self.input_data.beamline, npoints=self.npoints_beamline)
+        # beams stored in the beamline by the upstream widgets: only the missing ones are re-traced
+        ticket = focnew_scan_beams_at_elements(self.input_data.beamline, last_beam=self.input_data.beam, npoints=int(self.npoints_beamline))
+
+        if len(ticket['retraced_elements']) > 0:
+            print("Beams re-traced for the full beamline scan at: " + ", ".join(["source" if index < 0 else "oe %d" % (index + 1) for index in ticket['retraced_elements']]))
 
         self.plot_canvas_bl = plot_multi_data1D(ticket['list_y'] + ticket['list_y'],
                                                 ticket['list_x'] + ticket['list_z'],
@@ -18,6 +18,7 @@ from orangecontrib.shadow4.util.shadow4_objects import ShadowData
 from orangecontrib.shadow4.util.shadow4_util import ShadowCongruence, ShadowPlot
 from orangecontrib.shadow4.widgets.gui.ow_automatic_element import AutomaticElement
 from orangecontrib.shadow4.util.python_script import PythonScript
+from orangecontrib.shadow4.util.shadow4_compact import get_beam_copy, parse_columns, validate_compact_beam, get_validation_text, RAYS_STORAGE_ITEMS, DEFAULT_FULL_PRECISION_COLUMNS
 from shadow4.beam.s4_beam import S4Beam
 
 class Histogram(AutomaticElement):
@@ -65,6 +66,8 @@ class Histogram(AutomaticElement):
     autosave_partial_results = Setting(0)
 
     conversion_active = Setting(1)
+    rays_storage      = Setting(0)
+    full_precision_columns = Setting(DEFAULT_FULL_PRECISION_COLUMNS)
 
     cumulated_ticket = None
     plotted_ticket   = None
@@ -155,12 +158,17 @@ class Histogram(AutomaticElement):
 
         gui.button(incremental_box, self, "Clear", callback=self.clear_results)
 
-        histograms_box = oasysgui.widgetBox(tab_gen, "Histograms settings", addSpace=True, orientation="vertical", height=90)
+        histograms_box = oasysgui.widgetBox(tab_gen, "Histograms settings", addSpace=True, orientation="vertical", height=140)
 
         oasysgui.lineEdit(histograms_box, self, "number_of_bins", "Number of Bins", labelWidth=250, valueType=int, orientation="horizontal")
 
         gui.comboBox(histograms_box, self, "conversion_active", label="Is U.M. conversion active", labelWidth=250,
                      items=["No", "Yes"], sendSelectedValue=False, orientation="horizontal", callback=self.set_is_conversion_active)
+        gui.comboBox(histograms_box, self, "rays_storage", label="Rays of the retraced copies", labelWidth=150,
+                     items=RAYS_STORAGE_ITEMS, sendSelectedValue=False, orientation="horizontal", callback=self.set_rays_storage)
+        self.le_full_precision_columns = oasysgui.lineEdit(histograms_box, self, "full_precision_columns", "Full precision columns (float64)", labelWidth=250,
+                                                           valueType=str, orientation="horizontal")
+        self.set_rays_storage()
 
         self.set_autosave()
 
@@ -351,7 +359,7 @@ plot(ticket['bin_path'], ticket['histogram_path'],
         flux         = self.input_data.get_flux(nolost=self.rays)
 
         if self.image_plane == 1:
-            new_shadow_beam = self.input_data.beam.duplicate()
+            new_shadow_beam = get_beam_copy(self.input_data.beam, self.rays_storage, self.get_full_precision_columns())
             dist = self.image_plane_new_position
             self.retrace_beam(new_shadow_beam, dist)
             beam_to_plot = new_shadow_beam
@@ -434,11 +442,22 @@ plot(ticket['bin_path'], ticket['histogram_path'],
 
         return x, auto_title, xum
 
+    def set_rays_storage(self):
+        self.le_full_precision_columns.setEnabled(self.rays_storage in [1, 2])
+
+    def __set_input_data(self, shadow_data: ShadowData):
+        # the received data is held upstream: only the copies made to retrace the beam are in the chosen storage
+        self.input_data = shadow_data
+        if self.rays_storage == 2: self.write_stdout(get_validation_text(*validate_compact_beam(shadow_data.beam, self.get_full_precision_columns())))
+
+    def get_full_precision_columns(self):
+        return parse_columns(self.full_precision_columns)
+
     @Inputs.shadow_data
     def set_shadow_data(self, shadow_data : ShadowData):
         if ShadowCongruence.check_empty_data(shadow_data):
             if ShadowCongruence.check_empty_beam(shadow_data.beam):
-                self.input_data = shadow_data
+                self.__set_input_data(shadow_data)
                 if self.is_automatic_run: self.plot_results()
             else:
                 MessageDialog.message(self, "Data not displayable: bad content", "Error", "critical")
@@ -5,7 +5,7 @@ from AnyQt.QtWidgets import QMessageBox
 
 from orangewidget import gui
 
-from orangewidget.widget import Input, Output
+from orangewidget.widget import MultiInput, Output
 
 from oasys2.widget.gui import Styles
 from oasys2.widget import gui as oasysgui
@@ -23,6 +23,39 @@ from orangecontrib.shadow4.util.shadow4_util import TriggerToolsDecorator
 from shadow4.tools.logger import set_verbose
 from shadow4.sources.s4_light_source_from_beamlines import S4LightSourceFromBeamlines
 from shadow4.beamline.s4_beamline import S4Beamline
+from shadow4.beam.s4_beam import S4Beam
+
+AMPLITUDE_COLUMNS = [6, 7, 8, 15, 16, 17] # electric fields (columns 7-9, 16-18)
+
+def merge_beams(beams, weights=None):
+    '''
+    Same result of appending the beams one after the other with S4Beam.append_beam(update_column_index=True), but the
+    merged array is allocated once and each beam is copied once into its slice: intensity weights are applied in
+    place on the slice, and the ray indices (column 12) are shifted by the number of rays of the previous beams.
+    '''
+    if len(beams) == 0: raise ValueError("No beams to merge")
+    if weights is None: weights = [1.0] * len(beams)
+
+    rays = numpy.empty((sum([beam.rays.shape[0] for beam in beams]), 18))
+
+    start        = 0
+    index_offset = 0
+    for beam, weight in zip(beams, weights):
+        end = start + beam.rays.shape[0]
+
+        rays[start:end] = beam.rays
+        if weight != 1.0: rays[start:end, AMPLITUDE_COLUMNS] *= numpy.sqrt(weight) # weights are intensities!
+        if index_offset != 0: rays[start:end, 11] += index_offset
+
+        start         = end
+        index_offset += beam.N
+
+    merged_beam = S4Beam(N=0) # S4Beam(array=...) would copy the rays again
+    merged_beam.rays = rays
+    # as append_beam: the total includes the lost rays removed from the cleaned beams
+    merged_beam._N_cleaned = index_offset if any([beam.is_cleaned() for beam in beams]) else None
+
+    return merged_beam
 
 class MergeBeams(GenericElement, TriggerToolsDecorator):
     name = "Merge Shadow4 Beam"
@@ -38,16 +71,8 @@ class MergeBeams(GenericElement, TriggerToolsDecorator):
     want_control_area = 1
 
     class Inputs:
-        shadow_data_1 = Input("Input Shadow Data # 1", ShadowData, default=True, auto_summary=False)
-        shadow_data_2 = Input("Input Shadow Data # 2", ShadowData, default=True, auto_summary=False)
-        shadow_data_3 = Input("Input Shadow Data # 3", ShadowData, default=True, auto_summary=False)
-        shadow_data_4 = Input("Input Shadow Data # 4", ShadowData, default=True, auto_summary=False)
-        shadow_data_5 = Input("Input Shadow Data # 5", ShadowData, default=True, auto_summary=False)
-        shadow_data_6 = Input("Input Shadow Data # 6", ShadowData, default=True, auto_summary=False)
-        shadow_data_7 = Input("Input Shadow Data # 7", ShadowData, default=True, auto_summary=False)
-        shadow_data_8 = Input("Input Shadow Data # 8", ShadowData, default=True, auto_summary=False)
-        shadow_data_9 = Input("Input Shadow Data # 9", ShadowData, default=True, auto_summary=False)
-        shadow_data_10 = Input("Input Shadow Data # 10", ShadowData, default=True, auto_summary=False)
+        shadow_data = MultiInput("Input Shadow Data", ShadowData, default=True, auto_summary=False,
+                                 replaces=["Input Shadow Data # " + str(index) for index in range(1, 11)])
 
     class Outputs:
         shadow_data = Output("Shadow Data", ShadowData, default=True, auto_summary=False)
@@ -55,31 +80,29 @@ class MergeBeams(GenericElement, TriggerToolsDecorator):
 
     want_main_area = 1
 
-    input_data_1 = None
-    input_data_2 = None
-    input_data_3 = None
-    input_data_4 = None
-    input_data_5 = None
-    input_data_6 = None
-    input_data_7 = None
-    input_data_8 = None
-    input_data_9 = None
-    input_data_10 = None
-
     use_weights = Setting(0)
+    weights = Setting("1.0, 1.0")
+    weights_from_channels = Setting(False)
 
-    weight_input_data_1 = Setting(1.0)
-    weight_input_data_2 = Setting(1.0)
-    weight_input_data_3 = Setting(1.0)
-    weight_input_data_4 = Setting(1.0)
-    weight_input_data_5 = Setting(1.0)
-    weight_input_data_6 = Setting(1.0)
-    weight_input_data_7 = Setting(1.0)
-    weight_input_data_8 = Setting(1.0)
-    weight_input_data_9 = Setting(1.0)
-    weight_input_data_10 = Setting(1.0)
+    number_of_inputs = 0
+
+    settings_version = 2
+
+    @classmethod
+    def migrate_settings(cls, settings, version):
+        # up to version 1: a weight for each of the 10 inputs (weight_input_data_1, ..., weight_input_data_10).
+        # The loaded links don't keep the number of their old input, so the weights are kept in the order of the
+        # inputs and fitted to the links present at the first merge (see get_weights)
+        if version < 2 and "weight_input_data_1" in settings:
+            weights = [float(settings.pop("weight_input_data_" + str(index), 1.0)) for index in range(1, 11)]
+            while len(weights) > 1 and weights[-1] == 1.0: weights.pop()
+
+            settings["weights"]               = ", ".join([str(weight) for weight in weights])
+            settings["weights_from_channels"] = len(weights) > 1
 
     def __init__(self):
+        self.input_data = []
+
         super().__init__(show_automatic_box=False, has_footprint=False)
 
         button_box = oasysgui.widgetBox(self.controlArea, "", addSpace=False, orientation="horizontal", width=self.CONTROL_AREA_WIDTH-5)
@@ -102,6 +125,9 @@ class MergeBeams(GenericElement, TriggerToolsDecorator):
         gen_box = gui.widgetBox(tab_basic, "Merge Shadow4 Data", orientation="vertical")
         gui.separator(gen_box)
 
+        le = oasysgui.lineEdit(gen_box, self, "number_of_inputs", "Connected Input Beams", labelWidth=300, valueType=int, orientation="horizontal")
+        le.setReadOnly(True)
+
         weight_box = oasysgui.widgetBox(gen_box, "Relative Weights", orientation="vertical")
 
         gui.comboBox(weight_box, self, "use_weights", label="Use Relative Weights?",
@@ -110,177 +136,65 @@ class MergeBeams(GenericElement, TriggerToolsDecorator):
 
         gui.separator(weight_box, height=10)
 
-        self.le_weight_input_data_1 = oasysgui.lineEdit(weight_box, self, "weight_input_data_1", "Input Beam 1 weight",
-                                                        labelWidth=300, valueType=float, orientation="horizontal")
-
-        self.le_weight_input_data_2 = oasysgui.lineEdit(weight_box, self, "weight_input_data_2", "Input Beam 2 weight",
-                                                        labelWidth=300, valueType=float, orientation="horizontal")
-
-        self.le_weight_input_data_3 = oasysgui.lineEdit(weight_box, self, "weight_input_data_3", "Input Beam 3 weight",
-                                                        labelWidth=300, valueType=float, orientation="horizontal")
-
-        self.le_weight_input_data_4 = oasysgui.lineEdit(weight_box, self, "weight_input_data_4", "Input Beam 4 weight",
-                                                        labelWidth=300, valueType=float, orientation="horizontal")
-
-        self.le_weight_input_data_5 = oasysgui.lineEdit(weight_box, self, "weight_input_data_5", "Input Beam 5 weight",
-                                                        labelWidth=300, valueType=float, orientation="horizontal")
+        self.le_weights = oasysgui.lineEdit(weight_box, self, "weights", "Input Beam weights (comma separated, in the order of the links)",
+                                            labelWidth=350, valueType=str, orientation="vertical", callback=self.set_Weights)
 
-        self.le_weight_input_data_6 = oasysgui.lineEdit(weight_box, self, "weight_input_data_6", "Input Beam 6 weight",
-                                                        labelWidth=300, valueType=float, orientation="horizontal")
+        self.set_UseWeights()
 
-        self.le_weight_input_data_7 = oasysgui.lineEdit(weight_box, self, "weight_input_data_7", "Input Beam 7 weight",
-                                                        labelWidth=300, valueType=float, orientation="horizontal")
+    @Inputs.shadow_data
+    def set_shadow_data(self, index, shadow_data: ShadowData):
+        self.input_data[index] = self.__check_shadow_data(index, shadow_data)
 
-        self.le_weight_input_data_8 = oasysgui.lineEdit(weight_box, self, "weight_input_data_8", "Input Beam 8 weight",
-                                                        labelWidth=300, valueType=float, orientation="horizontal")
+    @Inputs.shadow_data.insert
+    def insert_shadow_data(self, index, shadow_data: ShadowData):
+        self.input_data.insert(index, self.__check_shadow_data(index, shadow_data))
+        self.number_of_inputs = len(self.input_data)
 
-        self.le_weight_input_data_9 = oasysgui.lineEdit(weight_box, self, "weight_input_data_9", "Input Beam 9 weight",
-                                                        labelWidth=300, valueType=float, orientation="horizontal")
-
-        self.le_weight_input_data_10 = oasysgui.lineEdit(weight_box, self, "weight_input_data_10",
-                                                         "Input Beam 10 weight",
-                                                         labelWidth=300, valueType=float, orientation="horizontal")
-
-        self.le_weight_input_data_1.setEnabled(False)
-        self.le_weight_input_data_2.setEnabled(False)
-        self.le_weight_input_data_3.setEnabled(False)
-        self.le_weight_input_data_4.setEnabled(False)
-        self.le_weight_input_data_5.setEnabled(False)
-        self.le_weight_input_data_6.setEnabled(False)
-        self.le_weight_input_data_7.setEnabled(False)
-        self.le_weight_input_data_8.setEnabled(False)
-        self.le_weight_input_data_9.setEnabled(False)
-        self.le_weight_input_data_10.setEnabled(False)
-
-    @Inputs.shadow_data_1
-    def set_shadow_data1(self, shadow_data: ShadowData):
-        self.le_weight_input_data_1.setEnabled(False)
-        self.input_data_1 = None
+    @Inputs.shadow_data.remove
+    def remove_shadow_data(self, index):
+        self.input_data.pop(index)
+        self.number_of_inputs = len(self.input_data)
 
+    def __check_shadow_data(self, index, shadow_data: ShadowData):
         if ShadowCongruence.check_empty_data(shadow_data):
             if ShadowCongruence.check_good_beam(shadow_data.beam):
-                self.input_data_1 = shadow_data
-                if self.use_weights == 1: self.le_weight_input_data_1.setEnabled(True)
+                return shadow_data
             else:
-                QMessageBox.critical(self, "Error", "Data #1 not displayable: No good rays or bad content",
+                QMessageBox.critical(self, "Error", "Data #%d not displayable: No good rays or bad content" % (index + 1),
                                      QMessageBox.Ok)
 
-    @Inputs.shadow_data_2
-    def set_shadow_data2(self, shadow_data: ShadowData):
-        self.le_weight_input_data_2.setEnabled(False)
-        self.input_data_2 = None
+        return None
 
-        if ShadowCongruence.check_empty_data(shadow_data):
-            if ShadowCongruence.check_good_beam(shadow_data.beam):
-                self.input_data_2 = shadow_data
-                if self.use_weights == 1: self.le_weight_input_data_2.setEnabled(True)
-            else:
-                QMessageBox.critical(self, "Error", "Data #2 not displayable: No good rays or bad content",
-                                     QMessageBox.Ok)
+    def get_weights(self):
+        number_of_inputs = len(self.input_data)
 
-    @Inputs.shadow_data_3
-    def set_shadow_data3(self, shadow_data: ShadowData):
-        self.le_weight_input_data_3.setEnabled(False)
-        self.input_data_3 = None
+        if self.use_weights == 1:
+            weights = [float(weight) for weight in self.weights.replace(",", " ").split()]
 
-        if ShadowCongruence.check_empty_data(shadow_data):
-            if ShadowCongruence.check_good_beam(shadow_data.beam):
-                self.input_data_3 = shadow_data
-                if self.use_weights == 1: self.le_weight_input_data_3.setEnabled(True)
-            else:
-                QMessageBox.critical(self, "Error", "Data #3 not displayable: No good rays or bad content",
-                                     QMessageBox.Ok)
+            if self.weights_from_channels and number_of_inputs > 0: weights = self.__fit_weights_from_channels(weights, number_of_inputs)
 
-    @Inputs.shadow_data_4
-    def set_shadow_data4(self, shadow_data: ShadowData):
-        self.le_weight_input_data_4.setEnabled(False)
-        self.input_data_4 = None
+            if len(weights) > number_of_inputs: raise ValueError(f"Number of weights ({len(weights)}) larger than the number of input beams ({number_of_inputs})")
+            for index, weight in enumerate(weights):
+                if weight < 0: raise ValueError(f"Weight #{index + 1} must be >= 0")
 
-        if ShadowCongruence.check_empty_data(shadow_data):
-            if ShadowCongruence.check_good_beam(shadow_data.beam):
-                self.input_data_4 = shadow_data
-                if self.use_weights == 1: self.le_weight_input_data_4.setEnabled(True)
-            else:
-                QMessageBox.critical(self, "Error", "Data #4 not displayable: No good rays or bad content",
-                                     QMessageBox.Ok)
+            return weights + [1.0] * (number_of_inputs - len(weights))
+        else:
+            return [1.0] * number_of_inputs
 
-    @Inputs.shadow_data_5
-    def set_shadow_data5(self, shadow_data: ShadowData):
-        self.le_weight_input_data_5.setEnabled(False)
-        self.input_data_5 = None
+    def __fit_weights_from_channels(self, weights, number_of_inputs):
+        # weights of the old numbered inputs: they follow the links only if the linked inputs had the same weight
+        if len(set(weights)) > 1:
+            QMessageBox.warning(self, "Warning",
+                                "The weights were converted from the numbered inputs of an older version (" + self.weights + "), " +
+                                "but the links don't keep their input number: the first " + str(number_of_inputs) +
+                                " weights (1.0 for the others) are assigned to the input beams in the order of the links, please check them", QMessageBox.Ok)
 
-        if ShadowCongruence.check_empty_data(shadow_data):
-            if ShadowCongruence.check_good_beam(shadow_data.beam):
-                self.input_data_5 = shadow_data
-                if self.use_weights == 1: self.le_weight_input_data_5.setEnabled(True)
-            else:
-                QMessageBox.critical(self, "Error", "Data #5 not displayable: No good rays or bad content",
-                                     QMessageBox.Ok)
-
-    @Inputs.shadow_data_6
-    def set_shadow_data6(self, shadow_data: ShadowData):
-        self.le_weight_input_data_6.setEnabled(False)
-        self.input_data_6 = None
-
-        if ShadowCongruence.check_empty_data(shadow_data):
-            if ShadowCongruence.check_good_beam(shadow_data.beam):
-                self.input_data_6 = shadow_data
-                if self.use_weights == 1: self.le_weight_input_data_6.setEnabled(True)
-            else:
-                QMessageBox.critical(self, "Error", "Data #6 not displayable: No good rays or bad content",
-                                     QMessageBox.Ok)
-
-    @Inputs.shadow_data_7
-    def set_shadow_data7(self, shadow_data: ShadowData):
-        self.le_weight_input_data_7.setEnabled(False)
-        self.input_data_7 = None
-
-        if ShadowCongruence.check_empty_data(shadow_data):
-            if ShadowCongruence.check_good_beam(shadow_data.beam):
-                self.input_data_7 = shadow_data
-                if self.use_weights == 1: self.le_weight_input_data_7.setEnabled(True)
-            else:
-                QMessageBox.critical(self, "Error", "Data #7 not displayable: No good rays or bad content",
-                                     QMessageBox.Ok)
-
-    @Inputs.shadow_data_8
-    def set_shadow_data8(self, shadow_data: ShadowData):
-        self.le_weight_input_data_8.setEnabled(False)
-        self.input_data_8 = None
-
-        if ShadowCongruence.check_empty_data(shadow_data):
-            if ShadowCongruence.check_good_beam(shadow_data.beam):
-                self.input_data_8 = shadow_data
-                if self.use_weights == 1: self.le_weight_input_data_8.setEnabled(True)
-            else:
-                QMessageBox.critical(self, "Error", "Data #8 not displayable: No good rays or bad content",
-                                     QMessageBox.Ok)
+        weights = weights[:number_of_inputs]
 
-    @Inputs.shadow_data_9
-    def set_shadow_data9(self, shadow_data: ShadowData):
-        self.le_weight_input_data_9.setEnabled(False)
-        self.input_data_9 = None
+        self.weights               = ", ".join([str(weight) for weight in weights])
+        self.weights_from_channels = False
 
-        if ShadowCongruence.check_empty_data(shadow_data):
-            if ShadowCongruence.check_good_beam(shadow_data.beam):
-                self.input_data_9 = shadow_data
-                if self.use_weights == 1: self.le_weight_input_data_9.setEnabled(True)
-            else:
-                QMessageBox.critical(self, "Error", "Data #9 not displayable: No good rays or bad content",
-                                     QMessageBox.Ok)
-
-    @Inputs.shadow_data_10
-    def set_shadow_data10(self, shadow_data: ShadowData):
-        self.le_weight_input_data_10.setEnabled(False)
-        self.input_data_10 = None
-
-        if ShadowCongruence.check_empty_data(shadow_data):
-            if ShadowCongruence.check_good_beam(shadow_data.beam):
-                self.input_data_10 = shadow_data
-                if self.use_weights == 1: self.le_weight_input_data_10.setEnabled(True)
-            else:
-                QMessageBox.critical(self, "Error", "Data #10 not displayable: No good rays or bad content",
-                                     QMessageBox.Ok)
+        return weights
 
     def get_lightsource(self):
         try:    name = self.getNode().title
@@ -289,15 +203,11 @@ class MergeBeams(GenericElement, TriggerToolsDecorator):
         light_source = S4LightSourceFromBeamlines(name=name)
 
         try:
-            for index in range(1, 11):
-                current_data: ShadowData = getattr(self, "input_data_" + str(index))
+            weights = self.get_weights()
 
+            for index, current_data in enumerate(self.input_data):
                 if not current_data is None:
-                    if self.use_weights == 1:
-                        weight = getattr(self, "weight_input_data_" + str(index))
-                    else:
-                        weight = 1.0
-                    light_source.append_beamline(current_data.beamline, id="beamline channel %d" % (index), weight=weight)
+                    light_source.append_beamline(current_data.beamline, id="beamline channel %d" % (index + 1), weight=weights[index])
 
         except Exception as e:
             QMessageBox.critical(self, "Error", str(e), QMessageBox.Ok)
@@ -327,24 +237,17 @@ class MergeBeams(GenericElement, TriggerToolsDecorator):
         self.progressBarSet(5)
 
 
-        try:
-            merged_beam = None
+        merged_beam = None
 
-            for index in range(1, 11):
-                current_data: ShadowData = getattr(self, "input_data_" + str(index))
-                if not current_data is None:
-                    current_data_beam = current_data.beam.duplicate()
+        try:
+            weights = self.get_weights()
 
-                    if self.use_weights == 1:
-                        weight = getattr(self, "weight_input_data_" + str(index))
-                        if weight < 0: raise ValueError(f"Weight #{index} is must be > 0]")
+            beams          = [current_data.beam for current_data in self.input_data if not current_data is None]
+            merged_weights = [weight for current_data, weight in zip(self.input_data, weights) if not current_data is None]
 
-                        current_data_beam.apply_attenuation(numpy.sqrt(weight)) # weights are intensities!
+            if len(beams) == 0: raise ValueError("No input beams to merge")
 
-                    if merged_beam is None:
-                        merged_beam = current_data_beam
-                    else:
-                        merged_beam.append_beam(current_data_beam, update_column_index=True)
+            merged_beam = merge_beams(beams, merged_weights)
 
             self.Outputs.shadow_data.send(ShadowData(
                 beamline=S4Beamline(light_source=light_source),
@@ -362,16 +265,10 @@ class MergeBeams(GenericElement, TriggerToolsDecorator):
         self.progressBarFinished()
 
     def set_UseWeights(self):
-        self.le_weight_input_data_1.setEnabled(self.use_weights == 1 and not self.input_data_1 is None)
-        self.le_weight_input_data_2.setEnabled(self.use_weights == 1 and not self.input_data_2 is None)
-        self.le_weight_input_data_3.setEnabled(self.use_weights == 1 and not self.input_data_3 is None)
-        self.le_weight_input_data_4.setEnabled(self.use_weights == 1 and not self.input_data_4 is None)
-        self.le_weight_input_data_5.setEnabled(self.use_weights == 1 and not self.input_data_5 is None)
-        self.le_weight_input_data_6.setEnabled(self.use_weights == 1 and not self.input_data_6 is None)
-        self.le_weight_input_data_7.setEnabled(self.use_weights == 1 and not self.input_data_7 is None)
-        self.le_weight_input_data_8.setEnabled(self.use_weights == 1 and not self.input_data_8 is None)
-        self.le_weight_input_data_9.setEnabled(self.use_weights == 1 and not self.input_data_9 is None)
-        self.le_weight_input_data_10.setEnabled(self.use_weights == 1 and not self.input_data_10 is None)
+        self.le_weights.setEnabled(self.use_weights == 1)
+
+    def set_Weights(self):
+        self.weights_from_channels = False
 
 
 add_widget_parameters_to_module(__name__)
@@ -426,7 +323,7 @@ if __name__ == "__main__":
     a = QApplication(sys.argv)
     ow = MergeBeams()
     ow.show()
-    ow.set_shadow_data1(get_shadow_data())
-    ow.set_shadow_data2(get_shadow_data())
+    ow.insert_shadow_data(0, get_shadow_data())
+    ow.insert_shadow_data(1, get_shadow_data())
     a.exec()
     ow.saveSettings()
\ No newline at end of file
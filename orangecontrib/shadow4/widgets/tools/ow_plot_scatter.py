@@ -18,6 +18,7 @@ from orangecontrib.shadow4.util.shadow4_objects import ShadowData
 from orangecontrib.shadow4.util.shadow4_util import ShadowCongruence, ShadowPlot
 from orangecontrib.shadow4.widgets.gui.ow_automatic_element import AutomaticElement
 from orangecontrib.shadow4.util.python_script import PythonScript
+from orangecontrib.shadow4.util.shadow4_compact import get_beam_copy, parse_columns, validate_compact_beam, get_validation_text, RAYS_STORAGE_ITEMS, DEFAULT_FULL_PRECISION_COLUMNS
 
 from shadow4.beam.s4_beam import S4Beam
 
@@ -79,6 +80,8 @@ class PlotScatter(AutomaticElement):
     title = Setting("")
 
     conversion_active = Setting(1)
+    rays_storage      = Setting(0)
+    full_precision_columns = Setting(DEFAULT_FULL_PRECISION_COLUMNS)
 
     if has_opengl:
         backend = 1
@@ -180,6 +183,12 @@ class PlotScatter(AutomaticElement):
                      items=["No", "Yes"],
                      sendSelectedValue=False, orientation="horizontal", callback=self.set_is_conversion_active)
 
+        gui.comboBox(general_box, self, "rays_storage", label="Rays of the retraced copies", labelWidth=150,
+                     items=RAYS_STORAGE_ITEMS, sendSelectedValue=False, orientation="horizontal", callback=self.set_rays_storage)
+        self.le_full_precision_columns = oasysgui.lineEdit(general_box, self, "full_precision_columns", "Full precision columns (float64)", labelWidth=250,
+                                                           valueType=str, orientation="horizontal")
+        self.set_rays_storage()
+
         gui.comboBox(general_box, self, "backend", label="render backend", labelWidth=250,
                                          items=["matplotlib", "gl"],
                                          sendSelectedValue=False, orientation="horizontal")
@@ -205,11 +214,22 @@ class PlotScatter(AutomaticElement):
 
         self.set_visibility()
 
+    def set_rays_storage(self):
+        self.le_full_precision_columns.setEnabled(self.rays_storage in [1, 2])
+
+    def __set_input_data(self, shadow_data: ShadowData):
+        # the received data is held upstream: only the copies made to retrace the beam are in the chosen storage
+        self.input_data = shadow_data
+        if self.rays_storage == 2: self.writeStdOut(get_validation_text(*validate_compact_beam(shadow_data.beam, self.get_full_precision_columns())))
+
+    def get_full_precision_columns(self):
+        return parse_columns(self.full_precision_columns)
+
     @Inputs.shadow_data
     def set_shadow_data(self, shadow_data: ShadowData):
         if ShadowCongruence.check_empty_data(shadow_data):
             if ShadowCongruence.check_empty_beam(shadow_data.beam):
-                self.input_data = shadow_data
+                self.__set_input_data(shadow_data)
                 if self.is_automatic_run: self.plot_results()
             else:
                 MessageDialog.message(self, "Data not displayable: bad content", "Error", "critical")
@@ -426,7 +446,7 @@ plt.show()
         beam_to_plot = self.input_data.beam
 
         if self.image_plane == 1:
-            new_shadow_beam = beam_to_plot.duplicate()
+            new_shadow_beam = get_beam_copy(beam_to_plot, self.rays_storage, self.get_full_precision_columns())
             self.retrace_beam(new_shadow_beam, self.image_plane_new_position)
             beam_to_plot = new_shadow_beam
 
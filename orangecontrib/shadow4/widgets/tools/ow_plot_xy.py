@@ -17,6 +17,7 @@ from orangecontrib.shadow4.util.shadow4_objects import ShadowData
 from orangecontrib.shadow4.util.shadow4_util import ShadowCongruence, ShadowPlot
 from orangecontrib.shadow4.widgets.gui.ow_automatic_element import AutomaticElement
 from orangecontrib.shadow4.util.python_script import PythonScript
+from orangecontrib.shadow4.util.shadow4_compact import get_beam_copy, parse_columns, validate_compact_beam, get_validation_text, RAYS_STORAGE_ITEMS, DEFAULT_FULL_PRECISION_COLUMNS
 
 from shadow4.beam.s4_beam import S4Beam
 
@@ -66,6 +67,8 @@ class _PlotXY(AutomaticElement):
     x_column_index           = Setting(0)
     y_column_index           = Setting(2)
     conversion_active        = Setting(1)
+    rays_storage             = Setting(0)
+    full_precision_columns   = Setting(DEFAULT_FULL_PRECISION_COLUMNS)
     image_plane              = Setting(0)
     image_plane_new_position = Setting(10.0)
 
@@ -179,7 +182,7 @@ class _PlotXY(AutomaticElement):
 
         gui.button(incremental_box, self, "Clear", callback=self.clear_results)
 
-        histograms_box = oasysgui.widgetBox(tab_gen, "Histograms settings", addSpace=True, orientation="vertical", height=200)
+        histograms_box = oasysgui.widgetBox(tab_gen, "Histograms settings", addSpace=True, orientation="vertical", height=250)
 
         oasysgui.lineEdit(histograms_box, self, "number_of_bins_h", "Number of Bins H", labelWidth=250, valueType=int, orientation="horizontal")
         oasysgui.lineEdit(histograms_box, self, "number_of_bins_v", "Number of Bins V", labelWidth=250, valueType=int, orientation="horizontal")
@@ -193,6 +196,11 @@ class _PlotXY(AutomaticElement):
         gui.comboBox(histograms_box, self, "flip_v", label="Flip V Axis", labelWidth=250,
                                          items=["No", "Yes"],
                                          sendSelectedValue=False, orientation="horizontal")
+        gui.comboBox(histograms_box, self, "rays_storage", label="Rays of the retraced copies", labelWidth=150,
+                     items=RAYS_STORAGE_ITEMS, sendSelectedValue=False, orientation="horizontal", callback=self.set_rays_storage)
+        self.le_full_precision_columns = oasysgui.lineEdit(histograms_box, self, "full_precision_columns", "Full precision columns (float64)", labelWidth=250,
+                                                           valueType=str, orientation="horizontal")
+        self.set_rays_storage()
 
         self.set_autosave()
 
@@ -420,7 +428,7 @@ plot_image_with_histograms(ticket['histogram'], ticket['bin_h_center'], ticket['
 
 
         if self.image_plane == 1:
-            new_shadow_beam = beam_to_plot.duplicate()
+            new_shadow_beam = get_beam_copy(beam_to_plot, self.rays_storage, self.get_full_precision_columns())
             dist = self.image_plane_new_position
             self.retrace_beam(new_shadow_beam, dist)
             beam_to_plot = new_shadow_beam
@@ -554,11 +562,22 @@ plot_image_with_histograms(ticket['histogram'], ticket['bin_h_center'], ticket['
     def is_conversion_active(self):
         return self.conversion_active == 1
 
+    def set_rays_storage(self):
+        self.le_full_precision_columns.setEnabled(self.rays_storage in [1, 2])
+
+    def __set_input_data(self, shadow_data: ShadowData):
+        # the received data is held upstream: only the copies made to retrace the beam are in the chosen storage
+        self.input_data = shadow_data
+        if self.rays_storage == 2: self.writeStdOut(get_validation_text(*validate_compact_beam(shadow_data.beam, self.get_full_precision_columns())))
+
+    def get_full_precision_columns(self):
+        return parse_columns(self.full_precision_columns)
+
     @Inputs.shadow_data
     def set_shadow_data(self, shadow_data : ShadowData):
         if ShadowCongruence.check_empty_data(shadow_data):
             if ShadowCongruence.check_empty_beam(shadow_data.beam):
-                self.input_data = shadow_data
+                self.__set_input_data(shadow_data)
                 if self.is_automatic_run: self.plot_results()
             else:
                 MessageDialog.message(self, "Data not displayable: bad content", "Error", "critical")